@@ -557,9 +557,9 @@ class OpenBazaarAPI(APIResource):
                 moderators=request.args["moderators"] if "moderators" in request.args else None,
                 contract_id=request.args["contract_id"][0] if "contract_id" in request.args else None)
 
-            for keyword in request.args["keywords"]:
-                self.kserver.set(digest(keyword.lower()), unhexlify(c.get_contract_id()),
-                                 self.kserver.node.getProto().SerializeToString())
+            pointer = self.kserver.node.getProto().SerializeToString()
+            self.kserver.set_many([(digest(keyword.lower()), unhexlify(c.get_contract_id()), pointer)
+                                   for keyword in request.args["keywords"]])
             request.write(json.dumps({"success": True, "id": c.get_contract_id()}))
             request.finish()
             return server.NOT_DONE_YET
@@ -578,11 +578,11 @@ class OpenBazaarAPI(APIResource):
                     contract = json.load(filename, object_pairs_hook=OrderedDict)
                 c = Contract(self.db, contract=contract)
                 if "keywords" in c.contract["vendor_offer"]["listing"]["item"]:
-                    for keyword in c.contract["vendor_offer"]["listing"]["item"]["keywords"]:
-                        if keyword != "":
-                            self.kserver.delete(keyword.lower(), unhexlify(c.get_contract_id()),
-                                                self.keychain.signing_key.sign(
-                                                    unhexlify(c.get_contract_id()))[:64])
+                    keywords = c.contract["vendor_offer"]["listing"]["item"]["keywords"]
+                    contract_id = unhexlify(c.get_contract_id())
+                    signature = self.keychain.signing_key.sign(contract_id)[:64]
+                    self.kserver.delete_many([(keyword.lower(), contract_id, signature)
+                                              for keyword in keywords if keyword != ""])
                 if "delete_images" in request.args:
                     c.delete(delete_images=True)
                 else:
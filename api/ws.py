@@ -112,10 +112,7 @@ class WSProtocol(Protocol):
                         val.ParseFromString(mod)
                         n = objects.Node()
                         n.ParseFromString(val.serializedData)
-                        node_to_ask = Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
-                                           None if not n.HasField("relayAddress") else
-                                           (n.relayAddress.ip, n.relayAddress.port),
-                                           n.natType, n.vendor)
+                        node_to_ask = Node.fromProto(n)
                         if n.guid == KeyChain(self.factory.db).guid:
                             parse_profile(Profile(self.factory.db).get(), node_to_ask)
                         else:
@@ -221,31 +218,27 @@ class WSProtocol(Protocol):
                     listing_json["listing"]["ships_to"].append(str(CountryCode.Name(country)))
                 self.transport.write(str(bleach.clean(json.dumps(listing_json, indent=4), tags=ALLOWED_TAGS)))
 
-        def parse_results(values):
-            if values is not None:
-                for v in values:
-                    try:
-                        val = Value()
-                        val.ParseFromString(v)
-                        n = objects.Node()
-                        n.ParseFromString(val.serializedData)
-                        node_to_ask = Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
-                                           None if not n.HasField("relayAddress") else
-                                           (n.relayAddress.ip, n.relayAddress.port),
-                                           n.natType, n.vendor)
-                        if n.guid == KeyChain(self.factory.db).guid:
-                            proto = self.factory.db.ListingsStore().get_proto()
-                            l = Listings()
-                            l.ParseFromString(proto)
-                            for listing in l.listing:
-                                if listing.contract_hash == val.valueKey:
-                                    respond(listing, node_to_ask)
-                        else:
-                            self.factory.mserver.get_contract_metadata(node_to_ask, val.valueKey)\
-                                .addCallback(respond, node_to_ask)
-                    except Exception:
-                        pass
-        self.factory.kserver.get(keyword.lower()).addCallback(parse_results)
+        def parse_result(v):
+            try:
+                val = Value()
+                val.ParseFromString(v)
+                n = objects.Node()
+                n.ParseFromString(val.serializedData)
+                node_to_ask = Node.fromProto(n)
+                if n.guid == KeyChain(self.factory.db).guid:
+                    proto = self.factory.db.ListingsStore().get_proto()
+                    l = Listings()
+                    l.ParseFromString(proto)
+                    for listing in l.listing:
+                        if listing.contract_hash == val.valueKey:
+                            respond(listing, node_to_ask)
+                else:
+                    self.factory.mserver.get_contract_metadata(node_to_ask, val.valueKey)\
+                        .addCallback(respond, node_to_ask)
+            except Exception:
+                pass
+        # listings are sent to the client as each one is found rather than when the search ends
+        self.factory.kserver.get(keyword.lower(), onValue=parse_result)
 
     def dataReceived(self, payload):
         try:
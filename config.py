@@ -12,7 +12,9 @@ from os.path import expanduser, join, isfile
 from ConfigParser import ConfigParser
 from urlparse import urlparse
 
-PROTOCOL_VERSION = 13
+PROTOCOL_VERSION = 16
+# the oldest version of the protocol we'll still talk to
+MIN_PROTOCOL_VERSION = 13
 CONFIG_FILE = join(os.getcwd(), 'ob.cfg')
 
 # FIXME probably a better way to do this. This curretly checks two levels deep
@@ -26,6 +28,10 @@ DEFAULTS = {
     'data_folder': 'OpenBazaar',  # FIXME change to 'None' when issue #163 is resolved
     'ksize': '20',
     'alpha': '3',
+    'dht_max_bytes': '209715200',
+    'dht_max_entries': '250000',
+    'dht_max_values_per_keyword': '1000',
+    'dht_eviction_policy': 'farthest',
     'transaction_fee': '10000',
     'libbitcoin_server': 'tcp://libbitcoin1.openbazaar.org:9091',
     'libbitcoin_server_testnet': 'tcp://libbitcoin2.openbazaar.org:9091',
@@ -161,6 +167,10 @@ else:
 DATA_FOLDER = _platform_agnostic_data_path(cfg.get('CONSTANTS', 'DATA_FOLDER'))
 KSIZE = int(cfg.get('CONSTANTS', 'KSIZE'))
 ALPHA = int(cfg.get('CONSTANTS', 'ALPHA'))
+DHT_MAX_BYTES = int(cfg.get('CONSTANTS', 'DHT_MAX_BYTES'))
+DHT_MAX_ENTRIES = int(cfg.get('CONSTANTS', 'DHT_MAX_ENTRIES'))
+DHT_MAX_VALUES_PER_KEYWORD = int(cfg.get('CONSTANTS', 'DHT_MAX_VALUES_PER_KEYWORD'))
+DHT_EVICTION_POLICY = cfg.get('CONSTANTS', 'DHT_EVICTION_POLICY')
 TRANSACTION_FEE = int(cfg.get('CONSTANTS', 'TRANSACTION_FEE'))
 LIBBITCOIN_SERVER = cfg.get('CONSTANTS', 'LIBBITCOIN_SERVER')
 LIBBITCOIN_SERVER_TESTNET = cfg.get('CONSTANTS', 'LIBBITCOIN_SERVER_TESTNET')
@@ -3,12 +3,13 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import time
+
 from collections import Counter, defaultdict
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 from log import Logger
 
-from dht.utils import deferredDict
 from dht.node import Node, NodeHeap
 
 from protos import objects
@@ -17,8 +18,19 @@ from protos import objects
 class SpiderCrawl(object):
     """
     Crawl the network and look for given 160-bit keys.
+
+    Up to alpha requests are kept in flight. Each response is handled as soon
+    as it arrives and a new request goes out to the nearest uncontacted node
+    in its place. A peer that hasn't answered within `softTimeout` seconds
+    stops holding up a slot and is set aside until it answers (its response
+    is still used if it turns up later), and a peer whose request fails is
+    dropped. The crawl ends once the k nearest nodes have all responded and
+    nothing is left in flight, so only peers that responded are returned. It
+    waits on slow peers only while it has fewer than k nodes.
     """
 
+    softTimeout = 2
+
     def __init__(self, protocol, node, peers, ksize, alpha):
         """
         Create a new C{SpiderCrawl}er.
@@ -35,10 +47,22 @@ class SpiderCrawl(object):
         self.alpha = alpha
         self.node = node
         self.nearest = NodeHeap(self.node, self.ksize)
-        self.lastIDsCrawled = []
         self.log = Logger(system=self)
         self.log.debug("creating spider with peers: %s" % peers)
         self.nearest.push(peers)
+        # number of responses between the initial peers and each node we've heard of
+        self.depth = dict((peer.id, 0) for peer in peers)
+        self.inflight = {}
+        # ids of the peers that have responded
+        self.responded = set()
+        # id -> node for peers set aside by the soft timeout
+        self.slow = {}
+        self.hops = 0
+        self.queries = 0
+        self.started = None
+        self.elapsed = None
+        self._rpcmethod = None
+        self._finished = None
 
     def _find(self, rpcmethod):
         """
@@ -47,35 +71,141 @@ class SpiderCrawl(object):
         Args:
             rpcmethod: The protocol's callFindValue or callFindNode.
 
-        The process:
-          1. calls find_* to current ALPHA nearest not already queried nodes,
-             adding results to current nearest list of k nodes.
-          2. current nearest list needs to keep track of who has been queried already
-             sort by nearest, keep KSIZE
-          3. if list is same as last time, next call should be to everyone not
-             yet queried
-          4. repeat, unless nearest list has all been queried, then ur done
+        Returns a deferred which fires with the result of the whole lookup.
         """
         self.log.debug("crawling with nearest: %s" % str(tuple(self.nearest)))
-        count = self.alpha
-        if self.nearest.getIDs() == self.lastIDsCrawled:
-            self.log.debug("last iteration same as current - checking all in list now")
-            count = len(self.nearest)
-        self.lastIDsCrawled = self.nearest.getIDs()
+        self._rpcmethod = rpcmethod
+        if self._finished is None or self._finished.called:
+            self._finished = defer.Deferred()
+            self.started = time.time()
+        self._fill()
+        return self._finished
 
-        ds = {}
-        for peer in self.nearest.getUncontacted()[:count]:
-            ds[peer.id] = rpcmethod(peer, self.node)
-            self.nearest.markContacted(peer)
-        return deferredDict(ds).addCallback(self._nodesFound)
+    def _fill(self):
+        """
+        Top up the requests in flight, or finish if there's nothing left to do.
+        """
+        if self._rpcmethod is None:
+            return
+        if self._isDone():
+            self._finish()
+            return
+        if not self._searching():
+            return
+        for peer in self.nearest.getUncontacted()[:self.alpha - len(self.inflight)]:
+            self._query(peer)
+
+    def _query(self, peer):
+        self.nearest.markContacted(peer)
+        self.queries += 1
+        self.hops = max(self.hops, self.depth.get(peer.id, 0) + 1)
+        self.inflight[peer.id] = reactor.callLater(self.softTimeout, self._softTimeout, peer.id)
+        d = self._rpcmethod(peer, self.node)
+        d.addErrback(lambda _: (False, None))
+        d.addCallback(self._responseReceived, peer.id)
+
+    def _softTimeout(self, peerid):
+        if self.inflight.pop(peerid, None) is not None:
+            self.log.debug("%s is slow to respond, moving on" % peerid.encode("hex"))
+            peer = self.nearest.getNodeById(peerid)
+            if peer is not None:
+                self.slow[peerid] = peer
+                self.nearest.remove([peerid])
+            self._fill()
+
+    def _responseReceived(self, response, peerid):
+        timeout = self.inflight.pop(peerid, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        peer = self.slow.pop(peerid, None)
+        if self._rpcmethod is None:
+            return
+        response = RPCFindResponse(response)
+        if not response.happened():
+            self.nearest.remove([peerid])
+        else:
+            if peer is not None:
+                # a slow peer finally answered, it's a candidate again
+                self.nearest.push(peer)
+            self.responded.add(peerid)
+            self._handleResponse(peerid, response)
+        self._fill()
+
+    def _learned(self, peerid, nodes):
+        """
+        Record how many hops away from the starting peers newly learned nodes
+        are and add them to the nearest nodes, unless we've queried them
+        without an answer.
+        """
+        depth = self.depth.get(peerid, 0) + 1
+        for node in nodes:
+            self.depth.setdefault(node.id, depth)
+        self.nearest.push([node for node in nodes
+                           if node.id not in self.nearest.contacted or node.id in self.responded])
+
+    def _finish(self):
+        self._rpcmethod = None
+        for timeout in self.inflight.values():
+            if timeout.active():
+                timeout.cancel()
+        self.inflight = {}
+        self.elapsed = time.time() - self.started
+        self.log.debug("lookup for %s finished in %.3f seconds after %s hops and %s queries" %
+                       (self.node.id.encode("hex"), self.elapsed, self.hops, self.queries))
+        defer.maybeDeferred(self._result).chainDeferred(self._finished)
+
+    def _handleResponse(self, peerid, response):
+        """
+        Take in a single RPCFindResponse from a peer that responded.
+        """
+
+    # pylint: disable=R0201
+    def _searching(self):
+        """
+        Whether new peers should still be queried. Once this is False the crawl
+        only waits for the requests already in flight.
+        """
+        return True
+
+    def _isDone(self):
+        if len(self.inflight) > 0:
+            return False
+        # short of k nodes, the slow peers may still answer
+        if len(self.nearest) < self.ksize and len(self.slow) > 0:
+            return False
+        for peer in self.nearest:
+            if peer.id not in self.responded:
+                return False
+        return True
+
+    def _result(self):
+        """
+        Get the result of the lookup once it's done.
+        """
 
 
 class ValueSpiderCrawl(SpiderCrawl):
-    def __init__(self, protocol, node, peers, ksize, alpha):
+    def __init__(self, protocol, node, peers, ksize, alpha, onValue=None, maxValues=None):
+        """
+        Create a new C{ValueSpiderCrawl}er.
+
+        By default the crawl stops once a value has been found. If onValue is
+        given the crawl instead streams: every value with a valueKey we haven't
+        seen yet is passed to onValue as soon as it arrives and the crawl keeps
+        going through the k nearest nodes to gather values held by other peers.
+
+        Args:
+            onValue: a callable taking a serialized `objects.Value`.
+            maxValues: stop once this many distinct values have been found.
+        """
         SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
         # keep track of the single nearest node without value - per
         # section 2.3 so we can set the key there if found
         self.nearestWithoutValue = NodeHeap(self.node, 1)
+        self.foundValues = set()
+        self.valueKeys = set()
+        self.onValue = onValue
+        self.maxValues = maxValues
 
     def find(self):
         """
@@ -83,31 +213,47 @@ class ValueSpiderCrawl(SpiderCrawl):
         """
         return self._find(self.protocol.callFindValue)
 
-    def _nodesFound(self, responses):
-        """
-        Handle the result of an iteration in _find.
-        """
-        toremove = []
-        foundValues = []
-        for peerid, response in responses.items():
-            response = RPCFindResponse(response)
-            if not response.happened():
-                toremove.append(peerid)
-            elif response.hasValue():
-                # since we get back a list of values, we will just extend foundValues (excluding duplicates)
-                foundValues = list(set(foundValues) | set(response.getValue()))
-            else:
-                peer = self.nearest.getNodeById(peerid)
+    def _handleResponse(self, peerid, response):
+        if response.hasValue():
+            # since we get back a list of values, we will just extend foundValues (excluding duplicates)
+            for value in response.getValue():
+                self._valueFound(value)
+        else:
+            peer = self.nearest.getNodeById(peerid)
+            if peer is not None:
                 self.nearestWithoutValue.push(peer)
-                self.nearest.push(response.getNodeList())
-        self.nearest.remove(toremove)
+            self._learned(peerid, response.getNodeList())
+
+    def _valueFound(self, value):
+        if value in self.foundValues:
+            return
+        self.foundValues.add(value)
+        try:
+            v = objects.Value()
+            v.ParseFromString(value)
+        except Exception:
+            return
+        if v.valueKey not in self.valueKeys:
+            self.valueKeys.add(v.valueKey)
+            if self.onValue is not None:
+                self.onValue(value)
 
-        if len(foundValues) > 0:
-            return self._handleFoundValues(foundValues)
-        if self.nearest.allBeenContacted():
-            # not found!
-            return None
-        return self.find()
+    def _searching(self):
+        # once a value turns up, wait only for the requests already in flight
+        # since they may be holding more of the values stored under this key
+        return len(self.foundValues) == 0 or self.onValue is not None
+
+    def _isDone(self):
+        if self.maxValues is not None and len(self.valueKeys) >= self.maxValues:
+            return True
+        if not self._searching():
+            return len(self.inflight) == 0
+        return SpiderCrawl._isDone(self)
+
+    def _result(self):
+        if len(self.foundValues) > 0:
+            return self._handleFoundValues(list(self.foundValues))
+        return None
 
     def _handleFoundValues(self, values):
         """
@@ -163,22 +309,11 @@ class NodeSpiderCrawl(SpiderCrawl):
         """
         return self._find(self.protocol.callFindNode)
 
-    def _nodesFound(self, responses):
-        """
-        Handle the result of an iteration in _find.
-        """
-        toremove = []
-        for peerid, response in responses.items():
-            response = RPCFindResponse(response)
-            if not response.happened():
-                toremove.append(peerid)
-            else:
-                self.nearest.push(response.getNodeList())
-        self.nearest.remove(toremove)
+    def _handleResponse(self, peerid, response):
+        self._learned(peerid, response.getNodeList())
 
-        if self.nearest.allBeenContacted():
-            return list(self.nearest)
-        return self.find()
+    def _result(self):
+        return list(self.nearest)
 
 
 class RPCFindResponse(object):
@@ -218,11 +353,7 @@ class RPCFindResponse(object):
             try:
                 n = objects.Node()
                 n.ParseFromString(node)
-                newNode = Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
-                               None if not n.HasField("relayAddress") else (n.relayAddress.ip, n.relayAddress.port),
-                               n.natType,
-                               n.vendor)
-                nodes.append(newNode)
+                nodes.append(Node.fromProto(n))
             except Exception:
                 pass
         return nodes
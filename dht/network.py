@@ -5,24 +5,24 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import heapq
 import pickle
 import httplib
-from binascii import hexlify
 from twisted.internet.task import LoopingCall
 from twisted.internet import defer, reactor, task
 
 import nacl.signing
-import nacl.hash
 import nacl.encoding
 
 from seed import peers
 from log import Logger
 from dht.protocol import KademliaProtocol
-from dht.utils import deferredDict, digest
+from dht.utils import deferredDict, digest, LRUCache
 from dht.storage import ForgetfulStorage
 from dht.node import Node
 from dht.crawling import ValueSpiderCrawl
 from dht.crawling import NodeSpiderCrawl
+from keys.guid import verify_guid
 
 from protos import objects
 
@@ -42,12 +42,23 @@ def _anyRespondSuccess(responses):
     return False
 
 
+_MISSING = object()
+
+
 class Server(object):
     """
     High level view of a node instance.  This is the object that should be created
     to start listening as an active node on the network.
     """
 
+    # How long the results of get() and resolve() are cached for. Values are
+    # also never cached past their own ttl. Lookups which found nothing are
+    # cached for NEGATIVE_CACHE_TTL.
+    VALUE_CACHE_TTL = 60
+    NODE_CACHE_TTL = 120
+    NEGATIVE_CACHE_TTL = 15
+    CACHE_SIZE = 1000
+
     def __init__(self, node, db, signing_key, ksize=20, alpha=3, storage=None):
         """
         Create a server instance.  This will start listening on the given port.
@@ -66,6 +77,18 @@ class Server(object):
         self.node = node
         self.protocol = KademliaProtocol(self.node, self.storage, ksize, db, signing_key)
         self.refreshLoop = LoopingCall(self.refreshTable).start(3600)
+        self.cullLoop = LoopingCall(self.storage.cull)
+        self.cullLoop.start(60, now=False)
+        # lookups currently running, keyed by (type, target), so that identical
+        # concurrent lookups can share a single crawl
+        self.lookups = {}
+        self.lookupStats = {'hits': 0, 'misses': 0}
+        self.valueCache = LRUCache(self.CACHE_SIZE)
+        self.nodeCache = LRUCache(self.CACHE_SIZE)
+        # (ip, port) -> guid of the node cached at that address, so a timeout
+        # can find it without scanning nodeCache
+        self.nodeCacheAddresses = LRUCache(self.CACHE_SIZE)
+        self.protocol.timeoutListeners.append(self._nodeTimedOut)
 
     def listen(self, port):
         """
@@ -92,7 +115,7 @@ class Server(object):
         def republishKeys(_):
             for bucket in self.protocol.router.buckets:
                 for node in bucket.nodes.values():
-                    self.protocol.transferKeyValues(node)
+                    self.protocol.republisher.add(node)
 
         return defer.gatherResults(ds).addCallback(republishKeys)
 
@@ -171,15 +194,8 @@ class Server(object):
                     n = objects.Node()
                     try:
                         n.ParseFromString(result[1][0])
-                        h = nacl.hash.sha512(n.publicKey)
-                        hash_pow = h[40:]
-                        if int(hash_pow[:6], 16) >= 50 or hexlify(n.guid) != h[:40]:
-                            raise Exception('Invalid GUID')
-                        node = Node(n.guid, addr[0], addr[1], n.publicKey,
-                                    None if not n.HasField("relayAddress") else
-                                    (n.relayAddress.ip, n.relayAddress.port),
-                                    n.natType,
-                                    n.vendor)
+                        verify_guid(n.publicKey, n.guid)
+                        node = Node.fromProto(n, addr[0], addr[1])
                         self.protocol.router.addContact(node)
                         if n.natType == objects.FULL_CONE:
                             potential_relay_nodes.append((addr[0], addr[1]))
@@ -218,23 +234,109 @@ class Server(object):
             ds.append(self.protocol.stun(neighbor))
         return defer.gatherResults(ds).addCallback(handle)
 
-    def get(self, keyword):
+    def _coalesce(self, kind, target, crawl):
+        """
+        Start a lookup unless an identical one is already running, in which
+        case wait for that one instead.
+
+        Args:
+            kind: the type of lookup, e.g. "value" or "nodes".
+            target: the key being looked up.
+            crawl: a callable which starts the lookup and returns a `Deferred`.
+
+        Returns: a `Deferred` which fires with the result of the lookup.
+        """
+        key = (kind, target)
+        if key in self.lookups:
+            self.lookupStats['hits'] += 1
+            d = defer.Deferred()
+            self.lookups[key].append(d)
+            return d
+        self.lookupStats['misses'] += 1
+        waiting = self.lookups[key] = []
+
+        def done(result):
+            del self.lookups[key]
+            for d in waiting:
+                d.callback(list(result) if isinstance(result, list) else result)
+            return result
+        # maybeDeferred so a crawl that raises still clears the entry and fails everyone waiting on it
+        return defer.maybeDeferred(crawl).addBoth(done)
+
+    def lookupHitRate(self):
+        """
+        Get the fraction of lookups which were answered by joining one already in flight.
+        """
+        total = self.lookupStats['hits'] + self.lookupStats['misses']
+        return float(self.lookupStats['hits']) / total if total > 0 else 0.0
+
+    def _nodeTimedOut(self, node):
+        """
+        Drop a node that stopped responding from the resolve cache.
+        """
+        self.nodeCache.invalidate(node.id)
+        address = (node.ip, node.port)
+        guid = self.nodeCacheAddresses.get(address)
+        if guid is not None:
+            self.nodeCacheAddresses.invalidate(address)
+            cached = self.nodeCache.get(guid)
+            if cached is not None and (cached.ip, cached.port) == address:
+                self.nodeCache.invalidate(guid)
+
+    def _cacheValues(self, dkey, values):
+        ttl = self.NEGATIVE_CACHE_TTL
+        if values is not None:
+            ttl = self.VALUE_CACHE_TTL
+            for v in values:
+                try:
+                    val = objects.Value()
+                    val.ParseFromString(v)
+                    ttl = min(ttl, val.ttl)
+                except Exception:
+                    pass
+            values = list(values)
+        self.valueCache.set(dkey, values, ttl)
+
+    def get(self, keyword, onValue=None, maxValues=None):
         """
         Get a key if the network has it.
 
+        Args:
+            keyword: the keyword to look up. It's hashed before the lookup.
+            onValue: if given, called with each distinct serialized `objects.Value`
+                as soon as it's found, rather than waiting on the whole lookup.
+            maxValues: stop the lookup after this many distinct values.
+
         Returns:
             :class:`None` if not found, the value otherwise.
         """
         dkey = digest(keyword)
-        if self.storage.get(dkey) is not None:
-            return defer.succeed(self.storage.get(dkey))
+        values = self.storage.get(dkey)
+        if values is None:
+            values = self.valueCache.get(dkey, _MISSING)
+            if isinstance(values, list):
+                values = list(values)
+        if values is not _MISSING:
+            if values is not None and onValue is not None:
+                for v in values[:maxValues]:
+                    onValue(v)
+            return defer.succeed(values)
+
+        def cache(values):
+            if maxValues is None:
+                self._cacheValues(dkey, values)
+            return values
+
         node = Node(dkey)
         nearest = self.protocol.router.findNeighbors(node)
         if len(nearest) == 0:
             self.log.warning("there are no known neighbors to get key %s" % dkey.encode('hex'))
             return defer.succeed(None)
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
-        return spider.find()
+        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, onValue, maxValues)
+        if onValue is not None or maxValues is not None:
+            # a bounded or streaming lookup can't be shared with other callers
+            return spider.find().addCallback(cache)
+        return self._coalesce("value", dkey, spider.find).addCallback(cache)
 
     def set(self, keyword, key, value, ttl=604800):
         """
@@ -257,6 +359,7 @@ class Server(object):
             return defer.succeed(False)
 
         self.log.debug("setting '%s' on network" % keyword.encode("hex"))
+        self.valueCache.invalidate(keyword)
 
         def store(nodes):
             self.log.debug("setting '%s' on %s" % (keyword.encode("hex"), [str(i) for i in nodes]))
@@ -275,7 +378,7 @@ class Server(object):
             self.log.warning("there are no known neighbors to set keyword %s" % keyword.encode("hex"))
             return defer.succeed(False)
         spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
-        return spider.find().addCallback(store)
+        return self._coalesce("nodes", keyword, spider.find).addCallback(store)
 
     def delete(self, keyword, key, signature):
         """
@@ -293,6 +396,7 @@ class Server(object):
         """
         self.log.debug("deleting '%s':'%s' from the network" % (keyword.encode("hex"), key.encode("hex")))
         dkey = digest(keyword)
+        self.valueCache.invalidate(dkey)
 
         def delete(nodes):
             self.log.debug("deleting '%s' on %s" % (key.encode("hex"), [str(i) for i in nodes]))
@@ -311,6 +415,129 @@ class Server(object):
         spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.ksize)
         return spider.find().addCallback(delete)
 
+    def _findNodesMany(self, keywords, alpha, coalesce=True):
+        """
+        Run a `NodeSpiderCrawl` for each keyword at the same time and, once they've
+        all finished, pick the k closest to each keyword out of every node any of
+        the crawls found. Keywords which end up close together get the benefit
+        of each other's crawls.
+
+        Returns: a `Deferred` which fires with a dict of keyword -> [nodes].
+        """
+        ds = {}
+        for keyword in keywords:
+            node = Node(keyword)
+            nearest = self.protocol.router.findNeighbors(node)
+            if len(nearest) == 0:
+                self.log.warning("there are no known neighbors to find keyword %s" % keyword.encode("hex"))
+                continue
+            spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, alpha)
+            ds[keyword] = self._coalesce("nodes", keyword, spider.find) if coalesce else spider.find()
+
+        def closest(results):
+            found = {}
+            for nodes in results.values():
+                if isinstance(nodes, list):
+                    for n in nodes:
+                        found[n.id] = n
+            contacts = [(n.long_id, n) for n in found.values()]
+            ret = {}
+            for keyword in results:
+                target = Node(keyword).long_id
+                ret[keyword] = [n for _, n in heapq.nsmallest(self.ksize, contacts,
+                                                              key=lambda c, t=target: c[0] ^ t)]
+            return ret
+        return deferredDict(ds).addCallback(closest)
+
+    def _sendGrouped(self, destinations, items, call):
+        """
+        Group items by the nodes they're going to and make one call per node.
+
+        Args:
+            destinations: a list with a list of nodes for each item.
+            items: the arguments to pass to call for each item.
+            call: `callStoreMany` or `callDeleteMany`.
+
+        Returns: a `Deferred` which fires with a list saying, for each item,
+            whether at least one node accepted it.
+        """
+        groups = {}
+        for index, nodes in enumerate(destinations):
+            for n in nodes:
+                groups.setdefault(n.id, (n, []))[1].append(index)
+        results = [False] * len(items)
+
+        def record(response, indexes):
+            for index, ok in zip(indexes, response[1]):
+                results[index] = results[index] or ok
+
+        ds = []
+        for n, indexes in groups.values():
+            self.log.debug("sending %s values to %s" % (len(indexes), n))
+            ds.append(call(n, [items[i] for i in indexes]).addCallback(record, indexes))
+        return defer.DeferredList(ds).addCallback(lambda _: results)
+
+    def set_many(self, values, ttl=604800):
+        """
+        Like `set` for several key/value tuples at once. Nodes are looked up for
+        every keyword at the same time and each node is sent all of its values in
+        a single STORE_MANY.
+
+        Args:
+            values: a list of (keyword, key, value) tuples as taken by `set`.
+            ttl: how long the values should be stored for.
+
+        Return: a `Deferred` which fires with a list of booleans saying, for each
+            of the values, whether at least one peer stored it.
+        """
+        keywords = list(set(keyword for keyword, _, _ in values if len(keyword) == 20))
+        for keyword in keywords:
+            self.valueCache.invalidate(keyword)
+        self.log.debug("setting %s values under %s keywords on network" % (len(values), len(keywords)))
+
+        def store(nodes):
+            destinations = []
+            items = []
+            for keyword, key, value in values:
+                found = nodes.get(keyword, []) if len(keyword) == 20 else []
+                destinations.append(found)
+                items.append((keyword, key, value, ttl))
+                keynode = Node(keyword)
+                if len(found) > 0 and self.node.distanceTo(keynode) < max([n.distanceTo(keynode) for n in found]):
+                    self.storage[keyword] = (key, value, ttl)
+            return self._sendGrouped(destinations, items, self.protocol.callStoreMany)
+
+        return self._findNodesMany(keywords, self.alpha).addCallback(store)
+
+    def delete_many(self, deletes):
+        """
+        Like `delete` for several key/value pairs at once, sending each node a
+        single DELETE_MANY with everything it should delete.
+
+        Args:
+            deletes: a list of (keyword, key, signature) tuples as taken by `delete`.
+
+        Return: a `Deferred` which fires with a list of booleans saying, for each
+            pair, whether at least one peer deleted it.
+        """
+        dkeys = [digest(keyword) for keyword, _, _ in deletes]
+        for dkey in set(dkeys):
+            self.valueCache.invalidate(dkey)
+        self.log.debug("deleting %s values from the network" % len(deletes))
+
+        def delete(nodes):
+            destinations = []
+            items = []
+            for dkey, (_, key, signature) in zip(dkeys, deletes):
+                destinations.append(nodes.get(dkey, []))
+                items.append((dkey, key, signature))
+                if self.storage.getSpecific(dkey, key) is not None:
+                    self.storage.delete(dkey, key)
+            return self._sendGrouped(destinations, items, self.protocol.callDeleteMany)
+
+        # as in delete, use ksize as alpha to reach as many nodes storing the values as possible
+        return self._findNodesMany(set(dkeys), self.ksize, coalesce=False).addCallback(delete)
+
     def resolve(self, guid):
         """
         Given a guid return a `Node` object containing its ip and port or none if it's
@@ -328,7 +555,10 @@ class Server(object):
         def check_for_node(nodes):
             for node in nodes:
                 if node.id == node_to_find.id:
+                    self.nodeCache.set(guid, node, self.NODE_CACHE_TTL)
+                    self.nodeCacheAddresses.set((node.ip, node.port), guid, self.NODE_CACHE_TTL)
                     return node
+            self.nodeCache.set(guid, None, self.NEGATIVE_CACHE_TTL)
             return None
 
         index = self.protocol.router.getBucketFor(node_to_find)
@@ -337,18 +567,22 @@ class Server(object):
             if node.id == node_to_find.id:
                 return defer.succeed(node)
 
+        cached = self.nodeCache.get(guid, _MISSING)
+        if cached is not _MISSING:
+            return defer.succeed(cached)
+
         nearest = self.protocol.router.findNeighbors(node_to_find)
         if len(nearest) == 0:
             self.log.warning("there are no known neighbors to find node %s" % node_to_find.id.encode("hex"))
             return defer.succeed(None)
 
         spider = NodeSpiderCrawl(self.protocol, node_to_find, nearest, self.ksize, self.alpha)
-        return spider.find().addCallback(check_for_node)
+        return self._coalesce("nodes", guid, spider.find).addCallback(check_for_node)
 
     def saveState(self, fname):
         """
-        Save the state of this node (the alpha/ksize/id/immediate neighbors)
-        to a cache file with the given fname.
+        Save the state of this node (the alpha/ksize/id/immediate neighbors
+        and a snapshot of the routing table) to a cache file with the given fname.
         """
         data = {'ksize': self.ksize,
                 'alpha': self.alpha,
@@ -357,20 +591,25 @@ class Server(object):
                 'pubkey': self.node.pubkey,
                 'signing_key': self.protocol.signing_key,
                 'neighbors': self.bootstrappableNeighbors(),
+                'routing_table': self.protocol.router.snapshot(),
                 'testnet': self.protocol.multiplexer.testnet}
         if len(data['neighbors']) == 0:
             self.log.warning("no known neighbors, so not writing to cache.")
             return
-        with open(fname, 'w') as f:
-            pickle.dump(data, f)
+        with open(fname, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
 
     @classmethod
     def loadState(cls, fname, ip_address, port, multiplexer, db, nat_type, relay_node, callback=None, storage=None):
         """
         Load the state of this node (the alpha/ksize/id/immediate neighbors)
         from a cache file with the given fname.
+
+        If the cache holds a routing table snapshot the table is restored from
+        it straight away and the restored contacts are pinged in the background,
+        dropping those that no longer respond.
         """
-        with open(fname, 'r') as f:
+        with open(fname, 'rb') as f:
             data = pickle.load(f)
         if data['testnet'] != multiplexer.testnet:
             raise Exception('Cache uses wrong network parameters')
@@ -378,6 +617,10 @@ class Server(object):
         n = Node(data['id'], ip_address, port, data['pubkey'], relay_node, nat_type, data['vendor'])
         s = Server(n, db, data['signing_key'], data['ksize'], data['alpha'], storage=storage)
         s.protocol.connect_multiplexer(multiplexer)
+        restored = s.protocol.router.restore(data.get('routing_table', {}))
+        if len(restored) > 0:
+            s.log.info("restored %s contacts from the routing table cache" % len(restored))
+            s.validateContacts(restored)
         if len(data['neighbors']) > 0:
             if callback is not None:
                 s.bootstrap(data['neighbors']).addCallback(callback)
@@ -391,6 +634,33 @@ class Server(object):
                 s.bootstrap(s.querySeed(SEEDS))
         return s
 
+    def validateContacts(self, nodes, batch=None, interval=1):
+        """
+        Ping the given contacts a few at a time in the background. Any that
+        don't respond are removed from the routing table.
+
+        Args:
+            nodes: a `list` of `Node`s to check, in the order they should be pinged.
+            batch: how many to ping each interval. Defaults to alpha.
+            interval: seconds between batches.
+        """
+        pending = list(reversed(nodes))
+        batch = batch or self.alpha
+
+        def pingBatch():
+            if self.protocol.multiplexer.transport is None:
+                return
+            for _ in range(min(batch, len(pending))):
+                node = pending.pop()
+                if not self.protocol.router.isNewNode(node):
+                    self.protocol.callPing(node)
+            if len(pending) == 0:
+                loop.stop()
+
+        loop = LoopingCall(pingBatch)
+        loop.start(interval, now=False)
+        return loop
+
     def saveStateRegularly(self, fname, frequency=600):
         """
         Save the state of node with a given regularity to the given
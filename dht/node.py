@@ -3,22 +3,107 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 import heapq
+import weakref
 
+from binascii import hexlify
 from operator import itemgetter
 from protos import objects
 
 
 class Node(object):
+    """
+    A contact on the network.
+
+    Nodes are created for every message we receive and every contact in a
+    find_node response, so they are slotted and keep their long id and
+    serialized protobuf around. Use `Node.fromProto` to get one from a
+    protobuf; it reuses an existing instance for the same guid if every field
+    matches. Since those instances are shared, their fields can't be changed.
+    The address and public key of any node are read-only, while the relay
+    node, nat type and vendor flag can only be changed on nodes which were
+    created directly, such as our own.
+    """
+    __slots__ = ('id', '_ip', '_port', '_pubkey', 'long_id', '_relay_node', '_nat_type', '_vendor',
+                 '_serialized', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+
     def __init__(self, node_id, ip=None, port=None, pubkey=None,
                  relay_node=None, nat_type=None, vendor=False):
         self.id = node_id
-        self.ip = ip
-        self.port = port
-        self.pubkey = pubkey
-        self.relay_node = relay_node
-        self.nat_type = nat_type
-        self.vendor = vendor
-        self.long_id = long(node_id.encode('hex'), 16)
+        self._ip = ip
+        self._port = port
+        self._pubkey = pubkey
+        self._relay_node = relay_node
+        self._nat_type = nat_type
+        self._vendor = vendor
+        self._serialized = None
+        self.long_id = long(hexlify(node_id), 16)
+
+    @classmethod
+    def fromProto(cls, proto, ip=None, port=None):
+        """
+        Get a `Node` for an `objects.Node` protobuf.
+
+        Args:
+            proto: the `objects.Node` to read.
+            ip: the ip to use instead of the one in the protobuf.
+            port: the port to use instead of the one in the protobuf.
+        """
+        ip = proto.nodeAddress.ip if ip is None else ip
+        port = proto.nodeAddress.port if port is None else port
+        relay_node = None if not proto.HasField("relayAddress") else \
+            (proto.relayAddress.ip, proto.relayAddress.port)
+        node = cls._interned.get(proto.guid)
+        if node is None or (node.ip, node.port, node.pubkey, node.relay_node, node.nat_type, node.vendor) != \
+                (ip, port, proto.publicKey, relay_node, proto.natType, proto.vendor):
+            node = cls(proto.guid, ip, port, proto.publicKey, relay_node, proto.natType, proto.vendor)
+            cls._interned[proto.guid] = node
+        return node
+
+    @property
+    def ip(self):
+        return self._ip
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def pubkey(self):
+        return self._pubkey
+
+    @property
+    def relay_node(self):
+        return self._relay_node
+
+    @relay_node.setter
+    def relay_node(self, relay_node):
+        self._modify()
+        self._relay_node = relay_node
+
+    @property
+    def nat_type(self):
+        return self._nat_type
+
+    @nat_type.setter
+    def nat_type(self, nat_type):
+        self._modify()
+        self._nat_type = nat_type
+
+    @property
+    def vendor(self):
+        return self._vendor
+
+    @vendor.setter
+    def vendor(self, vendor):
+        self._modify()
+        self._vendor = vendor
+
+    def _modify(self):
+        if Node._interned.get(self.id) is self:
+            raise AttributeError("nodes returned by fromProto are shared and can't be modified")
+        self._serialized = None
 
     def getProto(self):
         node_address = objects.Node.IPAddress()
@@ -40,6 +125,14 @@ class Node(object):
 
         return n
 
+    def getSerializedProto(self):
+        """
+        Same as `getProto().SerializeToString()` but only serializes once.
+        """
+        if self._serialized is None:
+            self._serialized = self.getProto().SerializeToString()
+        return self._serialized
+
     def sameHomeAs(self, node):
         return self.ip == node.ip and self.port == node.port
 
@@ -65,6 +158,11 @@ class Node(object):
 class NodeHeap(object):
     """
     A heap of nodes ordered by distance to a given node.
+
+    Nodes are indexed by id so membership tests, lookups and removals don't
+    scan the heap. Removed nodes are left in the heap and skipped when they
+    reach the top, and the nearest `maxsize` nodes are cached until a push
+    or removal could change them.
     """
 
     def __init__(self, node, maxsize):
@@ -76,8 +174,11 @@ class NodeHeap(object):
         """
         self.node = node
         self.heap = []
+        self.entries = {}
         self.contacted = set()
         self.maxsize = maxsize
+        self._nearest = None
+        self._farthest = None
 
     def remove(self, peerIDs):
         """
@@ -87,20 +188,17 @@ class NodeHeap(object):
         removal of nodes may not change the visible size as previously added
         nodes suddenly become visible.
         """
-        peerIDs = set(peerIDs)
-        if len(peerIDs) == 0:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peerIDs:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        for peerID in peerIDs:
+            entry = self.entries.pop(peerID, None)
+            if entry is not None and self._nearest is not None and entry[1] in self._nearest:
+                self._nearest = None
+        if len(self.heap) > 2 * len(self.entries) + 16:
+            self.heap = self.entries.values()
+            heapq.heapify(self.heap)
 
     def getNodeById(self, node_id):
-        for _, node in self.heap:
-            if node.id == node_id:
-                return node
-        return None
+        entry = self.entries.get(node_id)
+        return entry[1] if entry is not None else None
 
     def allBeenContacted(self):
         return len(self.getUncontacted()) == 0
@@ -112,8 +210,12 @@ class NodeHeap(object):
         self.contacted.add(node.id)
 
     def popleft(self):
-        if len(self) > 0:
-            return heapq.heappop(self.heap)[1]
+        while len(self.heap) > 0:
+            entry = heapq.heappop(self.heap)
+            if self.entries.get(entry[1].id) is entry:
+                del self.entries[entry[1].id]
+                self._nearest = None
+                return entry[1]
         return None
 
     def push(self, nodes):
@@ -126,23 +228,32 @@ class NodeHeap(object):
             nodes = [nodes]
 
         for node in nodes:
-            if node not in self:
-                distance = self.node.distanceTo(node)
-                heapq.heappush(self.heap, (distance, node))
+            if node.id not in self.entries:
+                entry = (self.node.distanceTo(node), node)
+                self.entries[node.id] = entry
+                heapq.heappush(self.heap, entry)
+                if self._nearest is not None and (len(self._nearest) < self.maxsize or
+                                                  entry[0] < self._farthest):
+                    self._nearest = None
+
+    def nearest(self):
+        """
+        Get the closest `maxsize` nodes, closest first.
+        """
+        if self._nearest is None:
+            entries = heapq.nsmallest(self.maxsize, self.entries.itervalues())
+            self._nearest = map(itemgetter(1), entries)
+            self._farthest = entries[-1][0] if len(entries) > 0 else None
+        return self._nearest
 
     def __len__(self):
-        return min(len(self.heap), self.maxsize)
+        return min(len(self.entries), self.maxsize)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        return iter(list(self.nearest()))
 
     def __contains__(self, node):
-        # pylint: disable=unused-variable
-        for distance, n in self.heap:
-            if node.id == n.id:
-                return True
-        return False
+        return node.id in self.entries
 
     def getUncontacted(self):
-        return [n for n in self if n.id not in self.contacted]
+        return [n for n in self.nearest() if n.id not in self.contacted]
@@ -3,25 +3,32 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import time
 import random
+from collections import OrderedDict
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from zope.interface import implements
 import nacl.signing
 
 from dht.node import Node
 from dht.routing import RoutingTable
-from dht.utils import digest
+from dht.utils import digest, BloomFilter
 from log import Logger
-from net.rpcudp import RPCProtocol
+from net.rpcudp import RPCProtocol, TIMED_OUT
 from interfaces import MessageProcessor
 from protos import objects
-from protos.message import PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES
+from protos.message import PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES, \
+    INV_SUMMARY, STORE_MANY, DELETE_MANY
 
 
 class KademliaProtocol(RPCProtocol):
     implements(MessageProcessor)
 
+    # the first protocol versions to understand INV_SUMMARY and STORE_MANY/DELETE_MANY
+    INV_SUMMARY_VERSION = 14
+    STORE_MANY_VERSION = 15
+
     def __init__(self, sourceNode, storage, ksize, database, signing_key):
         self.ksize = ksize
         self.router = RoutingTable(self, ksize, sourceNode)
@@ -31,12 +38,26 @@ class KademliaProtocol(RPCProtocol):
         self.db = database
         self.signing_key = signing_key
         self.log = Logger(system=self)
-        self.handled_commands = [PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES]
+        # callables taking a Node, called whenever an RPC to that node times out
+        # or its connection is torn down
+        self.timeoutListeners = []
+        self.republisher = RepublishPlanner(self)
+        self.handled_commands = [PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES,
+                                 INV_SUMMARY, STORE_MANY, DELETE_MANY]
         RPCProtocol.__init__(self, sourceNode, self.router)
 
     def connect_multiplexer(self, multiplexer):
         self.multiplexer = multiplexer
 
+    def timeout(self, node):
+        RPCProtocol.timeout(self, node)
+        for listener in self.timeoutListeners:
+            listener(node)
+
+    def requestTimedOut(self, node):
+        for listener in self.timeoutListeners:
+            listener(node)
+
     def getRefreshIDs(self):
         """
         Get ids to search for to keep old buckets up to date.
@@ -52,19 +73,49 @@ class KademliaProtocol(RPCProtocol):
 
     def rpc_ping(self, sender):
         self.addToRouter(sender)
-        return [self.sourceNode.getProto().SerializeToString()]
+        return [self.sourceNode.getSerializedProto()]
 
     def rpc_store(self, sender, keyword, key, value, ttl):
         self.addToRouter(sender)
         self.log.debug("got a store request from %s, storing value" % str(sender))
+        return [str(self._store(keyword, key, value, ttl))]
+
+    def rpc_store_many(self, sender, *serialized_values):
+        """
+        Store each of the given serialized `objects.Value`s. Returns "True" or
+        "False" for each one, in order.
+        """
+        self.addToRouter(sender)
+        self.log.debug("got a store request for %s values from %s" % (len(serialized_values), str(sender)))
+        ret = []
+        for val in serialized_values:
+            try:
+                v = objects.Value()
+                v.ParseFromString(val)
+                ret.append(str(self._store(v.keyword, v.valueKey, v.serializedData, v.ttl)))
+            except Exception:
+                ret.append("False")
+        return ret
+
+    def _store(self, keyword, key, value, ttl):
         if len(keyword) == 20 and len(key) <= 33 and len(value) <= 2100 and int(ttl) <= 604800:
             self.storage[keyword] = (key, value, int(ttl))
-            return ["True"]
-        else:
-            return ["False"]
+            return True
+        return False
 
     def rpc_delete(self, sender, keyword, key, signature):
         self.addToRouter(sender)
+        return [str(self._delete(sender, keyword, key, signature))]
+
+    def rpc_delete_many(self, sender, *args):
+        """
+        Takes a flat list of keyword, key, signature triples and returns "True"
+        or "False" for each triple, in order.
+        """
+        self.addToRouter(sender)
+        return [str(self._delete(sender, *args[i:i + 3])) for i in range(0, len(args) - 2, 3)]
+
+    def _delete(self, sender, keyword, key, signature):
         value = self.storage.getSpecific(keyword, key)
         if value is not None:
             # Try to delete a message from the dht
@@ -73,9 +124,9 @@ class KademliaProtocol(RPCProtocol):
                     verify_key = nacl.signing.VerifyKey(sender.pubkey)
                     verify_key.verify(key, signature)
                     self.storage.delete(keyword, key)
-                    return ["True"]
+                    return True
                 except Exception:
-                    return ["False"]
+                    return False
             # Or try to delete a pointer
             else:
                 try:
@@ -86,12 +137,12 @@ class KademliaProtocol(RPCProtocol):
                         verify_key = nacl.signing.VerifyKey(pubkey)
                         verify_key.verify(key, signature)
                         self.storage.delete(keyword, key)
-                        return ["True"]
+                        return True
                     except Exception:
-                        return ["False"]
+                        return False
                 except Exception:
                     pass
-        return ["False"]
+        return False
 
     def rpc_find_node(self, sender, key):
         self.log.debug("finding neighbors of %s in local table" % key.encode('hex'))
@@ -100,9 +151,9 @@ class KademliaProtocol(RPCProtocol):
         nodeList = self.router.findNeighbors(node, exclude=sender)
         ret = []
         if self.sourceNode.id == key:
-            ret.append(self.sourceNode.getProto().SerializeToString())
+            ret.append(self.sourceNode.getSerializedProto())
         for n in nodeList:
-            ret.append(n.getProto().SerializeToString())
+            ret.append(n.getSerializedProto())
         return ret
 
     def rpc_find_value(self, sender, keyword):
@@ -127,6 +178,24 @@ class KademliaProtocol(RPCProtocol):
                 pass
         return ret
 
+    def rpc_inv_summary(self, sender, salt, *keywords):
+        """
+        Return a Bloom filter (built with salt) over keyword + valueKey for
+        every value we hold under the given keywords.
+        """
+        self.addToRouter(sender)
+        keys = []
+        for keyword in keywords:
+            try:
+                for k, _ in self.storage.iteritems(keyword):
+                    keys.append(keyword + k)
+            except Exception:
+                pass
+        f = BloomFilter.forCapacity(len(keys), salt=salt)
+        for key in keys:
+            f.add(key)
+        return [f.toString()]
+
     def rpc_values(self, sender, *serialized_values):
         self.addToRouter(sender)
         for val in serialized_values:
@@ -158,10 +227,65 @@ class KademliaProtocol(RPCProtocol):
         d = self.delete(nodeToAsk, keyword, key, signature)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
+    def callStoreMany(self, nodeToAsk, values):
+        """
+        Store a list of (keyword, key, value, ttl) on nodeToAsk. Fires with
+        (True, [bool]) saying whether each value was stored. Nodes too old for
+        STORE_MANY are sent a STORE for each value instead.
+        """
+        if self.peerVersion(nodeToAsk) < self.STORE_MANY_VERSION:
+            ds = [self.callStore(nodeToAsk, keyword, key, value, ttl) for keyword, key, value, ttl in values]
+            return defer.gatherResults(ds).addCallback(_collectResults)
+        serialized = []
+        for keyword, key, value, ttl in values:
+            v = objects.Value()
+            v.keyword = keyword
+            v.valueKey = key
+            v.serializedData = value
+            v.ttl = int(round(ttl))
+            serialized.append(v.SerializeToString())
+        d = self.store_many(nodeToAsk, *serialized)
+        return d.addCallback(self.handleCallResponse, nodeToAsk).addCallback(_parseResults, len(values))
+
+    def callDeleteMany(self, nodeToAsk, deletes):
+        """
+        Delete a list of (keyword, key, signature) from nodeToAsk. Fires with
+        (True, [bool]) saying whether each one was deleted.
+        """
+        if self.peerVersion(nodeToAsk) < self.STORE_MANY_VERSION:
+            ds = [self.callDelete(nodeToAsk, keyword, key, signature) for keyword, key, signature in deletes]
+            return defer.gatherResults(ds).addCallback(_collectResults)
+        args = []
+        for keyword, key, signature in deletes:
+            args.extend([keyword, key, signature])
+        d = self.delete_many(nodeToAsk, *args)
+        return d.addCallback(self.handleCallResponse, nodeToAsk).addCallback(_parseResults, len(deletes))
+
     def callInv(self, nodeToAsk, serlialized_inv_list):
         d = self.inv(nodeToAsk, *serlialized_inv_list)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
+    def callInvSummary(self, nodeToAsk, items):
+        """
+        Ask nodeToAsk which of the given (keyword, valueKey) pairs it's missing.
+        Fires with (True, [missing pairs]) like `callInv` fires with the INVs
+        that were requested.
+        """
+        salt = digest(random.getrandbits(255))[:8]
+        keywords = list(OrderedDict((keyword, None) for keyword, _ in items))
+
+        def missing(result):
+            if not result[0]:
+                return result
+            try:
+                f = BloomFilter.fromString(result[1][0], salt)
+            except Exception:
+                return False, None
+            return True, [(keyword, k) for keyword, k in items if keyword + k not in f]
+
+        d = self.inv_summary(nodeToAsk, salt, *keywords)
+        return d.addCallback(self.handleCallResponse, nodeToAsk).addCallback(missing)
+
     def callValues(self, nodeToAsk, serlialized_values_list):
         d = self.values(nodeToAsk, *serlialized_values_list)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
@@ -178,45 +302,64 @@ class KademliaProtocol(RPCProtocol):
         than the furtherst in that list, and the node for this server
         is closer than the closest in that list, then store the key/value
         on the new node (per section 2.5 of the paper)
+
+        This sends straight away. New contacts found while handling messages
+        go through `self.republisher` instead, which batches and paces them.
+        """
+        for n, items in self.republisher.plan([node]):
+            self.sendInv(n, items)
+
+    def sendInv(self, node, items):
+        """
+        Offer the given (keyword, valueKey) pairs to node and send it the values
+        it's missing.
+
+        Nodes new enough to understand INV_SUMMARY send back a Bloom filter of
+        what they already hold under those keywords, which costs a couple of
+        bytes per value instead of an INV for each one. Older nodes get the INVs.
+        A false positive in the filter means a value isn't sent this time; the
+        salt changes with every summary so it won't be the same value next time.
         """
-        def send_values(inv_list):
+        def send_values(result):
+            if not result[0]:
+                return
             values = []
-            if inv_list[0]:
-                for requested_inv in inv_list[1]:
-                    try:
-                        i = objects.Inv()
-                        i.ParseFromString(requested_inv)
-                        value = self.storage.getSpecific(i.keyword, i.valueKey)
-                        if value is not None:
-                            v = objects.Value()
-                            v.keyword = i.keyword
-                            v.valueKey = i.valueKey
-                            v.serializedData = value
-                            v.ttl = int(round(self.storage.get_ttl(i.keyword, i.valueKey)))
-                            values.append(v.SerializeToString())
-                    except Exception:
-                        pass
-                if len(values) > 0:
-                    self.callValues(node, values)
-
-        inv = []
-        for keyword in self.storage.iterkeys():
-            keynode = Node(keyword)
-            neighbors = self.router.findNeighbors(keynode, exclude=node)
-            if len(neighbors) > 0:
-                newNodeClose = node.distanceTo(keynode) < neighbors[-1].distanceTo(keynode)
-                thisNodeClosest = self.sourceNode.distanceTo(keynode) < neighbors[0].distanceTo(keynode)
-            if len(neighbors) == 0 \
-                    or (newNodeClose and thisNodeClosest) \
-                    or (thisNodeClosest and len(neighbors) < self.ksize):
-                # pylint: disable=W0612
-                for k, v in self.storage.iteritems(keyword):
+            for keyword, k in result[1]:
+                value = self.storage.getSpecific(keyword, k)
+                if value is not None:
+                    v = objects.Value()
+                    v.keyword = keyword
+                    v.valueKey = k
+                    v.serializedData = value
+                    v.ttl = int(round(self.storage.get_ttl(keyword, k)))
+                    values.append(v.SerializeToString())
+            if len(values) > 0:
+                self.callValues(node, values)
+
+        def parse_invs(inv_list):
+            if not inv_list[0]:
+                return inv_list
+            requested = []
+            for requested_inv in inv_list[1]:
+                try:
                     i = objects.Inv()
-                    i.keyword = keyword
-                    i.valueKey = k
-                    inv.append(i.SerializeToString())
-        if len(inv) > 0:
-            self.callInv(node, inv).addCallback(send_values)
+                    i.ParseFromString(requested_inv)
+                    requested.append((i.keyword, i.valueKey))
+                except Exception:
+                    pass
+            return True, requested
+
+        if self.peerVersion(node) >= self.INV_SUMMARY_VERSION:
+            d = self.callInvSummary(node, items)
+        else:
+            invs = []
+            for keyword, k in items:
+                i = objects.Inv()
+                i.keyword = keyword
+                i.valueKey = k
+                invs.append(i.SerializeToString())
+            d = self.callInv(node, invs).addCallback(parse_invs)
+        return d.addCallback(send_values)
 
     def handleCallResponse(self, result, node):
         """
@@ -225,8 +368,10 @@ class KademliaProtocol(RPCProtocol):
         """
         if result[0]:
             if self.router.isNewNode(node):
-                reactor.callLater(1, self.transferKeyValues, node)
+                self.republisher.add(node)
             self.router.addContact(node)
+        elif result[1] is TIMED_OUT:
+            self.log.debug("%s is slow to respond, keeping it in the router" % node)
         else:
             self.log.debug("no response from %s, removing from router" % node)
             self.router.removeContact(node)
@@ -240,9 +385,101 @@ class KademliaProtocol(RPCProtocol):
         """
         if self.router.isNewNode(node):
             self.log.debug("Found a new node, transferring key/values")
-            reactor.callLater(1, self.transferKeyValues, node)
+            self.republisher.add(node)
         self.router.addContact(node)
 
     def __iter__(self):
         return iter(self.handled_commands)
 
+
+def _parseResults(result, count):
+    """
+    Turn the response to a STORE_MANY or DELETE_MANY into (True, [bool]).
+    """
+    if not result[0]:
+        return False, [False] * count
+    # a NOT_FOUND reply carries no arguments
+    data = result[1] or ()
+    return True, [i < len(data) and data[i] == "True" for i in range(count)]
+
+
+def _collectResults(results):
+    """
+    Turn a list of STORE or DELETE responses into (True, [bool]).
+    """
+    return any(r[0] for r in results), [r[0] and len(r[1] or ()) > 0 and r[1][0] == "True" for r in results]
+
+
+class RepublishPlanner(object):
+    """
+    Works out which of our stored values should be offered to new contacts.
+
+    Contacts passed to `add` are collected for `delay` seconds and then
+    planned together: one pass over storage and one nearest neighbor query
+    for all keywords serves the whole batch. The resulting INVs are spread
+    out at no more than `rate` per second, each with up to `jitter` seconds
+    of random delay so a burst of new contacts doesn't become a burst of
+    traffic.
+    """
+
+    def __init__(self, protocol, delay=1, rate=20, jitter=0.5):
+        self.protocol = protocol
+        self.delay = delay
+        self.rate = rate
+        self.jitter = jitter
+        self.pending = OrderedDict()
+        self._planCall = None
+        self._nextSend = 0
+
+    def add(self, node):
+        """
+        Queue a contact to be planned with the next batch.
+        """
+        self.pending[node.id] = node
+        if self._planCall is None or not self._planCall.active():
+            self._planCall = reactor.callLater(self.delay, self.flush)
+
+    def flush(self):
+        """
+        Plan the queued contacts now and schedule their INVs.
+        """
+        if self._planCall is not None and self._planCall.active():
+            self._planCall.cancel()
+        self._planCall = None
+        nodes = self.pending.values()
+        self.pending = OrderedDict()
+        now = time.time()
+        self._nextSend = max(self._nextSend, now)
+        for node, items in self.plan(nodes):
+            delay = self._nextSend - now + random.uniform(0, self.jitter)
+            reactor.callLater(delay, self.protocol.sendInv, node, items)
+            self._nextSend += 1.0 / self.rate
+
+    def plan(self, nodes):
+        """
+        Get a list of (node, [(keyword, valueKey)]) for each of the given nodes which
+        should be offered some of our values (per section 2.5 of the paper).
+        """
+        protocol = self.protocol
+        ksize = protocol.ksize
+        offers = OrderedDict((node.id, []) for node in nodes)
+        keynodes = [Node(keyword) for keyword in protocol.storage.iterkeys()]
+        # every contact has its own address, so leaving out the one which shares
+        # a new node's address never takes more than one from the k + 1 nearest
+        neighborLists = protocol.router.findNeighborsMany(keynodes, ksize + 1)
+        for keynode, nearest in zip(keynodes, neighborLists):
+            items = None
+            ourDistance = protocol.sourceNode.distanceTo(keynode)
+            for node in nodes:
+                neighbors = [n for n in nearest if not n.sameHomeAs(node)][:ksize]
+                if len(neighbors) > 0:
+                    thisNodeClosest = ourDistance < neighbors[0].distanceTo(keynode)
+                    if not thisNodeClosest:
+                        continue
+                    newNodeClose = node.distanceTo(keynode) < neighbors[-1].distanceTo(keynode)
+                    if not newNodeClose and len(neighbors) >= ksize:
+                        continue
+                if items is None:
+                    items = [(keynode.id, k) for k, _ in protocol.storage.iteritems(keynode.id)]
+                offers[node.id].extend(items)
+        return [(node, offers[node.id]) for node in nodes if len(offers[node.id]) > 0]
@@ -5,16 +5,27 @@ Copyright (c) 2014 Brian Muller
 import heapq
 import time
 import operator
+from bisect import bisect_right
 from collections import OrderedDict
 
-from dht.utils import OrderedSet, sharedPrefix
+from dht.node import Node
+from dht.utils import ReplacementCache, sharedPrefix
 
 
 class KBucket(object):
-    def __init__(self, range_lower, range_upper, ksize):
+    def __init__(self, range_lower, range_upper, ksize, addresses=None, replacements=None):
+        """
+        @param addresses: An optional dict of (ip, port) -> C{Node} which
+        this bucket keeps up to date as nodes come and go. The routing
+        table shares one between all of its buckets.
+        @param replacements: The most contacts to keep in the replacement
+        cache. Defaults to ksize.
+        """
         self.range = (range_lower, range_upper)
         self.nodes = OrderedDict()
-        self.replacementNodes = OrderedSet()
+        self.lastSeen = {}
+        self.replacementNodes = ReplacementCache(replacements or ksize)
+        self.addresses = addresses if addresses is not None else {}
         self.touchLastUpdated()
         self.ksize = ksize
 
@@ -26,11 +37,16 @@ class KBucket(object):
 
     def split(self):
         midpoint = self.range[1] - ((self.range[1] - self.range[0]) / 2)
-        one = KBucket(self.range[0], midpoint, self.ksize)
-        two = KBucket(midpoint + 1, self.range[1], self.ksize)
+        cap = self.replacementNodes.maxsize
+        one = KBucket(self.range[0], midpoint, self.ksize, self.addresses, cap)
+        two = KBucket(midpoint + 1, self.range[1], self.ksize, self.addresses, cap)
         for node in self.nodes.values():
             bucket = one if node.long_id <= midpoint else two
             bucket.nodes[node.id] = node
+            bucket.lastSeen[node.id] = self.lastSeen[node.id]
+        for node in self.replacementNodes:
+            bucket = one if node.long_id <= midpoint else two
+            bucket.replacementNodes.push(node)
         return one, two
 
     def removeNode(self, node):
@@ -38,10 +54,20 @@ class KBucket(object):
             return
 
         # delete node, and see if we can add a replacement
-        del self.nodes[node.id]
-        if len(self.replacementNodes) > 0:
+        self._unindex(self.nodes.pop(node.id))
+        del self.lastSeen[node.id]
+        while len(self.replacementNodes) > 0:
             newnode = self.replacementNodes.pop()
-            self.nodes[newnode.id] = newnode
+            # skip replacements whose address has since been taken by another node
+            if self.addresses.get((newnode.ip, newnode.port), newnode).id == newnode.id:
+                self.nodes[newnode.id] = newnode
+                self.lastSeen[newnode.id] = time.time()
+                self.addresses[(newnode.ip, newnode.port)] = newnode
+                break
+
+    def _unindex(self, node):
+        if self.addresses.get((node.ip, node.port)) is node:
+            del self.addresses[(node.ip, node.port)]
 
     def hasInRange(self, node):
         return self.range[0] <= node.long_id <= self.range[1]
@@ -58,13 +84,16 @@ class KBucket(object):
         per section 4.1 of the paper.
         """
         if node.id in self.nodes:
-            del self.nodes[node.id]
+            self._unindex(self.nodes.pop(node.id))
             self.nodes[node.id] = node
         elif len(self) < self.ksize:
             self.nodes[node.id] = node
+            self.replacementNodes.remove(node)
         else:
             self.replacementNodes.push(node)
             return False
+        self.addresses[(node.ip, node.port)] = node
+        self.lastSeen[node.id] = time.time()
         return True
 
     def depth(self):
@@ -81,57 +110,42 @@ class KBucket(object):
         return len(self.nodes)
 
 
-class TableTraverser(object):
-    def __init__(self, table, startNode):
-        index = table.getBucketFor(startNode)
-        table.buckets[index].touchLastUpdated()
-        self.currentNodes = table.buckets[index].getNodes()
-        self.leftBuckets = table.buckets[:index]
-        self.rightBuckets = table.buckets[(index + 1):]
-        self.left = True
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        """
-        Pop an item from the left subtree, then right, then left, etc.
-        """
-        if len(self.currentNodes) > 0:
-            return self.currentNodes.pop()
-
-        if self.left and len(self.leftBuckets) > 0:
-            self.currentNodes = self.leftBuckets.pop().getNodes()
-            self.left = False
-            return self.next()
-
-        if len(self.rightBuckets) > 0:
-            self.currentNodes = self.rightBuckets.pop().getNodes()
-            self.left = True
-            return self.next()
-
-        raise StopIteration
-
-
 class RoutingTable(object):
-    def __init__(self, protocol, ksize, node):
+    SNAPSHOT_VERSION = 1
+    # findNeighborsMany scans every contact instead of walking the buckets
+    # when asked for at least this many neighbors per node
+    FLAT_SCAN_MIN_K = 40
+
+    def __init__(self, protocol, ksize, node, replacements=None):
         """
         @param node: The node that represents this server.  It won't
         be added to the routing table, but will be needed later to
         determine which buckets to split or not.
+        @param replacements: The most contacts each bucket keeps in its
+        replacement cache. Defaults to ksize.
         """
         self.node = node
         self.protocol = protocol
         self.ksize = ksize
+        self.replacements = replacements
         self.flush()
 
     def flush(self):
-        self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        # (ip, port) -> node for every contact in the table, so duplicate
+        # addresses can be found without walking all of the buckets
+        self.addresses = {}
+        self.buckets = [KBucket(0, 2 ** 160, self.ksize, self.addresses, self.replacements)]
+        self._contacts = None
+        # upper bound of each bucket's range, kept in the same order as
+        # self.buckets so getBucketFor can bisect instead of scanning
+        self.bounds = [2 ** 160]
 
     def splitBucket(self, index):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.bounds[index] = one.range[1]
+        self.bounds.insert(index + 1, two.range[1])
 
     def getLonelyBuckets(self):
         """
@@ -143,18 +157,20 @@ class RoutingTable(object):
     def removeContact(self, node):
         index = self.getBucketFor(node)
         self.buckets[index].removeNode(node)
+        self._contacts = None
 
     def isNewNode(self, node):
         index = self.getBucketFor(node)
         return self.buckets[index].isNewNode(node)
 
     def checkAndRemoveDuplicate(self, node):
-        for bucket in self.buckets:
-            for n in bucket.getNodes():
-                if (n.ip, n.port) == (node.ip, node.port) and n.id != node.id:
-                    self.removeContact(n)
+        n = self.addresses.get((node.ip, node.port))
+        if n is not None and n.id != node.id:
+            self.removeContact(n)
 
     def addContact(self, node):
+        if self.addresses.get((node.ip, node.port)) is not node:
+            self._contacts = None
         self.checkAndRemoveDuplicate(node)
         index = self.getBucketFor(node)
         bucket = self.buckets[index]
@@ -171,21 +187,126 @@ class RoutingTable(object):
         else:
             self.protocol.callPing(bucket.head())
 
+    def snapshot(self):
+        """
+        Get a picklable copy of the whole table: every bucket's range and
+        last update, and every contact with the time we last heard from it.
+        See C{restore}.
+        """
+        buckets = []
+        for bucket in self.buckets:
+            contacts = [(n.id, n.ip, n.port, n.pubkey, n.nat_type, n.relay_node, n.vendor, bucket.lastSeen[n.id])
+                        for n in bucket.getNodes()]
+            buckets.append((bucket.range[0], bucket.range[1], bucket.lastUpdated, contacts))
+        return {'version': self.SNAPSHOT_VERSION, 'buckets': buckets}
+
+    def restore(self, snapshot):
+        """
+        Replace the contents of the table with a snapshot taken by C{snapshot}.
+        Returns the restored contacts, least recently seen first, or an empty
+        list if the snapshot is from an incompatible version.
+        """
+        if snapshot.get('version') != self.SNAPSHOT_VERSION:
+            return []
+        self.flush()
+        self.buckets = []
+        self.bounds = []
+        nodes = []
+        for lower, upper, lastUpdated, contacts in snapshot['buckets']:
+            bucket = KBucket(lower, upper, self.ksize, self.addresses, self.replacements)
+            bucket.lastUpdated = lastUpdated
+            for guid, ip, port, pubkey, nat_type, relay_node, vendor, lastSeen in contacts:
+                node = Node(guid, ip, port, pubkey, relay_node, nat_type, vendor)
+                bucket.nodes[guid] = node
+                bucket.lastSeen[guid] = lastSeen
+                self.addresses[(ip, port)] = node
+                nodes.append((lastSeen, node))
+            self.buckets.append(bucket)
+            self.bounds.append(upper)
+        return [n for _, n in sorted(nodes, key=operator.itemgetter(0))]
+
     def getBucketFor(self, node):
         """
         Get the index of the bucket that the given node would fall into.
         """
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
+        index = bisect_right(self.bounds, node.long_id)
+        if index < len(self.buckets):
+            return index
+
+    def getContacts(self):
+        """
+        Get a list of (long_id, node) for every contact in the table. The list
+        is cached until the set of contacts changes.
+        """
+        if self._contacts is None:
+            self._contacts = [(n.long_id, n) for n in self.addresses.itervalues()]
+        return self._contacts
 
     def findNeighbors(self, node, k=None, exclude=None):
-        k = k or self.ksize
-        nodes = []
-        for neighbor in TableTraverser(self, node):
-            if exclude is None or not neighbor.sameHomeAs(exclude):
-                heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
-            if len(nodes) == k:
+        """
+        Find the k closest contacts to node, closest first.
+
+        Buckets are visited in order of the smallest distance any id in their
+        range could have from node, and the walk stops once the next bucket
+        can't hold anything closer than the k found so far. That usually
+        means only the buckets around node are looked at.
+
+        @param exclude: An optional C{Node} whose address should be left out of the results.
+        """
+        self.buckets[self.getBucketFor(node)].touchLastUpdated()
+        return self._walkNeighbors(node, k or self.ksize, exclude)
+
+    def _walkNeighbors(self, node, k, exclude):
+        target = node.long_id
+        buckets = sorted((self._rangeDistance(bucket, target), i) for i, bucket in enumerate(self.buckets))
+        # a max heap of the k closest so far, by negated distance
+        nearest = []
+        for bound, i in buckets:
+            if len(nearest) == k and bound > -nearest[0][0]:
                 break
+            for neighbor in self.buckets[i].nodes.itervalues():
+                if exclude is not None and neighbor.sameHomeAs(exclude):
+                    continue
+                entry = (-(neighbor.long_id ^ target), neighbor)
+                if len(nearest) < k:
+                    heapq.heappush(nearest, entry)
+                elif entry[0] > nearest[0][0]:
+                    heapq.heapreplace(nearest, entry)
+        return [n for _, n in sorted(nearest, key=operator.itemgetter(0), reverse=True)]
+
+    @staticmethod
+    def _rangeDistance(bucket, target):
+        """
+        A lower bound on the distance between target and any id in the bucket's
+        range. Every id in the range shares the bits above the highest bit
+        where its bounds differ, so those bits of the distance are fixed.
+        """
+        lower, upper = bucket.range
+        shift = (lower ^ upper).bit_length()
+        return ((lower ^ target) >> shift) << shift
 
-        return map(operator.itemgetter(1), heapq.nsmallest(k, nodes))
+    def findNeighborsMany(self, nodes, k=None, exclude=None):
+        """
+        Find the k closest contacts to each of the given nodes.
+
+        Like C{findNeighbors} this walks the buckets around each node. When k
+        is large the walk ends up visiting most of the table anyway, so then
+        it's cheaper to scan a flat list of every contact, which is built
+        (and filtered) once for the whole batch.
+
+        @param nodes: A list of C{Node}s (or anything with a long_id) to search around.
+        @param exclude: An optional C{Node} whose address should be left out of the results.
+        @return: A list with a list of up to k C{Node}s for each node, closest first.
+        """
+        k = k or self.ksize
+        if k < self.FLAT_SCAN_MIN_K:
+            return [self._walkNeighbors(node, k, exclude) for node in nodes]
+        contacts = self.getContacts()
+        if exclude is not None:
+            contacts = [c for c in contacts if not c[1].sameHomeAs(exclude)]
+        results = []
+        for node in nodes:
+            target = node.long_id
+            nearest = heapq.nsmallest(k, [(long_id ^ target, n) for long_id, n in contacts])
+            results.append(map(operator.itemgetter(1), nearest))
+        return results
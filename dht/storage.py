@@ -3,12 +3,20 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import os
 import time
+import mmap
+import zlib
+import heapq
+import struct
 import sqlite3 as lite
 from collections import OrderedDict, MutableMapping
 from zope.interface import implements, Interface
 from protos.objects import Value
 from threading import RLock
+from twisted.internet import reactor
+from log import Logger
+from dht.utils import LRUCache
 
 
 class IStorage(Interface):
@@ -65,54 +73,96 @@ class IStorage(Interface):
 class ForgetfulStorage(object):
     implements(IStorage)
 
-    def __init__(self, ttl=604800):
+    def __init__(self, ttl=604800, quota=None):
         """
         By default, max age is a week.
+
+        Args:
+            ttl: the max age of a value.
+            quota: an optional `StorageQuota` limiting how much we will store.
         """
         self.data = OrderedDict()
         self.ttl = ttl
+        self.quota = quota
+        self.value_cache = ValueCache()
+        # heap of (expiration, keyword) tuples. Entries go stale when a value is
+        # deleted or re-stored; cull() just skips over those.
+        self._expirations = []
 
     def __setitem__(self, keyword, values):
-        valueDic = TTLDict(self.ttl)
+        if keyword in self.data and values[0] in self.data[keyword]:
+            self.cull()
+            return
+        if self.quota is not None and not self.quota.admit(keyword, values[0]):
+            return
         if keyword in self.data:
             valueDic = self.data[keyword]
-            if values[0] not in valueDic:
-                valueDic[values[0]] = values[1]
-                valueDic.set_ttl(values[0], values[2])
         else:
-            valueDic[values[0]] = values[1]
-            valueDic.set_ttl(values[0], values[2])
+            valueDic = TTLDict(self.ttl)
             self.data[keyword] = valueDic
+        valueDic[values[0]] = values[1]
+        valueDic.set_ttl(values[0], values[2])
+        self.value_cache.invalidate(keyword)
+        expiration = time.time() + values[2]
+        heapq.heappush(self._expirations, (expiration, keyword))
+        if self.quota is not None:
+            self.quota.add(keyword, values[0], len(values[0]) + len(values[1]), expiration)
+            for victim in self.quota.victims():
+                self._remove(*victim)
         self.cull()
 
     def cull(self):
-        for key in self.data.iterkeys():
-            self.data[key].cull()
-            if len(self.data[key]) == 0:
-                del self.data[key]
+        """
+        Remove expired values. Only the keywords with something due to expire
+        are visited so this is cheap enough to call on every access.
+        """
+        now = time.time()
+        while len(self._expirations) > 0 and self._expirations[0][0] < now:
+            keyword = heapq.heappop(self._expirations)[1]
+            if keyword not in self.data:
+                continue
+            self.value_cache.invalidate(keyword)
+            self.data[keyword].cull(now)
+            if self.quota is not None:
+                self.quota.retain(keyword, self.data[keyword])
+            if len(self.data[keyword]) == 0:
+                del self.data[keyword]
 
     def get(self, keyword, default=None):
         self.cull()
         if keyword in self.data:
-            ret = []
-            for k, v in self[keyword].items():
-                value = Value()
-                value.valueKey = k
-                value.serializedData = v
-                value.ttl = int(round(self.data[keyword].get_ttl(k)))
-                ret.append(value.SerializeToString())
-            return ret
+            if keyword not in self.value_cache:
+                now = time.time()
+                values = [(k, v, now + self.data[keyword].get_ttl(k, now)) for k, v in self[keyword].items()]
+                self.value_cache.put(keyword, values)
+            if self.quota is not None:
+                for k in self.value_cache.keys(keyword):
+                    self.quota.touch(keyword, k)
+            return self.value_cache.get(keyword) or default
         return default
 
     def getSpecific(self, keyword, key):
         self.cull()
         if keyword in self.data and key in self.data[keyword]:
+            if self.quota is not None:
+                self.quota.touch(keyword, key)
             return self.data[keyword][key]
 
     def delete(self, keyword, key):
-        del self.data[keyword][key]
+        self._remove(keyword, key)
+        if self.quota is not None:
+            self.quota.remove(keyword, key)
         self.cull()
 
+    def _remove(self, keyword, key):
+        self.value_cache.invalidate(keyword)
+        if keyword not in self.data:
+            return
+        if key in self.data[keyword]:
+            del self.data[keyword][key]
+        if len(self.data[keyword]) == 0:
+            del self.data[keyword]
+
     def __getitem__(self, keyword):
         self.cull()
         return self.data[keyword]
@@ -141,110 +191,781 @@ class ForgetfulStorage(object):
 class PersistentStorage(object):
     implements(IStorage)
 
-    def __init__(self, filename, ttl=604800):
+    def __init__(self, filename, ttl=604800, flush_interval=None, flush_size=500, quota=None):
+        """
+        Args:
+            filename: the path to the sqlite database.
+            ttl: the max age of a value. By default a week.
+            quota: an optional `StorageQuota` limiting how much we will store.
+            flush_interval: if set, stores are buffered in memory and written to the
+                database in a single transaction this many seconds after the first
+                buffered write. If `None` every store is committed immediately.
+            flush_size: flush the buffer early once this many values are pending.
 
+        Expired values are filtered out on read. They are only deleted from the
+        database when `cull()` is called which `dht.network.Server` does on a timer.
+        """
         self.ttl = ttl
+        self.quota = quota
+        self.value_cache = ValueCache()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._pending_count = 0
+        self._flush_call = None
         self.db = lite.connect(filename)
         self.db.text_factory = str
+        cursor = self.db.cursor()
+        cursor.execute('''PRAGMA table_info(dht)''')
+        columns = dict((row[1], row[2]) for row in cursor.fetchall())
+        # older versions stored the keyword hex encoded
+        legacy = columns.get("keyword") == "TEXT"
+        # sqlite3 commits before every schema change on its own. Take over the
+        # transaction so a crash part way through a migration rolls it back
+        # and leaves the old table as it was.
+        self.db.isolation_level = None
         try:
-            cursor = self.db.cursor()
-            cursor.execute('''CREATE TABLE dht(keyword TEXT, id BLOB, value BLOB, birthday FLOAT)''')
-            cursor.execute('''CREATE INDEX idx1 ON dht(keyword);CREATE INDEX idx2 ON dht(birthday);''')
-            self.db.commit()
+            cursor.execute('''BEGIN''')
+            if legacy:
+                cursor.execute('''ALTER TABLE dht RENAME TO dht_legacy''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS dht(keyword BLOB, id BLOB, value BLOB, birthday FLOAT)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS dht_keyword ON dht(keyword)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS dht_birthday ON dht(birthday)''')
+            # one row per distinct keyword, kept in sync with the dht table by the triggers below
+            cursor.execute('''CREATE TABLE IF NOT EXISTS dhtkeywords(keyword BLOB PRIMARY KEY, count INTEGER)''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS dht_insert AFTER INSERT ON dht BEGIN
+                              INSERT OR IGNORE INTO dhtkeywords(keyword, count) VALUES (NEW.keyword, 0);
+                              UPDATE dhtkeywords SET count = count + 1 WHERE keyword = NEW.keyword;
+                              END''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS dht_delete AFTER DELETE ON dht BEGIN
+                              UPDATE dhtkeywords SET count = count - 1 WHERE keyword = OLD.keyword;
+                              DELETE FROM dhtkeywords WHERE keyword = OLD.keyword AND count <= 0;
+                              END''')
+            if legacy:
+                cursor.execute('''SELECT keyword, id, value, birthday FROM dht_legacy''')
+                rows = [(k.decode("hex"), i, v, b) for k, i, v, b in cursor.fetchall()]
+                cursor.executemany('''INSERT INTO dht(keyword, id, value, birthday) VALUES (?,?,?,?)''', rows)
+                cursor.execute('''DROP TABLE dht_legacy''')
+            cursor.execute('''COMMIT''')
         except Exception:
-            self.cull()
+            cursor.execute('''ROLLBACK''')
+            raise
+        finally:
+            self.db.isolation_level = ""
+        self.cull()
+        if self.quota is not None:
+            cursor.execute('''SELECT keyword, id, length(value), birthday FROM dht''')
+            for keyword, key, size, birthday in cursor:
+                self.quota.add(keyword, key, len(key) + size, birthday + self.ttl)
 
     def __setitem__(self, keyword, values):
+        birthday = time.time() - (self.ttl - values[2])
+        if self.quota is not None:
+            # a value we already have keeps its birthday, so the quota must keep its expiration
+            if self._stored(keyword, values[0], values[1]) or not self.quota.admit(keyword, values[0]):
+                return
+        self.value_cache.invalidate(keyword)
+        if self.flush_interval is None:
+            self._insert([(keyword, values[0], values[1], birthday)])
+        else:
+            pending = self._pending.setdefault(keyword, OrderedDict())
+            if (values[0], values[1]) not in pending:
+                pending[(values[0], values[1])] = birthday
+                self._pending_count += 1
+        # evict only once the value is stored, it may be the one to go
+        if self.quota is not None:
+            self.quota.add(keyword, values[0], len(values[0]) + len(values[1]), birthday + self.ttl)
+            for victim in self.quota.victims():
+                self._remove(*victim)
+        if self.flush_interval is None:
+            return
+        if self._pending_count >= self.flush_size:
+            self.flush()
+        elif self._flush_call is None and self._pending_count > 0:
+            self._flush_call = reactor.callLater(self.flush_interval, self.flush)
+
+    def _stored(self, keyword, key, value):
+        """
+        Return True if this keyword/key/value combination is already stored or buffered.
+        """
+        if (key, value) in self._pending.get(keyword, ()):
+            return True
         cursor = self.db.cursor()
-        cursor.execute('''SELECT id, value FROM dht WHERE keyword=? AND id=? AND value=?''',
-                       (keyword.encode("hex"), values[0], values[1]))
-        if cursor.fetchone() is None:
-            birthday = time.time() - (self.ttl - values[2])
-            cursor.execute('''INSERT OR IGNORE INTO dht(keyword, id, value, birthday)
-                          VALUES (?,?,?,?)''', (keyword.encode("hex"), values[0], values[1], birthday))
-            self.db.commit()
-        self.cull()
+        cursor.execute('''SELECT 1 FROM dht WHERE keyword=? AND id=? AND value=?''', (keyword, key, value))
+        return cursor.fetchone() is not None
+
+    def _insert(self, rows):
+        """
+        Insert a list of (keyword, key, value, birthday) tuples in one transaction,
+        skipping any keyword/key/value combination we already have.
+        """
+        cursor = self.db.cursor()
+        cursor.executemany('''INSERT INTO dht(keyword, id, value, birthday) SELECT ?,?,?,?
+                          WHERE NOT EXISTS (SELECT 1 FROM dht WHERE keyword=? AND id=? AND value=?)''',
+                           [(keyword, key, value, birthday, keyword, key, value)
+                            for keyword, key, value, birthday in rows])
+        self.db.commit()
+
+    def flush(self):
+        """
+        Write any buffered values to the database.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        rows = []
+        for keyword, pending in self._pending.items():
+            for (key, value), birthday in pending.items():
+                rows.append((keyword, key, value, birthday))
+        self._pending = {}
+        self._pending_count = 0
+        if len(rows) > 0:
+            self._insert(rows)
+
+    def _get_pending(self, keyword):
+        """
+        Return a list of unexpired (key, value, birthday) tuples buffered for this keyword.
+        """
+        if keyword not in self._pending:
+            return []
+        expiration = time.time() - self.ttl
+        return [(k, v, b) for (k, v), b in self._pending[keyword].items() if b >= expiration]
 
     def __getitem__(self, keyword):
-        self.cull()
         cursor = self.db.cursor()
-        cursor.execute('''SELECT id, value, birthday FROM dht WHERE keyword=?''', (keyword.encode("hex"),))
-        return cursor.fetchall()
+        cursor.execute('''SELECT id, value, birthday FROM dht WHERE keyword=? AND birthday>=?''',
+                       (keyword, time.time() - self.ttl))
+        ret = cursor.fetchall()
+        pending = self._get_pending(keyword)
+        if len(pending) > 0:
+            stored = set((k, v) for k, v, _ in ret)
+            ret.extend(p for p in pending if p[:2] not in stored)
+        return ret
 
     def get(self, keyword, default=None):
-        self.cull()
-        if len(self[keyword]) > 0:
-            ret = []
-            for k, v, birthday in self[keyword]:
-                value = Value()
-                value.valueKey = k
-                value.serializedData = v
-                value.ttl = int(round(self.ttl - (time.time() - birthday)))
-                ret.append(value.SerializeToString())
-            return ret
-        return default
+        if keyword not in self.value_cache:
+            self.value_cache.put(keyword, [(k, v, birthday + self.ttl) for k, v, birthday in self[keyword]])
+        if self.quota is not None:
+            for k in self.value_cache.keys(keyword):
+                self.quota.touch(keyword, k)
+        return self.value_cache.get(keyword) or default
 
     def getSpecific(self, keyword, key):
+        if self.quota is not None:
+            self.quota.touch(keyword, key)
+        for k, v, _ in self._get_pending(keyword):
+            if k == key:
+                return v
         try:
             cursor = self.db.cursor()
-            cursor.execute('''SELECT value FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key))
+            cursor.execute('''SELECT value FROM dht WHERE keyword=? AND id=? AND birthday>=?''',
+                           (keyword, key, time.time() - self.ttl))
             return cursor.fetchone()[0]
         except Exception:
             return None
 
     def cull(self):
         expiration = time.time() - self.ttl
+        for keyword, pending in self._pending.items():
+            for k, birthday in pending.items():
+                if birthday < expiration:
+                    del pending[k]
+                    self._pending_count -= 1
+                    self.value_cache.invalidate(keyword)
+                    if self.quota is not None:
+                        self.quota.remove(keyword, k[0])
+            if len(pending) == 0:
+                del self._pending[keyword]
         cursor = self.db.cursor()
+        cursor.execute('''SELECT keyword, id FROM dht WHERE birthday < ?''', (expiration,))
+        for keyword, key in cursor.fetchall():
+            self.value_cache.invalidate(keyword)
+            if self.quota is not None:
+                self.quota.remove(keyword, key)
         cursor.execute('''DELETE FROM dht WHERE birthday < ?''', (expiration,))
         self.db.commit()
 
     def delete(self, keyword, key):
+        self._remove(keyword, key)
+        if self.quota is not None:
+            self.quota.remove(keyword, key)
+
+    def _remove(self, keyword, key):
+        self.value_cache.invalidate(keyword)
+        if keyword in self._pending:
+            pending = self._pending[keyword]
+            for k in pending.keys():
+                if k[0] == key:
+                    del pending[k]
+                    self._pending_count -= 1
+            if len(pending) == 0:
+                del self._pending[keyword]
         try:
             cursor = self.db.cursor()
-            cursor.execute('''DELETE FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key))
+            cursor.execute('''DELETE FROM dht WHERE keyword=? AND id=?''', (keyword, key))
             self.db.commit()
         except Exception:
             pass
-        self.cull()
 
     def iterkeys(self):
-        self.cull()
-        try:
-            cursor = self.db.cursor()
-            cursor.execute('''SELECT keyword FROM dht''')
-            keywords = cursor.fetchall()
-            keyword_list = []
-            for k in keywords:
-                if k[0].decode("hex") not in keyword_list:
-                    keyword_list.append(k[0].decode("hex"))
-            return keyword_list.__iter__()
-        except Exception:
-            return None
+        """
+        Return an iterator over each stored keyword, read from the `dhtkeywords`
+        table. The keywords are read up front so a `flush()` or `cull()` while
+        iterating doesn't affect it. A keyword whose values have all expired may
+        still be returned until the next `cull()`.
+        """
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT keyword FROM dhtkeywords''')
+        keywords = [row[0] for row in cursor.fetchall()]
+        stored = set(keywords)
+        for keyword in self._pending.keys():
+            if keyword not in stored and len(self._get_pending(keyword)) > 0:
+                keywords.append(keyword)
+        return iter(keywords)
 
     def iteritems(self, keyword):
-        self.cull()
         try:
-            cursor = self.db.cursor()
-            cursor.execute('''SELECT id, value FROM dht WHERE keyword=?''', (keyword.encode("hex"),))
-            return cursor.fetchall().__iter__()
+            return [(k, v) for k, v, _ in self[keyword]].__iter__()
         except Exception:
             return None
 
     def get_ttl(self, keyword, key):
+        for k, _, birthday in self._get_pending(keyword):
+            if k == key:
+                return self.ttl - (time.time() - birthday)
         cursor = self.db.cursor()
-        cursor.execute('''SELECT birthday FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key,))
+        cursor.execute('''SELECT birthday FROM dht WHERE keyword=? AND id=?''', (keyword, key,))
         return self.ttl - (time.time() - cursor.fetchall()[0][0])
 
 
+class LogStorage(object):
+    """
+    Storage backed by an append-only log file. Every store and delete is appended
+    as a record and an in-memory index points at where each live value sits in the
+    file. Values are read back through a read-only mmap of the file.
+
+    On startup the file is scanned once to rebuild the index. A record which fails
+    its checksum or is cut short (for example by a crash mid-write) ends the scan
+    and the file is truncated there. `cull()` drops expired values from the index
+    and rewrites the file without dead records once they make up more than
+    `compact_ratio` of it.
+    """
+    implements(IStorage)
+
+    # crc32, record type, keyword length, key length, value length, expiration
+    HEADER = struct.Struct(">IcBBId")
+    PUT = "P"
+    DELETE = "D"
+
+    def __init__(self, filename, ttl=604800, quota=None, compact_ratio=0.5, compact_min_size=1048576):
+        """
+        Args:
+            filename: the path to the log file. It is created if it doesn't exist.
+            ttl: the max age of a value. By default a week.
+            quota: an optional `StorageQuota` limiting how much we will store.
+            compact_ratio: compact once this fraction of the file is dead records.
+            compact_min_size: don't bother compacting files smaller than this many bytes.
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.quota = quota
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.value_cache = ValueCache()
+        self.log = Logger(system=self)
+        self._index = {}
+        self._expirations = []
+        self._live_bytes = 0
+        self._file = None
+        self._map = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.filename, "a+b")
+        self._index = {}
+        self._expirations = []
+        self._live_bytes = 0
+        self._remap()
+        offset = self._scan()
+        if offset < self._size():
+            self.log.warning("discarding %s bytes of incomplete records from %s" %
+                             (self._size() - offset, self.filename))
+            self._file.truncate(offset)
+            self._remap()
+        if self.quota is not None:
+            for keyword, keys in self._index.items():
+                for key, (_, length, expiration) in keys.items():
+                    self.quota.add(keyword, key, len(key) + length, expiration)
+
+    def _size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        size = self._size()
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size > 0 else None
+
+    def _scan(self):
+        """
+        Rebuild the index from the log. Returns the offset of the end of the last good record.
+        """
+        offset = 0
+        size = 0 if self._map is None else len(self._map)
+        now = time.time()
+        while offset + self.HEADER.size <= size:
+            crc, rtype, kw_len, key_len, value_len, expiration = self.HEADER.unpack_from(self._map, offset)
+            end = offset + self.HEADER.size + kw_len + key_len + value_len
+            if end > size or rtype not in (self.PUT, self.DELETE) or \
+                    zlib.crc32(self._map[offset + 4:end]) & 0xffffffff != crc:
+                break
+            start = offset + self.HEADER.size
+            keyword = self._map[start:start + kw_len]
+            key = self._map[start + kw_len:start + kw_len + key_len]
+            if rtype == self.PUT and expiration > now:
+                self._index_value(keyword, key, start + kw_len + key_len, value_len, expiration)
+            else:
+                self._unindex_value(keyword, key)
+            offset = end
+        return offset
+
+    def _index_value(self, keyword, key, offset, length, expiration):
+        self._unindex_value(keyword, key)
+        self._index.setdefault(keyword, OrderedDict())[key] = (offset, length, expiration)
+        heapq.heappush(self._expirations, (expiration, keyword, key))
+        self._live_bytes += self.HEADER.size + len(keyword) + len(key) + length
+
+    def _unindex_value(self, keyword, key):
+        if keyword in self._index and key in self._index[keyword]:
+            length = self._index[keyword].pop(key)[1]
+            self._live_bytes -= self.HEADER.size + len(keyword) + len(key) + length
+            if len(self._index[keyword]) == 0:
+                del self._index[keyword]
+
+    def _append(self, rtype, keyword, key, value, expiration):
+        """
+        Append a record and return the file offset its value starts at.
+        """
+        body = self.HEADER.pack(0, rtype, len(keyword), len(key), len(value), expiration)[4:] + \
+            keyword + key + value
+        offset = self._size()
+        self._file.write(struct.pack(">I", zlib.crc32(body) & 0xffffffff) + body)
+        self._file.flush()
+        return offset + self.HEADER.size + len(keyword) + len(key)
+
+    def _read(self, offset, length):
+        if self._map is None or offset + length > len(self._map):
+            self._remap()
+        return self._map[offset:offset + length]
+
+    def __setitem__(self, keyword, values):
+        key, value, ttl = values
+        self.cull()
+        if keyword in self._index and key in self._index[keyword]:
+            return
+        if self.quota is not None and not self.quota.admit(keyword, key):
+            return
+        expiration = time.time() + ttl
+        offset = self._append(self.PUT, keyword, key, value, expiration)
+        self._index_value(keyword, key, offset, len(value), expiration)
+        self.value_cache.invalidate(keyword)
+        if self.quota is not None:
+            self.quota.add(keyword, key, len(key) + len(value), expiration)
+            for victim in self.quota.victims():
+                self._remove(*victim)
+
+    def __getitem__(self, keyword):
+        return list(self.iteritems(keyword))
+
+    def get(self, keyword, default=None):
+        self.cull()
+        if keyword not in self._index:
+            return default
+        if keyword not in self.value_cache:
+            self.value_cache.put(keyword, [(k, self._read(offset, length), expiration)
+                                           for k, (offset, length, expiration) in self._index[keyword].items()])
+        if self.quota is not None:
+            for k in self.value_cache.keys(keyword):
+                self.quota.touch(keyword, k)
+        return self.value_cache.get(keyword) or default
+
+    def getSpecific(self, keyword, key):
+        self.cull()
+        if keyword in self._index and key in self._index[keyword]:
+            if self.quota is not None:
+                self.quota.touch(keyword, key)
+            offset, length, _ = self._index[keyword][key]
+            return self._read(offset, length)
+
+    def cull(self):
+        now = time.time()
+        while len(self._expirations) > 0 and self._expirations[0][0] < now:
+            expiration, keyword, key = heapq.heappop(self._expirations)
+            if keyword in self._index and key in self._index[keyword] \
+                    and self._index[keyword][key][2] == expiration:
+                self._unindex_value(keyword, key)
+                self.value_cache.invalidate(keyword)
+                if self.quota is not None:
+                    self.quota.remove(keyword, key)
+        size = self._size()
+        if size >= self.compact_min_size and size - self._live_bytes > size * self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the log with only the live values and swap it in place of the old one.
+        """
+        tmp = self.filename + ".compact"
+        index = {}
+        with open(tmp, "wb") as f:
+            offset = 0
+            for keyword, keys in self._index.items():
+                index[keyword] = OrderedDict()
+                for key, (value_offset, length, expiration) in keys.items():
+                    body = self.HEADER.pack(0, self.PUT, len(keyword), len(key), length, expiration)[4:] + \
+                        keyword + key + self._read(value_offset, length)
+                    f.write(struct.pack(">I", zlib.crc32(body) & 0xffffffff) + body)
+                    index[keyword][key] = (offset + self.HEADER.size + len(keyword) + len(key), length, expiration)
+                    offset += 4 + len(body)
+            f.flush()
+            os.fsync(f.fileno())
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        os.rename(tmp, self.filename)
+        self._file = open(self.filename, "a+b")
+        self._index = index
+        self._live_bytes = offset
+        self._remap()
+
+    def delete(self, keyword, key):
+        self._remove(keyword, key)
+        if self.quota is not None:
+            self.quota.remove(keyword, key)
+
+    def _remove(self, keyword, key):
+        self.value_cache.invalidate(keyword)
+        if keyword in self._index and key in self._index[keyword]:
+            self._append(self.DELETE, keyword, key, "", 0)
+            self._unindex_value(keyword, key)
+
+    def iterkeys(self):
+        self.cull()
+        return iter(self._index.keys())
+
+    def iteritems(self, keyword):
+        self.cull()
+        keys = self._index.get(keyword, {})
+        return iter([(k, self._read(offset, length)) for k, (offset, length, _) in keys.items()])
+
+    def get_ttl(self, keyword, key):
+        if keyword in self._index and key in self._index[keyword]:
+            return self._index[keyword][key][2] - time.time()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class ValueCache(object):
+    """
+    The serialized `Value` protobufs returned by `get`, kept for the most
+    recently read keywords so popular keywords are not re-encoded on every
+    FIND_VALUE. The ttl is the last field of a `Value` so it is left off the
+    cached bytes and appended at read time. The storage must invalidate a
+    keyword whenever its values change, expire or are evicted.
+    """
+
+    def __init__(self, maxsize=1000):
+        """
+        Args:
+            maxsize: the most keywords to keep values cached for.
+        """
+        self._cache = LRUCache(maxsize)
+
+    def __contains__(self, keyword):
+        return keyword in self._cache
+
+    def put(self, keyword, values):
+        """
+        Cache a list of (key, value, expiration) tuples for the keyword.
+        """
+        entries = []
+        for k, v, expiration in values:
+            value = Value()
+            value.valueKey = k
+            value.serializedData = v
+            entries.append((k, value.SerializePartialToString(), expiration))
+        self._cache.set(keyword, entries)
+
+    def keys(self, keyword):
+        return [k for k, _, _ in self._cache.get(keyword, ())]
+
+    def get(self, keyword):
+        """
+        Return a list of serialized `Value` objects for the keyword with their
+        current ttl filled in.
+        """
+        now = time.time()
+        ret = []
+        for _, partial, expiration in self._cache.get(keyword, ()):
+            ttl = int(round(expiration - now))
+            if ttl >= 0:
+                ret.append(partial + _TTL_TAG + _encode_varint(ttl))
+        return ret
+
+    def invalidate(self, keyword):
+        self._cache.invalidate(keyword)
+
+
+# field 4 (ttl) with wire type 0 (varint)
+_TTL_TAG = chr(4 << 3)
+
+
+def _encode_varint(value):
+    ret = ""
+    while value > 0x7f:
+        ret += chr((value & 0x7f) | 0x80)
+        value >>= 7
+    return ret + chr(value)
+
+
+class StorageQuota(object):
+    """
+    Keeps count of what a storage holds and decides what to evict once it
+    goes over its limits. Any limit left as `None` is unbounded.
+
+    The storage calls `admit` before storing a new value, `add` once it has,
+    `touch` when a value is read and `remove` when one is deleted or expires.
+    It should then delete everything yielded by `victims`.
+    """
+
+    def __init__(self, max_bytes=None, max_entries=None, max_per_keyword=None, policy=None):
+        """
+        Args:
+            max_bytes: the max combined size of all stored keys and values.
+            max_entries: the max number of stored values.
+            max_per_keyword: the max number of values stored under a single keyword.
+                New values for a keyword which is full are rejected.
+            policy: an `EvictionPolicy`. Defaults to `SoonestExpiring`.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_per_keyword = max_per_keyword
+        self.policy = policy or SoonestExpiring()
+        self.bytes = 0
+        self.evictions = 0
+        self.rejections = 0
+        self._sizes = {}
+        self._keywords = {}
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def admit(self, keyword, key):
+        """
+        Return False if a new value for this keyword should not be stored.
+        """
+        if (keyword, key) in self._sizes or self.max_per_keyword is None:
+            return True
+        if len(self._keywords.get(keyword, ())) < self.max_per_keyword:
+            return True
+        self.rejections += 1
+        return False
+
+    def add(self, keyword, key, size, expiration):
+        self.remove(keyword, key)
+        self._sizes[(keyword, key)] = size
+        self._keywords.setdefault(keyword, set()).add(key)
+        self.bytes += size
+        self.policy.add(keyword, key, expiration)
+
+    def touch(self, keyword, key):
+        if (keyword, key) in self._sizes:
+            self.policy.touch(keyword, key)
+
+    def remove(self, keyword, key):
+        if (keyword, key) not in self._sizes:
+            return
+        self.bytes -= self._sizes.pop((keyword, key))
+        self._keywords[keyword].discard(key)
+        if len(self._keywords[keyword]) == 0:
+            del self._keywords[keyword]
+        self.policy.remove(keyword, key)
+
+    def retain(self, keyword, keys):
+        """
+        Forget any values for this keyword which are not in `keys`.
+        """
+        for key in list(self._keywords.get(keyword, ())):
+            if key not in keys:
+                self.remove(keyword, key)
+
+    def over(self):
+        return (self.max_bytes is not None and self.bytes > self.max_bytes) or \
+               (self.max_entries is not None and len(self._sizes) > self.max_entries)
+
+    def victims(self):
+        """
+        Yield (keyword, key) tuples which must be deleted to get back within the limits.
+        """
+        while self.over():
+            victim = self.policy.pop()
+            if victim is None:
+                return
+            self.remove(*victim)
+            self.evictions += 1
+            yield victim
+
+    def stats(self):
+        return {"entries": len(self._sizes),
+                "bytes": self.bytes,
+                "keywords": len(self._keywords),
+                "evictions": self.evictions,
+                "rejections": self.rejections}
+
+
+class EvictionPolicy(object):
+    """
+    Picks which value a `StorageQuota` evicts next.
+    """
+
+    def add(self, keyword, key, expiration):
+        """
+        Start tracking a newly stored value.
+        """
+
+    def touch(self, keyword, key):
+        """
+        Note that a value was read.
+        """
+
+    def remove(self, keyword, key):
+        """
+        Stop tracking a value which was deleted or expired.
+        """
+
+    def pop(self):
+        """
+        Forget and return the (keyword, key) to evict next or None if empty.
+        """
+
+
+class SoonestExpiring(EvictionPolicy):
+    """
+    Evict the value closest to expiring anyway.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._expirations = {}
+
+    def add(self, keyword, key, expiration):
+        self._expirations[(keyword, key)] = expiration
+        heapq.heappush(self._heap, (expiration, keyword, key))
+        # stale entries are skipped by pop, but don't let them pile up
+        if len(self._heap) > 2 * len(self._expirations) + 16:
+            self._heap = [(e, k, v) for (k, v), e in self._expirations.iteritems()]
+            heapq.heapify(self._heap)
+
+    def remove(self, keyword, key):
+        self._expirations.pop((keyword, key), None)
+
+    def pop(self):
+        while len(self._heap) > 0:
+            expiration, keyword, key = heapq.heappop(self._heap)
+            if self._expirations.get((keyword, key)) == expiration:
+                del self._expirations[(keyword, key)]
+                return keyword, key
+        return None
+
+
+class LeastRecentlyUsed(EvictionPolicy):
+    """
+    Evict the value which was stored or read the longest time ago.
+    """
+
+    def __init__(self):
+        self._order = OrderedDict()
+
+    def add(self, keyword, key, expiration):
+        self.touch(keyword, key)
+
+    def touch(self, keyword, key):
+        self._order.pop((keyword, key), None)
+        self._order[(keyword, key)] = None
+
+    def remove(self, keyword, key):
+        self._order.pop((keyword, key), None)
+
+    def pop(self):
+        if len(self._order) == 0:
+            return None
+        return self._order.popitem(last=False)[0]
+
+
+class FarthestFirst(EvictionPolicy):
+    """
+    Evict values for the keyword farthest from our node id first. Those are the
+    values other nodes are least likely to look for on us. Within a keyword the
+    oldest value goes first.
+    """
+
+    def __init__(self, node_id):
+        self.long_id = long(node_id.encode('hex'), 16)
+        self._heap = []
+        self._keywords = {}
+
+    def add(self, keyword, key, expiration):
+        if keyword not in self._keywords:
+            self._keywords[keyword] = OrderedDict()
+            heapq.heappush(self._heap, (-self._distance(keyword), keyword))
+            # keywords which emptied out stay in the heap until pop reaches them,
+            # rebuild it before they pile up
+            if len(self._heap) > 2 * len(self._keywords) + 16:
+                self._heap = [(-self._distance(k), k) for k in self._keywords]
+                heapq.heapify(self._heap)
+        self._keywords[keyword][key] = None
+
+    def _distance(self, keyword):
+        return self.long_id ^ long(keyword.encode('hex'), 16)
+
+    def remove(self, keyword, key):
+        if keyword in self._keywords:
+            self._keywords[keyword].pop(key, None)
+            if len(self._keywords[keyword]) == 0:
+                del self._keywords[keyword]
+
+    def pop(self):
+        while len(self._heap) > 0:
+            keyword = self._heap[0][1]
+            if keyword in self._keywords:
+                keys = self._keywords[keyword]
+                key = keys.popitem(last=False)[0]
+                if len(keys) == 0:
+                    del self._keywords[keyword]
+                    heapq.heappop(self._heap)
+                return keyword, key
+            heapq.heappop(self._heap)
+        return None
+
+
 class TTLDict(MutableMapping):
     """
     Dictionary with TTL
     Extra args and kwargs are passed to initial .update() call
+
+    Expiration times are also kept in a heap so that expired keys can be
+    found without scanning the whole dictionary.
     """
 
     def __init__(self, default_ttl, *args, **kwargs):
         self._default_ttl = default_ttl
         self._values = {}
+        self._expirations = []
         self._lock = RLock()
         self.update(*args, **kwargs)
 
@@ -255,10 +976,7 @@ class TTLDict(MutableMapping):
         """ Set TTL for the given key """
         if now is None:
             now = time.time()
-        with self._lock:
-            # pylint: disable=unused-variable
-            _expire, value = self._values[key]
-            self._values[key] = (now + ttl, value)
+        self.expire_at(key, now + ttl)
 
     def get_ttl(self, key, now=None):
         """ Return remaining TTL for a key """
@@ -275,6 +993,11 @@ class TTLDict(MutableMapping):
             # pylint: disable=unused-variable
             _expire, value = self._values[key]
             self._values[key] = (timestamp, value)
+            heapq.heappush(self._expirations, (timestamp, key))
+            # rebuild the heap if it is mostly made up of superseded entries
+            if len(self._expirations) > 2 * len(self._values) + 16:
+                self._expirations = [(e, k) for k, (e, _v) in self._values.items() if e is not None]
+                heapq.heapify(self._expirations)
 
     def is_expired(self, key, now=None, remove=False):
         """ Check if key has expired """
@@ -292,23 +1015,20 @@ class TTLDict(MutableMapping):
 
     def __len__(self):
         with self._lock:
-            for key in self._values.keys():
-                self.is_expired(key, remove=True)
+            self.cull()
             return len(self._values)
 
     def __iter__(self):
         with self._lock:
+            self.cull()
             for key in self._values.keys():
-                if not self.is_expired(key, remove=True):
-                    yield key
+                yield key
 
     def __setitem__(self, key, value):
         with self._lock:
-            if self._default_ttl is None:
-                expire = None
-            else:
-                expire = time.time() + self._default_ttl
-            self._values[key] = (expire, value)
+            self._values[key] = (None, value)
+            if self._default_ttl is not None:
+                self.expire_at(key, time.time() + self._default_ttl)
 
     def __delitem__(self, key):
         with self._lock:
@@ -319,7 +1039,11 @@ class TTLDict(MutableMapping):
             self.is_expired(key, remove=True)
             return self._values[key][1]
 
-    def cull(self):
+    def cull(self, now=None):
+        if now is None:
+            now = time.time()
         with self._lock:
-            for key in self._values.keys():
-                self.is_expired(key, remove=True)
+            while len(self._expirations) > 0 and self._expirations[0][0] < now:
+                expire, key = heapq.heappop(self._expirations)
+                if key in self._values and self._values[key][0] == expire:
+                    del self._values[key]
@@ -7,13 +7,13 @@ import os
 from binascii import unhexlify
 from db.datastore import Database
 from dht.crawling import RPCFindResponse, NodeSpiderCrawl, ValueSpiderCrawl
-from dht.node import Node, NodeHeap
+from dht.node import Node
 from dht.protocol import KademliaProtocol
 from dht.storage import ForgetfulStorage
 from dht.utils import digest
 from net.wireprotocol import OpenBazaarProtocol
 from protos.objects import Value, FULL_CONE
-from twisted.internet import udp, address, task
+from twisted.internet import udp, address, task, defer
 from twisted.trial import unittest
 from txrudp import packet, connection, rudp, constants
 
@@ -85,58 +85,7 @@ class ValueSpiderCrawlTest(unittest.TestCase):
 
         self.clock.advance(100 * constants.PACKET_TIMEOUT)
         connection.REACTOR.runUntilCurrent()
-        self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 7)
-
-    def test_nodesFound(self):
-        self._connecting_to_connected()
-        self.wire_protocol[self.addr1] = self.con
-        self.wire_protocol[self.addr2] = self.con
-        self.wire_protocol[self.addr3] = self.con
-
-        self.protocol.router.addContact(self.node1)
-        self.protocol.router.addContact(self.node2)
-        self.protocol.router.addContact(self.node3)
-
-        # test response with uncontacted nodes
-        node = Node(digest("s"))
-        nearest = self.protocol.router.findNeighbors(node)
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, 20, 3)
-        response = (True, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
-                           self.node3.getProto().SerializeToString()))
-        responses = {self.node1.id: response}
-        spider._nodesFound(responses)
-        self.clock.advance(100 * constants.PACKET_TIMEOUT)
-        connection.REACTOR.runUntilCurrent()
-        self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 7)
-
-        # test all been contacted
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, 20, 3)
-        for peer in spider.nearest.getUncontacted():
-            spider.nearest.markContacted(peer)
-        response = (True, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
-                           self.node3.getProto().SerializeToString()))
-        responses = {self.node2.id: response}
-        resp = spider._nodesFound(responses)
-        self.assertTrue(resp is None)
-
-        # test didn't happen
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, 20, 3)
-        response = (False, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
-                            self.node3.getProto().SerializeToString()))
-        responses = {self.node1.id: response}
-        spider._nodesFound(responses)
-        self.assertTrue(len(spider.nearest) == 2)
-
-        # test got value
-        val = Value()
-        val.valueKey = digest("contractID")
-        val.serializedData = self.protocol.sourceNode.getProto().SerializeToString()
-        val.ttl = 10
-        response = (True, ("value", val.SerializeToString()))
-        responses = {self.node3.id: response}
-        spider.nearestWithoutValue = NodeHeap(node, 1)
-        value = spider._nodesFound(responses)
-        self.assertEqual(value[0], val.SerializeToString())
+        self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 4)
 
     def test_handleFoundValues(self):
         self._connecting_to_connected()
@@ -265,52 +214,7 @@ class NodeSpiderCrawlTest(unittest.TestCase):
 
         self.clock.advance(100 * constants.PACKET_TIMEOUT)
         connection.REACTOR.runUntilCurrent()
-        self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 7)
-
-    def test_nodesFound(self):
-        self._connecting_to_connected()
-        self.wire_protocol[self.addr1] = self.con
-        self.wire_protocol[self.addr2] = self.con
-        self.wire_protocol[self.addr3] = self.con
-
-        self.protocol.router.addContact(self.node1)
-        self.protocol.router.addContact(self.node2)
-        self.protocol.router.addContact(self.node3)
-
-        node = Node(digest("s"))
-        nearest = self.protocol.router.findNeighbors(node)
-        spider = NodeSpiderCrawl(self.protocol, node, nearest, 20, 3)
-        response = (True, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
-                           self.node3.getProto().SerializeToString()))
-        responses = {self.node1.id: response}
-        spider._nodesFound(responses)
-
-        self.clock.advance(100 * constants.PACKET_TIMEOUT)
-        connection.REACTOR.runUntilCurrent()
-        self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 7)
-
-        response = (True, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
-                           self.node3.getProto().SerializeToString()))
-        responses = {self.node1.id: response}
-        nodes = spider._nodesFound(responses)
-        node_protos = []
-        for n in nodes:
-            node_protos.append(n.getProto())
-
-        self.assertTrue(self.node1.getProto() in node_protos)
-        self.assertTrue(self.node2.getProto() in node_protos)
-        self.assertTrue(self.node3.getProto() in node_protos)
-
-        response = (False, (self.node1.getProto().SerializeToString(), self.node2.getProto().SerializeToString(),
-                            self.node3.getProto().SerializeToString()))
-        responses = {self.node1.id: response}
-        nodes = spider._nodesFound(responses)
-        node_protos = []
-        for n in nodes:
-            node_protos.append(n.getProto())
-
-        self.assertTrue(self.node2.getProto() in node_protos)
-        self.assertTrue(self.node3.getProto() in node_protos)
+        self.assertEqual(len(self.proto_mock.send_datagram.call_args_list), 4)
 
     def _connecting_to_connected(self):
         remote_synack_packet = packet.Packet.from_data(
@@ -371,3 +275,154 @@ class RPCFindResponseTest(unittest.TestCase):
         self.assertEqual(nodes[0].getProto(), node1.getProto())
         self.assertEqual(nodes[1].getProto(), node2.getProto())
         self.assertEqual(nodes[2].getProto(), node3.getProto())
+
+
+class SpiderCrawlLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        connection.REACTOR.callLater = self.clock.callLater
+        self.requests = {}
+        self.stored = []
+        self.nodes = [Node(digest(i), "127.0.0.1", i, digest("key"), None, FULL_CONE, False) for i in range(5)]
+
+    def callFindNode(self, nodeToAsk, nodeToFind):
+        d = defer.Deferred()
+        self.requests[nodeToAsk.id] = d
+        return d
+
+    def respond(self, node, nodes):
+        self.requests.pop(node.id).callback((True, [n.getProto().SerializeToString() for n in nodes]))
+
+    def test_advances_on_each_response(self):
+        spider = NodeSpiderCrawl(self, Node(digest("target")), self.nodes[:3], 20, 2)
+        d = spider.find()
+        self.assertEqual(len(self.requests), 2)
+        first = [n for n in self.nodes[:3] if n.id in self.requests][0]
+        self.respond(first, self.nodes[3:])
+        # a new request goes out straight away without waiting on the other one
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(spider.queries, 3)
+
+        # a peer that doesn't answer in time gives up its slot
+        self.clock.advance(spider.softTimeout)
+        self.assertEqual(spider.queries, 5)
+        for node in self.nodes:
+            if node.id in self.requests:
+                self.requests.pop(node.id).callback((False, None))
+        self.assertEqual(self.requests, {})
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(spider.queries, 5)
+        self.assertEqual(spider.hops, 2)
+        self.assertTrue(spider.elapsed is not None)
+
+    def callFindValue(self, nodeToAsk, nodeToFind):
+        return self.callFindNode(nodeToAsk, nodeToFind)
+
+    def callStore(self, nodeToAsk, keyword, key, value, ttl):
+        self.stored.append((nodeToAsk, keyword, key, value, ttl))
+        return defer.succeed((True, True))
+
+    def test_streaming_values(self):
+        values = []
+        for i in range(3):
+            val = Value()
+            val.valueKey = digest("contract%s" % i)
+            val.serializedData = self.nodes[0].getProto().SerializeToString()
+            val.ttl = 10
+            values.append(val.SerializeToString())
+        found = []
+        spider = ValueSpiderCrawl(self, Node(digest("target")), self.nodes, 20, 2,
+                                  onValue=found.append, maxValues=3)
+        d = spider.find()
+        peers = self.requests.keys()
+        self.requests.pop(peers[0]).callback((True, ["value", values[0], values[1]]))
+        self.assertEqual(found, values[:2])
+        # the lookup carries on to gather values held elsewhere
+        self.assertEqual(len(self.requests), 2)
+        self.requests.pop(peers[1]).callback((True, ["value", values[1], values[2]]))
+        self.assertEqual(found, values)
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(sorted(result[0]), sorted(values))
+
+    def test_slow_and_failed_peers(self):
+        target = Node(digest("target"))
+        a, b, c = sorted(self.nodes[:3], key=target.distanceTo)
+        spider = NodeSpiderCrawl(self, target, self.nodes[:3], 20, 2)
+        d = spider.find()
+        self.assertEqual(sorted(self.requests.keys()), sorted([a.id, b.id]))
+        self.clock.advance(spider.softTimeout)
+        self.assertEqual(sorted(spider.slow.keys()), sorted([a.id, b.id]))
+        # peers we're still waiting on don't rejoin the lookup when another peer mentions them
+        self.respond(c, [a, b])
+        self.assertEqual(list(spider.nearest), [c])
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(result, [])
+
+        # a late answer puts a peer back, a failure drops it for good
+        self.respond(a, [b])
+        self.requests.pop(b.id).callback((False, None))
+        self.assertEqual(spider.slow, {})
+        self.assertEqual(result, [[a, c]])
+        self.assertEqual(spider.responded, set([a.id, c.id]))
+
+    def test_slow_peers_dont_hold_up_k_results(self):
+        target = Node(digest("target"))
+        spider = NodeSpiderCrawl(self, target, self.nodes[:2], 1, 2)
+        d = spider.find()
+        self.clock.advance(spider.softTimeout)
+        self.respond(self.nodes[1], [])
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(result, [[self.nodes[1]]])
+
+    def test_value_found(self):
+        val = Value()
+        val.valueKey = digest("contractID")
+        val.serializedData = self.nodes[0].getProto().SerializeToString()
+        val.ttl = 10
+        target = Node(digest("target"))
+        spider = ValueSpiderCrawl(self, target, self.nodes[:2], 20, 1)
+        d = spider.find()
+        first = self.requests.keys()[0]
+        self.requests.pop(first).callback((True, []))
+        second = self.requests.keys()[0]
+        self.requests.pop(second).callback((True, ["value", val.SerializeToString()]))
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(result, [[val.SerializeToString()]])
+        # the peer that didn't have the value is asked to store it
+        self.assertEqual([s[0].id for s in self.stored], [first])
+
+        # not found
+        spider = ValueSpiderCrawl(self, target, self.nodes[:2], 20, 2)
+        d = spider.find()
+        for peerid in self.requests.keys():
+            self.requests.pop(peerid).callback((True, []))
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(result, [None])
+
+    def test_stops_querying_once_value_found(self):
+        val = Value()
+        val.valueKey = digest("contractID")
+        val.serializedData = self.nodes[0].getProto().SerializeToString()
+        val.ttl = 10
+        spider = ValueSpiderCrawl(self, Node(digest("target")), self.nodes, 20, 3)
+        d = spider.find()
+        self.assertEqual(spider.queries, 3)
+        peers = self.requests.keys()
+        self.requests.pop(peers[0]).callback((True, ["value", val.SerializeToString()]))
+        # the other two requests are left to finish but nobody new is asked
+        self.assertEqual(spider.queries, 3)
+        self.requests.pop(peers[1]).callback((True, []))
+        self.assertEqual(spider.queries, 3)
+        result = []
+        d.addCallback(result.append)
+        self.assertEqual(result, [])
+        self.requests.pop(peers[2]).callback((True, []))
+        self.assertEqual(spider.queries, 3)
+        self.assertEqual(result, [[val.SerializeToString()]])
@@ -51,6 +51,35 @@ class NodeTest(unittest.TestCase):
         n2 = Node(rid, "127.0.0.1", 1234, digest("pubkey"), ("127.0.0.1", 1234), objects.FULL_CONE, True)
         self.assertEqual(n1, n2.getProto())
 
+    def test_serialized_proto(self):
+        n = Node(digest("guid"), "127.0.0.1", 1234, digest("pubkey"), None, objects.FULL_CONE, False)
+        serialized = n.getSerializedProto()
+        self.assertEqual(serialized, n.getProto().SerializeToString())
+        self.assertTrue(n.getSerializedProto() is serialized)
+        n.relay_node = ("127.0.0.1", 4321)
+        n.vendor = True
+        self.assertEqual(n.getSerializedProto(), n.getProto().SerializeToString())
+        self.assertNotEqual(n.getSerializedProto(), serialized)
+        self.assertRaises(AttributeError, setattr, n, "foo", 1)
+        self.assertRaises(AttributeError, setattr, n, "ip", "127.0.0.2")
+        self.assertRaises(AttributeError, setattr, n, "port", 4321)
+        self.assertRaises(AttributeError, setattr, n, "pubkey", digest("other"))
+
+        # nodes from fromProto are shared between everyone who parsed the same proto
+        shared = Node.fromProto(n.getProto())
+        self.assertTrue(Node.fromProto(n.getProto()) is shared)
+        self.assertRaises(AttributeError, setattr, shared, "vendor", False)
+        self.assertEqual(shared.getSerializedProto(), n.getSerializedProto())
+
+    def test_fromProto(self):
+        n = Node(digest("guid"), "127.0.0.1", 1234, digest("pubkey"), ("127.0.0.1", 4321), objects.FULL_CONE, True)
+        n1 = Node.fromProto(n.getProto())
+        self.assertEqual(n1.getProto(), n.getProto())
+        self.assertTrue(Node.fromProto(n.getProto()) is n1)
+        n2 = Node.fromProto(n.getProto(), "127.0.0.2", 1234)
+        self.assertFalse(n2 is n1)
+        self.assertEqual((n2.ip, n2.port, n2.relay_node), ("127.0.0.2", 1234, ("127.0.0.1", 4321)))
+
     def test_tuple(self):
         n = Node('127.0.0.1', 0, 'testkey')
         i = n.__iter__()
@@ -96,3 +125,29 @@ class NodeHeapTest(unittest.TestCase):
         nh = NodeHeap(n, 5)
         val = nh.getNodeById('')
         self.assertIsNone(val)
+
+    def test_popleft(self):
+        heap = NodeHeap(mknode(intid=0), 3)
+        nodes = [mknode(intid=x) for x in range(6)]
+        heap.push(nodes)
+        heap.remove([nodes[0].id, nodes[2].id])
+        self.assertEqual(heap.popleft(), nodes[1])
+        self.assertEqual(heap.getIDs(), [nodes[3].id, nodes[4].id, nodes[5].id])
+        heap.push(nodes[0])
+        self.assertEqual(heap.popleft(), nodes[0])
+        self.assertEqual(heap.popleft(), nodes[3])
+
+    def test_index(self):
+        heap = NodeHeap(mknode(intid=0), 2)
+        nodes = [mknode(intid=x) for x in range(1, 200)]
+        for node in reversed(nodes):
+            heap.push(node)
+            heap.push(node)
+        self.assertTrue(nodes[100] in heap)
+        self.assertEqual(heap.getNodeById(nodes[100].id), nodes[100])
+        self.assertEqual(list(heap), nodes[:2])
+        heap.remove([n.id for n in nodes[:150]])
+        self.assertFalse(nodes[100] in heap)
+        self.assertIsNone(heap.getNodeById(nodes[100].id))
+        self.assertEqual(list(heap), nodes[150:152])
+        self.assertTrue(len(heap.heap) < 100)
@@ -13,16 +13,28 @@ from twisted.trial import unittest
 from twisted.internet import task, address, udp, defer, reactor
 
 from dht.protocol import KademliaProtocol
-from dht.utils import digest
+from dht.utils import digest, BloomFilter
 from dht.storage import ForgetfulStorage
 from dht.tests.utils import mknode
 from dht.node import Node
 from protos import message, objects
 from net.wireprotocol import OpenBazaarProtocol
+from net.rpcudp import MessageBuilder, RTTEstimate, DETACHED_FRAME, TIMED_OUT, openDetached
 from db import datastore
 from config import PROTOCOL_VERSION
 
 
+def parseSent(payload):
+    """
+    Parse a message we sent, in either framing.
+    """
+    if payload[:1] == DETACHED_FRAME:
+        payload = openDetached(payload)[1]
+    m = message.Message()
+    m.ParseFromString(payload)
+    return m
+
+
 class KademliaProtocolTest(unittest.TestCase):
     def setUp(self):
         self.version = PROTOCOL_VERSION
@@ -99,7 +111,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
         received_message = sent_packet.payload
         m2 = message.Message()
-        m2.ParseFromString(received_message)
+        m2.MergeFrom(parseSent(received_message))
         m2.ClearField("signature")
         received_message = m2.SerializeToString()
 
@@ -133,7 +145,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
         received_message = sent_packet.payload
         m2 = message.Message()
-        m2.ParseFromString(received_message)
+        m2.MergeFrom(parseSent(received_message))
         m2.ClearField("signature")
         received_message = m2.SerializeToString()
         self.assertEqual(received_message, expected_message)
@@ -197,11 +209,11 @@ class KademliaProtocolTest(unittest.TestCase):
             for call in self.proto_mock.send_datagram.call_args_list
         )
         m2 = message.Message()
-        m2.ParseFromString(sent_packets[0].payload)
+        m2.MergeFrom(parseSent(sent_packets[0].payload))
         m2.ClearField("signature")
         received_message1 = m2.SerializeToString()
         m3 = message.Message()
-        m3.ParseFromString(sent_packets[1].payload)
+        m3.MergeFrom(parseSent(sent_packets[1].payload))
         m3.ClearField("signature")
         received_message2 = m3.SerializeToString()
         self.assertEqual(received_message1, expected_message1)
@@ -226,7 +238,7 @@ class KademliaProtocolTest(unittest.TestCase):
         self.clock.advance(100 * constants.PACKET_TIMEOUT)
         sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
         m4 = message.Message()
-        m4.ParseFromString(sent_packet.payload)
+        m4.MergeFrom(parseSent(sent_packet.payload))
         m4.ClearField("signature")
         received_message = m4.SerializeToString()
         self.assertEqual(received_message, expected_message3)
@@ -255,7 +267,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
         received_message = sent_packet.payload
         a = message.Message()
-        a.ParseFromString(received_message)
+        a.MergeFrom(parseSent(received_message))
         a.ClearField("signature")
         received_message = a.SerializeToString()
         self.assertEqual(received_message, expected_message)
@@ -293,7 +305,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
         received_message = sent_packet.payload
         a = message.Message()
-        a.ParseFromString(received_message)
+        a.MergeFrom(parseSent(received_message))
         a.ClearField("signature")
         received_message = a.SerializeToString()
         self.assertEqual(received_message, expected_message)
@@ -350,7 +362,7 @@ class KademliaProtocolTest(unittest.TestCase):
         )
         received_message = sent_packets[1].payload
         a = message.Message()
-        a.ParseFromString(received_message)
+        a.MergeFrom(parseSent(received_message))
         a.ClearField("signature")
         received_message = a.SerializeToString()
 
@@ -390,7 +402,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
         received_message = sent_packet.payload
         a = message.Message()
-        a.ParseFromString(received_message)
+        a.MergeFrom(parseSent(received_message))
         a.ClearField("signature")
         received_message = a.SerializeToString()
 
@@ -410,7 +422,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_message = sent_packet.payload
 
         m = message.Message()
-        m.ParseFromString(sent_message)
+        m.MergeFrom(parseSent(sent_message))
         self.assertTrue(len(m.messageID) == 20)
         self.assertEqual(self.protocol.sourceNode.getProto().guid, m.sender.guid)
         self.assertEqual(self.protocol.sourceNode.getProto().publicKey, m.sender.publicKey)
@@ -431,7 +443,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_message = sent_packet.payload
 
         m = message.Message()
-        m.ParseFromString(sent_message)
+        m.MergeFrom(parseSent(sent_message))
         self.assertTrue(len(m.messageID) == 20)
         self.assertEqual(self.protocol.sourceNode.getProto().guid, m.sender.guid)
         self.assertEqual(self.protocol.sourceNode.getProto().publicKey, m.sender.publicKey)
@@ -455,7 +467,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_message = sent_packet.payload
 
         m = message.Message()
-        m.ParseFromString(sent_message)
+        m.MergeFrom(parseSent(sent_message))
         self.assertTrue(len(m.messageID) == 20)
         self.assertEqual(self.protocol.sourceNode.getProto().guid, m.sender.guid)
         self.assertEqual(self.protocol.sourceNode.getProto().publicKey, m.sender.publicKey)
@@ -477,7 +489,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_message = sent_packet.payload
 
         m = message.Message()
-        m.ParseFromString(sent_message)
+        m.MergeFrom(parseSent(sent_message))
         self.assertTrue(len(m.messageID) == 20)
         self.assertEqual(self.protocol.sourceNode.getProto().guid, m.sender.guid)
         self.assertEqual(self.protocol.sourceNode.getProto().publicKey, m.sender.publicKey)
@@ -498,7 +510,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_message = sent_packet.payload
 
         m = message.Message()
-        m.ParseFromString(sent_message)
+        m.MergeFrom(parseSent(sent_message))
         self.assertEqual(self.proto_mock.send_datagram.call_args_list[0][0][1], self.addr1)
         self.assertTrue(len(m.messageID) == 20)
         self.assertEqual(self.protocol.sourceNode.getProto().guid, m.sender.guid)
@@ -539,6 +551,147 @@ class KademliaProtocolTest(unittest.TestCase):
         self.protocol.router.addContact(n)
         self.protocol.timeout(n)
 
+    def test_timeoutIndex(self):
+        n1 = Node(digest("S"), self.addr1[0], self.addr1[1])
+        n2 = Node(digest("T"), self.addr2[0], self.addr2[1])
+        results = []
+        requests = [("a", self.addr1, "ping"), ("b", self.addr1, "store"), ("c", self.addr2, "store")]
+        for msgID, addr, command in requests:
+            d = defer.Deferred().addCallback(results.append)
+            self.protocol._outstanding[msgID] = [d, addr, reactor.callLater(5, lambda: None), command]
+        self.assertEqual(self.protocol.inflight(),
+                         {'peers': {self.addr1: 2, self.addr2: 1}, 'commands': {"ping": 1, "store": 2}})
+
+        self.protocol.timeout(n1)
+        self.assertEqual(results, [(False, None), (False, None)])
+        self.assertEqual(self.protocol._outstanding.keys(), ["c"])
+        self.assertEqual(self.protocol.inflight(), {'peers': {self.addr2: 1}, 'commands': {"store": 1}})
+
+        self.protocol._acceptResponse("c", ["True"], n2)
+        self.assertEqual(results[-1], (True, ["True"]))
+        self.assertEqual(self.protocol.inflight(), {'peers': {}, 'commands': {}})
+
+    def test_rpcTimeout(self):
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        self.assertEqual(self.protocol.rttEstimate(n), None)
+        self.assertEqual(self.protocol.rpcTimeout(n, "ping"), 15)
+        self.assertEqual(self.protocol.rpcTimeout(n, "get_image"), 60)
+        self.assertEqual(self.protocol.rpcTimeout(n, "store_many", 16384), 16)
+
+        d = defer.Deferred()
+        self.protocol._outstanding["msgID"] = [d, self.addr1, reactor.callLater(5, lambda: None), "ping",
+                                               time.time() - 0.1]
+        self.protocol._acceptResponse("msgID", ["test"], n)
+        srtt, rttvar = self.protocol.rttEstimate(n)
+        self.assertTrue(0.1 <= srtt < 1)
+        self.assertAlmostEqual(rttvar, srtt / 2)
+        self.assertEqual(self.protocol.rpcTimeout(n, "ping"), self.protocol.MIN_TIMEOUT)
+        self.assertEqual(self.protocol.rpcTimeout(n, "get_image"), 60)
+
+        estimate = self.protocol.rtt.get(self.addr1)
+        estimate.update(30)
+        self.assertEqual(self.protocol.rpcTimeout(n, "ping"), 15)
+
+        self.protocol.timeout(n)
+        self.assertEqual(self.protocol.rttEstimate(n), None)
+
+        estimate = RTTEstimate(0.1)
+        self.protocol.rtt.set(self.addr1, estimate)
+        for command in self.protocol.REMOTE_COMMANDS:
+            self.assertEqual(self.protocol.rpcTimeout(n, command), 15)
+
+    def test_requestTimeout(self):
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        self.protocol.router.addContact(n)
+        self.protocol.rtt.set(self.addr1, RTTEstimate(0.1))
+
+        results = []
+        self.protocol.ping(n).addCallback(results.append)
+        self.protocol.get_image(n, digest("image")).addCallback(results.append)
+        self.clock.advance(self.protocol.MIN_TIMEOUT + 1)
+        self.assertEqual(results, [(False, TIMED_OUT)])
+        self.assertEqual(self.protocol.inflight(), {'peers': {self.addr1: 1}, 'commands': {"get_image": 1}})
+        self.assertEqual(self.protocol.rttEstimate(n), None)
+        self.assertIn(n, self.protocol.router.findNeighbors(self.node))
+        self.assertFalse(self.proto_mock.shutdown.called)
+
+    def test_requestTimeoutListeners(self):
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        timedOut = []
+        self.protocol.timeoutListeners.append(timedOut.append)
+        self.protocol.rtt.set(self.addr1, RTTEstimate(0.1))
+        self.protocol.ping(n)
+        self.clock.advance(self.protocol.MIN_TIMEOUT + 1)
+        self.assertEqual(timedOut, [n])
+        self.protocol.ping(n)
+        self.clock.advance(16)
+        self.assertEqual(timedOut, [n, n])
+
+    def test_slowResponseKeepsContact(self):
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        self.protocol.router.addContact(n)
+        self.protocol.rtt.set(self.addr1, RTTEstimate(0.1))
+
+        results = []
+        with mock.patch.object(self.protocol.router, "removeContact") as removeContact:
+            self.protocol.callPing(n).addCallback(results.append)
+            self.clock.advance(self.protocol.MIN_TIMEOUT + 1)
+            self.assertEqual(results, [(False, TIMED_OUT)])
+            self.assertFalse(removeContact.called)
+
+            # without an estimate the request waits the full waitTimeout, after which the peer is dropped
+            self.protocol.callPing(n).addCallback(results.append)
+            self.clock.advance(16)
+            self.assertEqual(results[-1], (False, None))
+            removeContact.assert_called_once_with(n)
+
+    def test_messageBuilder(self):
+        builder = MessageBuilder(self.node, self.signing_key)
+        for testnet, args in ((False, []), (True, ["a", "b" * 300, 10])):
+            m = message.Message()
+            m.messageID = digest("msgid")
+            m.sender.MergeFrom(self.node.getProto())
+            m.command = message.STORE
+            m.protoVer = self.version
+            for arg in args:
+                m.arguments.append(str(arg))
+            m.testnet = testnet
+            m.signature = self.signing_key.sign(m.SerializeToString())[:64]
+            self.assertEqual(builder.build(digest("msgid"), message.STORE, args, testnet), m.SerializeToString())
+
+        self.node.nat_type = objects.RESTRICTED
+        m = message.Message()
+        m.ParseFromString(builder.build(digest("msgid"), message.PING, [], False))
+        self.assertEqual(m.sender.natType, objects.RESTRICTED)
+
+    def test_detachedFraming(self):
+        self._connecting_to_connected()
+        builder = MessageBuilder(self.node, self.signing_key)
+        data = builder.build(digest("msgid"), message.PING, [], False, detached=True)
+        pubkey, signed = openDetached(data)
+        self.assertEqual(pubkey, self.signing_key.verify_key.encode())
+        self.assertEqual(signed + "\x3a\x40" + data[34:98], builder.build(digest("msgid"), message.PING, [], False))
+
+        tampered = data[:-1] + chr(ord(data[-1]) ^ 1)
+        self.assertFalse(self.handler.receive_message(tampered))
+
+        self.handler.on_connection_made()
+        self.handler.receive_message(data)
+        self.clock.advance(100 * constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        # we've now heard the sender's version, so the response is framed the same way
+        response = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0]).payload
+        self.assertEqual(response[0], DETACHED_FRAME)
+        m = parseSent(response)
+        self.assertEqual(m.command, message.PING)
+        self.assertEqual(m.messageID, digest("msgid"))
+
     def test_transferKeyValues(self):
         self._connecting_to_connected()
         self.wire_protocol[self.addr1] = self.con
@@ -555,7 +708,7 @@ class KademliaProtocolTest(unittest.TestCase):
         sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
         sent_message = sent_packet.payload
         x = message.Message()
-        x.ParseFromString(sent_message)
+        x.MergeFrom(parseSent(sent_message))
 
         i = objects.Inv()
         i.keyword = digest("keyword")
@@ -576,6 +729,129 @@ class KademliaProtocolTest(unittest.TestCase):
         self.assertTrue(x.arguments[0] in m.arguments)
         self.assertTrue(x.arguments[1] in m.arguments)
 
+    def test_republishPlanner(self):
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+
+        self.protocol.storage[digest("keyword")] = (
+            digest("key"), self.protocol.sourceNode.getProto().SerializeToString(), 10)
+
+        n1 = Node(digest("id"), self.addr1[0], self.addr1[1])
+        n2 = Node(digest("id2"), self.addr2[0], self.addr2[1])
+        plan = self.protocol.republisher.plan([n1, n2])
+        self.assertEqual([n for n, _ in plan], [n1, n2])
+        self.assertEqual(len(plan[0][1]), 1)
+
+        self.protocol.republisher.add(n1)
+        self.protocol.republisher.add(n1)
+        self.assertEqual(len(self.protocol.republisher.pending), 1)
+        self.assertFalse(self.proto_mock.send_datagram.called)
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.protocol.republisher.pending), 0)
+        self.clock.advance(1)
+        connection.REACTOR.runUntilCurrent()
+        commands = []
+        for call in self.proto_mock.send_datagram.call_args_list:
+            x = message.Message()
+            x.MergeFrom(parseSent(packet.Packet.from_bytes(call[0][0]).payload))
+            commands.append(x.command)
+        self.assertTrue(message.Command.Value("INV") in commands)
+
+    def test_rpc_inv_summary(self):
+        sender = Node(digest("id"), self.addr1[0], self.addr1[1], digest("key"), nat_type=objects.FULL_CONE)
+        self.protocol.storage[digest("keyword")] = (digest("key"), "value", 10)
+        self.protocol.storage[digest("keyword")] = (digest("key2"), "value", 10)
+        self.protocol.storage[digest("other")] = (digest("key3"), "value", 10)
+
+        ret = self.protocol.rpc_inv_summary(sender, "salt", digest("keyword"), digest("missing"))
+        f = BloomFilter.fromString(ret[0], "salt")
+        self.assertTrue(digest("keyword") + digest("key") in f)
+        self.assertTrue(digest("keyword") + digest("key2") in f)
+        self.assertFalse(digest("other") + digest("key3") in f)
+
+    def test_sendInv_summary(self):
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+
+        n = Node(digest("id"), self.addr1[0], self.addr1[1], digest("key"), nat_type=objects.FULL_CONE)
+        self.protocol.storage[digest("keyword")] = (digest("key"), "value", 10)
+        self.protocol.storage[digest("keyword")] = (digest("key2"), "value2", 10)
+        items = [(digest("keyword"), digest("key")), (digest("keyword"), digest("key2"))]
+
+        # peers we haven't heard from are sent the old INVs
+        self.protocol.sendInv(n, items)
+        self.assertEqual(len(self.protocol._outstanding), 1)
+        self.protocol._outstanding.clear()
+
+        self.protocol.peerVersions.set(n.id, self.protocol.INV_SUMMARY_VERSION)
+        self.protocol.sendInv(n, items)
+        self.clock.advance(1)
+        connection.REACTOR.runUntilCurrent()
+        x = self._lastSentMessage()
+        self.assertEqual(x.command, message.INV_SUMMARY)
+        self.assertEqual(list(x.arguments[1:]), [digest("keyword")])
+
+        # the peer already has the first value
+        f = BloomFilter.forCapacity(1, salt=x.arguments[0])
+        f.add(digest("keyword") + digest("key"))
+        self.protocol.callValues = mock.Mock()
+        self.protocol._acceptResponse(x.messageID, (f.toString(),), n)
+        values = self.protocol.callValues.call_args[0][1]
+        self.assertEqual(len(values), 1)
+        v = objects.Value()
+        v.ParseFromString(values[0])
+        self.assertEqual(v.valueKey, digest("key2"))
+
+    def _lastSentMessage(self):
+        for call in reversed(self.proto_mock.send_datagram.call_args_list):
+            payload = packet.Packet.from_bytes(call[0][0]).payload
+            if payload:
+                m = message.Message()
+                m.MergeFrom(parseSent(payload))
+                return m
+
+    def test_rpc_store_many(self):
+        sender = Node(digest("id"), self.addr1[0], self.addr1[1], digest("key"), nat_type=objects.FULL_CONE)
+        good = objects.Value()
+        good.keyword = digest("keyword")
+        good.valueKey = digest("key")
+        good.serializedData = "value"
+        good.ttl = 10
+        bad = objects.Value()
+        bad.MergeFrom(good)
+        bad.keyword = "keyword"
+        ret = self.protocol.rpc_store_many(sender, good.SerializeToString(), "garbage", bad.SerializeToString())
+        self.assertEqual(ret, ["True", "False", "False"])
+        self.assertEqual(self.storage.getSpecific(digest("keyword"), digest("key")), "value")
+
+    def test_rpc_delete_many(self):
+        sender = Node(digest("id"), self.addr1[0], self.addr1[1], self.signing_key.verify_key.encode(),
+                      nat_type=objects.FULL_CONE)
+        keyword = digest(sender.id)
+        self.storage[keyword] = (digest("key"), "value", 10)
+        self.storage[keyword] = (digest("key2"), "value", 10)
+        signature = self.signing_key.sign(digest("key"))[:64]
+        ret = self.protocol.rpc_delete_many(sender, keyword, digest("key"), signature,
+                                            keyword, digest("key2"), "badsig")
+        self.assertEqual(ret, ["True", "False"])
+        self.assertEqual(self.storage.getSpecific(keyword, digest("key")), None)
+        self.assertEqual(self.storage.getSpecific(keyword, digest("key2")), "value")
+
+    def test_callManyNotFound(self):
+        n = Node(digest("id"), self.addr1[0], self.addr1[1], digest("key"), nat_type=objects.FULL_CONE)
+        notFound = lambda *args: defer.succeed((True, None))
+        for name in ("store", "delete", "store_many", "delete_many"):
+            setattr(self.protocol, name, notFound)
+        values = [(digest("keyword"), digest("key"), "value", 10)] * 2
+        deletes = [(digest("keyword"), digest("key"), "sig")] * 2
+        results = []
+        for version in (0, self.protocol.STORE_MANY_VERSION):
+            self.protocol.peerVersions.set(n.id, version)
+            self.protocol.callStoreMany(n, values).addCallback(results.append)
+            self.protocol.callDeleteMany(n, deletes).addCallback(results.append)
+        self.assertEqual(results, [(True, [False, False])] * 4)
+
     def test_refreshIDs(self):
         node1 = Node(digest("id1"), "127.0.0.1", 12345, pubkey=digest("key1"))
         node2 = Node(digest("id2"), "127.0.0.1", 22222, pubkey=digest("key2"))
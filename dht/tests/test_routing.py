@@ -1,3 +1,5 @@
+import pickle
+
 from twisted.trial import unittest
 
 from dht.routing import KBucket, RoutingTable
@@ -43,6 +45,17 @@ class KBucketTest(unittest.TestCase):
         bucket.removeNode(mknode(intid=2))
         self.assertEqual(len(bucket), 1)
 
+    def test_replacementNodes(self):
+        bucket = KBucket(0, 10, 2, replacements=2)
+        for i in range(6):
+            bucket.addNode(mknode(intid=i, port=i))
+        self.assertEqual([n.long_id for n in bucket.replacementNodes], [4, 5])
+        bucket.addNode(mknode(intid=4, port=4))
+        self.assertEqual([n.long_id for n in bucket.replacementNodes], [5, 4])
+        bucket.removeNode(mknode(intid=0))
+        self.assertEqual([n.long_id for n in bucket.getNodes()], [1, 4])
+        self.assertEqual(len(bucket.replacementNodes), 1)
+
     def test_inRange(self):
         bucket = KBucket(0, 10, 10)
         self.assertTrue(bucket.hasInRange(mknode(intid=5)))
@@ -73,3 +86,82 @@ class RoutingTableTest(unittest.TestCase):
         self.assertTrue(len(self.router.buckets), 1)
         self.assertTrue(len(self.router.buckets[0].nodes), 1)
         self.assertTrue(self.router.buckets[0].getNodes()[0].id == digest("asdf"))
+
+    def test_getBucketFor(self):
+        for _ in range(6):
+            self.router.splitBucket(len(self.router.buckets) - 1)
+            self.router.splitBucket(0)
+        for _ in range(100):
+            node = mknode()
+            bucket = self.router.buckets[self.router.getBucketFor(node)]
+            self.assertTrue(bucket.range[0] <= node.long_id < bucket.range[1])
+        upper = self.router.buckets[0].range[1]
+        self.assertEqual(self.router.getBucketFor(mknode(nodeid=("%040x" % upper).decode("hex"))), 1)
+        self.assertEqual(self.router.getBucketFor(mknode(nodeid="\xff" * 20)), len(self.router.buckets) - 1)
+
+    def test_addressIndex(self):
+        router = RoutingTable(self, 3, Node(digest("test"), "127.0.0.1", 1234))
+        nodes = [mknode(ip="127.0.0.1", port=i) for i in range(50)]
+        for node in nodes:
+            router.addContact(node)
+        contacts = [n for b in router.buckets for n in b.getNodes()]
+        self.assertEqual(sorted(n.id for n in router.addresses.values()), sorted(n.id for n in contacts))
+        router.removeContact(contacts[0])
+        self.assertFalse(("127.0.0.1", contacts[0].port) in router.addresses)
+        contacts = [n for b in router.buckets for n in b.getNodes()]
+        self.assertEqual(sorted(n.id for n in router.addresses.values()), sorted(n.id for n in contacts))
+        router.addContact(Node(digest("asdf"), "127.0.0.1", contacts[0].port))
+        self.assertTrue(router.isNewNode(contacts[0]))
+        self.assertNotEqual(router.addresses.get(("127.0.0.1", contacts[0].port)), contacts[0])
+
+    def callPing(self, node):
+        pass
+
+    def test_findNeighborsMany(self):
+        router = RoutingTable(self, 20, Node(digest("test"), "127.0.0.1", 1234))
+        for i in range(100):
+            router.addContact(mknode(ip="127.0.0.1", port=i))
+        contacts = [n for b in router.buckets for n in b.getNodes()]
+        targets = [mknode() for _ in range(5)]
+        results = router.findNeighborsMany(targets, k=8)
+        self.assertEqual(len(results), 5)
+        for target, nearest in zip(targets, results):
+            expected = sorted(contacts, key=lambda n, t=target: n.distanceTo(t))[:8]
+            self.assertEqual([n.id for n in nearest], [n.id for n in expected])
+        self.assertEqual(router.findNeighbors(targets[0], k=8), results[0])
+        # a k big enough for the flat scan agrees with walking the buckets
+        k = router.FLAT_SCAN_MIN_K
+        self.assertEqual(router.findNeighborsMany(targets, k), [router.findNeighbors(t, k) for t in targets])
+        excluded = router.findNeighbors(targets[0], k=8, exclude=results[0][0])
+        self.assertEqual(excluded, results[0][1:] + router.findNeighbors(targets[0], k=9)[8:])
+        router.removeContact(results[0][0])
+        self.assertFalse(results[0][0] in router.findNeighbors(targets[0], k=8))
+
+    def test_replacements(self):
+        router = RoutingTable(self, 3, Node(digest("test"), "127.0.0.1", 1234), replacements=5)
+        for i in range(30):
+            router.addContact(mknode(ip="127.0.0.1", port=i))
+        self.assertTrue(len(router.buckets) > 1)
+        for bucket in router.buckets:
+            self.assertEqual(bucket.replacementNodes.maxsize, 5)
+        restored = RoutingTable(self, 3, Node(digest("test"), "127.0.0.1", 1234), replacements=5)
+        restored.restore(router.snapshot())
+        self.assertEqual([b.replacementNodes.maxsize for b in restored.buckets], [5] * len(router.buckets))
+
+    def test_snapshot_restore(self):
+        router = RoutingTable(self, 3, Node(digest("test"), "127.0.0.1", 1234))
+        for i in range(30):
+            router.addContact(Node(digest(i), "127.0.0.1", i, digest("key"), ("10.0.0.1", 80), 2, i % 2 == 0))
+        snapshot = pickle.loads(pickle.dumps(router.snapshot(), pickle.HIGHEST_PROTOCOL))
+        restored = RoutingTable(self, 3, Node(digest("test"), "127.0.0.1", 1234))
+        nodes = restored.restore(snapshot)
+        self.assertEqual(len(nodes), len(router.addresses))
+        self.assertEqual(restored.bounds, router.bounds)
+        for old, new in zip(router.buckets, restored.buckets):
+            self.assertEqual(old.range, new.range)
+            self.assertEqual(old.lastSeen, new.lastSeen)
+            self.assertEqual([tuple(n) for n in old.getNodes()], [tuple(n) for n in new.getNodes()])
+        node = restored.buckets[0].getNodes()[0]
+        self.assertEqual((node.pubkey, node.relay_node, node.nat_type), (digest("key"), ("10.0.0.1", 80), 2))
+        self.assertEqual(sorted(n.id for n in restored.addresses.values()), sorted(n.id for n in nodes))
+        self.assertEqual(restored.restore({'version': 0}), [])
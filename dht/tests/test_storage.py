@@ -1,10 +1,15 @@
 __author__ = 'chris'
+import os
 import time
+import tempfile
+import sqlite3 as lite
 
+import mock
 from twisted.trial import unittest
 
 from dht.utils import digest
-from dht.storage import ForgetfulStorage, PersistentStorage, TTLDict
+from dht.storage import ForgetfulStorage, PersistentStorage, LogStorage, TTLDict, StorageQuota, \
+    SoonestExpiring, LeastRecentlyUsed, FarthestFirst, ValueCache
 
 from protos.objects import Value
 
@@ -75,6 +80,17 @@ class ForgetFulStorageTest(unittest.TestCase):
         f[self.keyword1] = (self.key1, self.value, .00000000000001)
         self.assertTrue(self.keyword1 not in f)
 
+    def test_cull(self):
+        f = ForgetfulStorage()
+        f[self.keyword1] = (self.key1, self.value, -1)
+        f[self.keyword1] = (self.key2, self.value, 10)
+        f[self.keyword2] = (self.key1, self.value, -1)
+        f.cull()
+        self.assertEqual(f.data.keys(), [self.keyword1])
+        self.assertEqual(f.getSpecific(self.keyword1, self.key2), self.value)
+        f.delete(self.keyword1, self.key2)
+        self.assertEqual(len(f.data), 0)
+
 
 class PersistentStorageTest(unittest.TestCase):
     def setUp(self):
@@ -133,6 +149,327 @@ class PersistentStorageTest(unittest.TestCase):
         p[self.keyword1] = (self.key1, self.value, .000000000001)
         self.assertTrue(p.get(self.keyword1) is None)
 
+    def test_iterkeys_distinct(self):
+        p = PersistentStorage(":memory:")
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p[self.keyword1] = (self.key2, self.value, 10)
+        p[self.keyword2] = (self.key1, self.value, 10)
+        self.assertEqual(sorted(p.iterkeys()), sorted([self.keyword1, self.keyword2]))
+        p.delete(self.keyword2, self.key1)
+        self.assertEqual(list(p.iterkeys()), [self.keyword1])
+
+    def test_iterkeys_snapshot(self):
+        p = PersistentStorage(":memory:", flush_interval=5)
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p.flush()
+        p[self.keyword2] = (self.key1, self.value, 10)
+        keys = []
+        for k in p.iterkeys():
+            keys.append(k)
+            p.flush()
+            p.cull()
+        self.assertEqual(sorted(keys), sorted([self.keyword1, self.keyword2]))
+
+    def test_legacy_hex_keywords(self):
+        fd, filename = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        db = lite.connect(filename)
+        db.text_factory = str
+        db.execute('''CREATE TABLE dht(keyword TEXT, id BLOB, value BLOB, birthday FLOAT)''')
+        db.execute('''INSERT INTO dht(keyword, id, value, birthday) VALUES (?,?,?,?)''',
+                   (self.keyword1.encode("hex"), self.key1, self.value, time.time()))
+        db.commit()
+        db.close()
+        p = PersistentStorage(filename)
+        self.addCleanup(p.db.close)
+        self.assertEqual(p.getSpecific(self.keyword1, self.key1), self.value)
+        self.assertEqual(list(p.iterkeys()), [self.keyword1])
+        cursor = p.db.cursor()
+        cursor.execute('''SELECT name FROM sqlite_master WHERE type='table' ORDER BY name''')
+        self.assertEqual(cursor.fetchall(), [("dht",), ("dhtkeywords",)])
+
+    def test_write_behind(self):
+        p = PersistentStorage(":memory:", flush_interval=5)
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p[self.keyword1] = (self.key1, self.value, 10)
+        self.assertEqual(p.getSpecific(self.keyword1, self.key1), self.value)
+        self.assertEqual(list(p.iterkeys()), [self.keyword1])
+        self.assertEqual(len(p.get(self.keyword1)), 1)
+        cursor = p.db.cursor()
+        cursor.execute('''SELECT COUNT(*) FROM dht''')
+        self.assertEqual(cursor.fetchone()[0], 0)
+        p.flush()
+        self.assertTrue(p._flush_call is None)
+        cursor.execute('''SELECT COUNT(*) FROM dht''')
+        self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(len(p.get(self.keyword1)), 1)
+
+    def test_write_behind_flush_size(self):
+        p = PersistentStorage(":memory:", flush_interval=5, flush_size=2)
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p[self.keyword2] = (self.key2, self.value, 10)
+        self.assertTrue(p._flush_call is None)
+        self.assertEqual(p._pending, {})
+        p.delete(self.keyword2, self.key2)
+        self.assertEqual(list(p.iterkeys()), [self.keyword1])
+
+    def test_cull(self):
+        p = PersistentStorage(":memory:")
+        p[self.keyword1] = (self.key1, self.value, -1)
+        p[self.keyword2] = (self.key1, self.value, 10)
+        self.assertTrue(p.get(self.keyword1) is None)
+        p.cull()
+        cursor = p.db.cursor()
+        cursor.execute('''SELECT COUNT(*) FROM dht''')
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class LogStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.keyword1 = digest("shoes")
+        self.keyword2 = digest("socks")
+        self.key1 = digest("contract1")
+        self.key2 = digest("contract2")
+        self.value = digest("node")
+        self.filename = "test_dht.store"
+
+    def tearDown(self):
+        for f in (self.filename, self.filename + ".compact"):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def test_setitem(self):
+        l = LogStorage(self.filename)
+        l[self.keyword1] = (self.key1, self.value, 10)
+        l[self.keyword2] = (self.key1, self.value, 10)
+        l[self.keyword2] = (self.key2, self.value, 10)
+        self.assertEqual(l[self.keyword1], [(self.key1, self.value)])
+        self.assertEqual(l[self.keyword2], [(self.key1, self.value), (self.key2, self.value)])
+        self.assertEqual(sorted(l.iterkeys()), sorted([self.keyword1, self.keyword2]))
+        l.close()
+
+    def test_get(self):
+        v = Value()
+        v.valueKey = self.key1
+        v.serializedData = self.value
+        v.ttl = 10
+        l = LogStorage(self.filename)
+        l[self.keyword1] = (self.key1, self.value, 10)
+        self.assertEqual([v.SerializeToString()], l.get(self.keyword1))
+        self.assertEqual(self.value, l.getSpecific(self.keyword1, self.key1))
+        l.close()
+
+    def test_delete(self):
+        l = LogStorage(self.filename)
+        l[self.keyword1] = (self.key1, self.value, 10)
+        l.delete(self.keyword1, self.key1)
+        self.assertEqual(l.get(self.keyword1), None)
+        l.close()
+        l = LogStorage(self.filename)
+        self.assertEqual(l.get(self.keyword1), None)
+        self.assertEqual(list(l.iterkeys()), [])
+        l.close()
+
+    def test_ttl(self):
+        l = LogStorage(self.filename)
+        l[self.keyword1] = (self.key1, self.value, -1)
+        self.assertTrue(l.get(self.keyword1) is None)
+        l.close()
+
+    def test_restart(self):
+        l = LogStorage(self.filename)
+        l[self.keyword1] = (self.key1, self.value, 10)
+        l[self.keyword2] = (self.key2, self.value, 10)
+        l.close()
+        l = LogStorage(self.filename)
+        self.assertEqual(l.getSpecific(self.keyword1, self.key1), self.value)
+        self.assertEqual(l.getSpecific(self.keyword2, self.key2), self.value)
+        self.assertTrue(l.get_ttl(self.keyword1, self.key1) <= 10)
+        l.close()
+
+    def test_crash_recovery(self):
+        l = LogStorage(self.filename)
+        l[self.keyword1] = (self.key1, self.value, 10)
+        l[self.keyword2] = (self.key2, self.value, 10)
+        l.close()
+        size = os.path.getsize(self.filename)
+        # simulate a crash half way through writing the last record
+        with open(self.filename, "r+b") as f:
+            f.truncate(size - 5)
+        l = LogStorage(self.filename)
+        self.assertEqual(l.getSpecific(self.keyword1, self.key1), self.value)
+        self.assertTrue(l.getSpecific(self.keyword2, self.key2) is None)
+        l[self.keyword2] = (self.key2, self.value, 10)
+        l.close()
+        l = LogStorage(self.filename)
+        self.assertEqual(l.getSpecific(self.keyword2, self.key2), self.value)
+        l.close()
+
+    def test_corrupt_record(self):
+        l = LogStorage(self.filename)
+        l[self.keyword1] = (self.key1, self.value, 10)
+        l[self.keyword2] = (self.key2, self.value, 10)
+        l.close()
+        with open(self.filename, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write("\x00" if last != "\x00" else "\x01")
+        l = LogStorage(self.filename)
+        self.assertEqual(list(l.iterkeys()), [self.keyword1])
+        l.close()
+
+    def test_compaction(self):
+        l = LogStorage(self.filename, compact_min_size=0)
+        l[self.keyword1] = (self.key1, self.value, 10)
+        size = os.path.getsize(self.filename)
+        l[self.keyword2] = (self.key1, self.value, 10)
+        l[self.keyword2] = (self.key2, self.value, -1)
+        l.delete(self.keyword2, self.key1)
+        l.cull()
+        self.assertEqual(os.path.getsize(self.filename), size)
+        self.assertFalse(os.path.exists(self.filename + ".compact"))
+        self.assertEqual(l.getSpecific(self.keyword1, self.key1), self.value)
+        l[self.keyword2] = (self.key2, self.value, 10)
+        l.close()
+        l = LogStorage(self.filename)
+        self.assertEqual(sorted(l.iterkeys()), sorted([self.keyword1, self.keyword2]))
+        self.assertEqual(l.getSpecific(self.keyword2, self.key2), self.value)
+        l.close()
+
+
+class ValueCacheTest(unittest.TestCase):
+    def test_ttl_patched_on_read(self):
+        cache = ValueCache()
+        cache.put(digest("shoes"), [(digest("contract1"), digest("node"), time.time() + 300.2)])
+        v = Value()
+        v.valueKey = digest("contract1")
+        v.serializedData = digest("node")
+        v.ttl = 300
+        self.assertEqual(cache.get(digest("shoes")), [v.SerializeToString()])
+
+    def test_invalidated_on_store(self):
+        f = ForgetfulStorage()
+        f[digest("shoes")] = (digest("contract1"), digest("node"), 10)
+        self.assertEqual(len(f.get(digest("shoes"))), 1)
+        self.assertTrue(digest("shoes") in f.value_cache)
+        f[digest("shoes")] = (digest("contract2"), digest("node"), 10)
+        self.assertEqual(len(f.get(digest("shoes"))), 2)
+        f.delete(digest("shoes"), digest("contract1"))
+        self.assertEqual(len(f.get(digest("shoes"))), 1)
+
+    def test_expired_values_dropped(self):
+        p = PersistentStorage(":memory:")
+        p[digest("shoes")] = (digest("contract1"), digest("node"), 10)
+        self.assertEqual(len(p.get(digest("shoes"))), 1)
+        p.value_cache.put(digest("shoes"), [(digest("contract1"), digest("node"), time.time() - 1)])
+        self.assertTrue(p.get(digest("shoes")) is None)
+
+    def test_bounded(self):
+        cache = ValueCache(maxsize=2)
+        for name in ("shoes", "socks", "hats"):
+            cache.put(digest(name), [(digest("contract1"), digest("node"), time.time() + 300)])
+        self.assertFalse(digest("shoes") in cache)
+        self.assertTrue(digest("hats") in cache)
+
+    def test_invalidated_on_cull(self):
+        for storage in (ForgetfulStorage(), PersistentStorage(":memory:"), PersistentStorage(":memory:", 10, 5)):
+            storage[digest("shoes")] = (digest("contract1"), digest("node"), 10)
+            self.assertEqual(len(storage.get(digest("shoes"))), 1)
+            with mock.patch("time.time", return_value=time.time() + 11):
+                storage.cull()
+            self.assertFalse(digest("shoes") in storage.value_cache)
+            if isinstance(storage, PersistentStorage):
+                storage.flush()
+
+
+class StorageQuotaTest(unittest.TestCase):
+    def setUp(self):
+        self.keyword1 = digest("shoes")
+        self.keyword2 = digest("socks")
+        self.key1 = digest("contract1")
+        self.key2 = digest("contract2")
+        self.value = digest("node")
+
+    def test_max_entries_soonest_expiring(self):
+        f = ForgetfulStorage(quota=StorageQuota(max_entries=1, policy=SoonestExpiring()))
+        f[self.keyword1] = (self.key1, self.value, 100)
+        f[self.keyword2] = (self.key1, self.value, 10)
+        self.assertEqual(f.data.keys(), [self.keyword1])
+        self.assertEqual(f.quota.stats()["evictions"], 1)
+
+    def test_persistent_evicts_incoming_value(self):
+        for flush_interval in (None, 5):
+            quota = StorageQuota(max_entries=1, policy=SoonestExpiring())
+            p = PersistentStorage(":memory:", flush_interval=flush_interval, quota=quota)
+            p[self.keyword1] = (self.key1, self.value, 100)
+            p[self.keyword2] = (self.key2, self.value, 10)
+            p.flush()
+            cursor = p.db.cursor()
+            cursor.execute('''SELECT keyword, id FROM dht''')
+            self.assertEqual(cursor.fetchall(), [(self.keyword1, self.key1)])
+            self.assertEqual(len(quota), 1)
+            self.assertEqual(quota.stats()["evictions"], 1)
+
+    def test_persistent_duplicate_keeps_expiration(self):
+        policy = SoonestExpiring()
+        p = PersistentStorage(":memory:", quota=StorageQuota(policy=policy))
+        p[self.keyword1] = (self.key1, self.value, 100)
+        expiration = policy._expirations[(self.keyword1, self.key1)]
+        p[self.keyword1] = (self.key1, self.value, 1000)
+        self.assertEqual(policy._expirations[(self.keyword1, self.key1)], expiration)
+        self.assertTrue(p.get_ttl(self.keyword1, self.key1) <= 100)
+
+    def test_policy_heaps_stay_bounded(self):
+        for policy in (SoonestExpiring(), FarthestFirst(self.keyword1)):
+            f = ForgetfulStorage(quota=StorageQuota(max_entries=10, policy=policy))
+            for i in range(1000):
+                f[self.keyword2] = (self.key1, self.value, 10 + i)
+            self.assertTrue(len(policy._heap) <= 2 * 1 + 16)
+            self.assertEqual(policy.pop(), (self.keyword2, self.key1))
+            self.assertEqual(policy.pop(), None)
+
+    def test_max_bytes_lru(self):
+        quota = StorageQuota(max_bytes=80, policy=LeastRecentlyUsed())
+        p = PersistentStorage(":memory:", quota=quota)
+        p[self.keyword1] = (self.key1, self.value, 10)
+        p[self.keyword1] = (self.key2, self.value, 10)
+        p.getSpecific(self.keyword1, self.key1)
+        p[self.keyword2] = (self.key1, self.value, 10)
+        self.assertTrue(p.getSpecific(self.keyword1, self.key2) is None)
+        self.assertEqual(p.getSpecific(self.keyword1, self.key1), self.value)
+        self.assertEqual(quota.bytes, 80)
+
+    def test_farthest_first(self):
+        quota = StorageQuota(max_entries=1, policy=FarthestFirst(self.keyword1))
+        f = ForgetfulStorage(quota=quota)
+        f[self.keyword2] = (self.key1, self.value, 10)
+        f[self.keyword1] = (self.key1, self.value, 10)
+        self.assertEqual(f.data.keys(), [self.keyword1])
+        f[self.keyword2] = (self.key1, self.value, 10)
+        self.assertEqual(f.data.keys(), [self.keyword1])
+
+    def test_max_per_keyword(self):
+        quota = StorageQuota(max_per_keyword=1)
+        f = ForgetfulStorage(quota=quota)
+        f[self.keyword1] = (self.key1, self.value, 10)
+        f[self.keyword1] = (self.key2, self.value, 10)
+        self.assertEqual(len(f[self.keyword1]), 1)
+        self.assertEqual(quota.stats()["rejections"], 1)
+        f.delete(self.keyword1, self.key1)
+        f[self.keyword1] = (self.key2, self.value, 10)
+        self.assertEqual(f.getSpecific(self.keyword1, self.key2), self.value)
+        self.assertEqual(len(quota), 1)
+
+    def test_expired_values_leave_quota(self):
+        quota = StorageQuota()
+        f = ForgetfulStorage(quota=quota)
+        f[self.keyword1] = (self.key1, self.value, -1)
+        f.cull()
+        self.assertEqual(quota.stats()["entries"], 0)
+        self.assertEqual(quota.bytes, 0)
+
 
 class TTLDictTest(unittest.TestCase):
     """ TTLDict tests """
@@ -211,3 +548,14 @@ class TTLDictTest(unittest.TestCase):
 
         # remove=False, so nothing should be gone
         self.assertEqual(len(ttl_dict), 2)
+
+    def test_cull_skips_rescheduled_keys(self):
+        """ Test that cull() only removes keys whose current TTL has passed """
+        ttl_dict = TTLDict(60, a=1, b=2)
+        now = time.time()
+        ttl_dict.expire_at('a', now - 1)
+        ttl_dict.expire_at('b', now - 1)
+        ttl_dict.expire_at('b', now + 60)
+        ttl_dict.cull()
+        self.assertEqual(ttl_dict._values.keys(), ['b'])
+        self.assertEqual(ttl_dict['b'], 2)
@@ -3,7 +3,8 @@ import hashlib
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict
+from dht.utils import digest, sharedPrefix, ReplacementCache, LRUCache, BloomFilter, deferredDict
+from dht.tests.utils import mknode
 
 
 class UtilsTest(unittest.TestCase):
@@ -48,11 +49,61 @@ class UtilsTest(unittest.TestCase):
         deferredDict({}).addCallback(checkEmpty)
 
 
-class OrderedSetTest(unittest.TestCase):
-    def test_order(self):
-        o = OrderedSet()
-        o.push('1')
-        o.push('1')
-        o.push('2')
-        o.push('1')
-        self.assertEqual(o, ['2', '1'])
+class ReplacementCacheTest(unittest.TestCase):
+    def test_push_and_pop(self):
+        cache = ReplacementCache(3)
+        nodes = [mknode(intid=i) for i in range(4)]
+        for node in nodes:
+            cache.push(node)
+        self.assertEqual(len(cache), 3)
+        self.assertFalse(nodes[0] in cache)
+        cache.push(mknode(intid=1))
+        self.assertEqual([n.long_id for n in cache], [2, 3, 1])
+        self.assertEqual(cache.pop().long_id, 1)
+        cache.remove(nodes[3])
+        self.assertEqual(list(cache), [nodes[2]])
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.items(), [("a", 1), ("c", 3)])
+        cache.invalidate("a")
+        self.assertEqual(cache.get("a", "missing"), "missing")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_ttl(self):
+        cache = LRUCache(10, ttl=60)
+        cache.set("a", None)
+        cache.set("b", 2, ttl=-1)
+        self.assertTrue("a" in cache)
+        self.assertEqual(cache.get("a", "missing"), None)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+        self.assertEqual(cache.items(), [("a", None)])
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_membership(self):
+        f = BloomFilter.forCapacity(1000, salt="salt")
+        items = [digest(i) for i in range(1000)]
+        for item in items:
+            f.add(item)
+        for item in items:
+            self.assertTrue(item in f)
+        falsePositives = sum(1 for i in range(1000, 11000) if digest(i) in f)
+        self.assertTrue(falsePositives < 300)
+
+    def test_serialization(self):
+        f = BloomFilter.forCapacity(10, salt="salt")
+        f.add("a")
+        g = BloomFilter.fromString(f.toString(), "salt")
+        self.assertTrue("a" in g)
+        self.assertEqual((g.bits, g.hashes), (f.bits, f.hashes))
+        self.assertRaises(ValueError, BloomFilter.fromString, f.toString()[:-1], "salt")
+        self.assertRaises(ValueError, BloomFilter.fromString, BloomFilter.HEADER.pack(0, 1))
@@ -3,8 +3,12 @@ General catchall for functions that don't make sense as methods.
 
 Copyright (c) 2014 Brian Muller
 """
+import math
+import time
+import struct
 import hashlib
 import operator
+from collections import OrderedDict
 
 from twisted.internet import defer
 
@@ -42,19 +46,178 @@ def deferredDict(d):
     return dl.addCallback(handle, d.keys())
 
 
-class OrderedSet(list):
+class ReplacementCache(object):
     """
-    Acts like a list in all ways, except in the behavior of the :meth:`push` method.
+    A bounded, insertion ordered collection of nodes keyed by node id. Used by
+    a k-bucket to remember contacts it had no room for.
     """
 
-    def push(self, thing):
+    def __init__(self, maxsize):
         """
-        1. If the item exists in the list, it's removed
-        2. The item is pushed to the end of the list
+        Args:
+            maxsize: the most nodes to keep. Once full, pushing a new node
+                drops the one which was pushed (or refreshed) the longest ago.
         """
-        if thing in self:
-            self.remove(thing)
-        self.append(thing)
+        self.maxsize = maxsize
+        self.nodes = OrderedDict()
+
+    def push(self, node):
+        """
+        Add a node, or refresh it if it's already here, making it the
+        most recent entry.
+        """
+        self.nodes.pop(node.id, None)
+        self.nodes[node.id] = node
+        if len(self.nodes) > self.maxsize:
+            self.nodes.popitem(last=False)
+
+    def pop(self):
+        """
+        Remove and return the most recently pushed node.
+        """
+        return self.nodes.popitem()[1]
+
+    def remove(self, node):
+        self.nodes.pop(node.id, None)
+
+    def __contains__(self, node):
+        return node.id in self.nodes
+
+    def __iter__(self):
+        return self.nodes.itervalues()
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class LRUCache(object):
+    """
+    A dict-like cache which holds at most `maxsize` entries, dropping the least
+    recently used one when full. Entries can also be given a time to live after
+    which they're treated as missing.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        """
+        Args:
+            maxsize: the most entries to hold.
+            ttl: the default number of seconds an entry lives for, or None to keep
+                entries until they are evicted.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Get the value cached under key and mark it as recently used. Returns
+        default if there's nothing there or the entry has expired.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+            self.misses += 1
+            return default
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache value under key for ttl seconds, or the cache's default ttl if not given.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + ttl if ttl is not None else None, value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def items(self):
+        """
+        Get the (key, value) pairs which haven't expired, least recently used first.
+        """
+        now = time.time()
+        return [(k, v) for k, (expires, v) in self.entries.items() if expires is None or expires > now]
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > time.time())
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter over byte strings. Testing membership never gives a false
+    negative and gives a false positive with roughly the error rate the filter
+    was sized for. Filters built with the same salt can be sent over the wire
+    with `toString` and read back with `fromString`.
+    """
+
+    HEADER = struct.Struct(">IB")
+    MAX_BITS = 8 * 1048576
+    # each position comes from its own 32 bits of a sha512 digest
+    MAX_HASHES = 16
+    POSITIONS = struct.Struct(">16I")
+
+    def __init__(self, bits, hashes, salt=""):
+        """
+        Args:
+            bits: the size of the filter in bits.
+            hashes: how many bits to set for each item.
+            salt: mixed into every hash, so that the false positives differ from one
+                filter to the next.
+        """
+        if not 0 < bits <= self.MAX_BITS or not 0 < hashes <= self.MAX_HASHES:
+            raise ValueError("invalid bloom filter parameters")
+        self.bits = bits
+        self.hashes = hashes
+        self.salt = salt
+        self.array = bytearray((bits + 7) / 8)
+
+    @classmethod
+    def forCapacity(cls, capacity, errorRate=0.01, salt=""):
+        """
+        Get an empty filter sized to hold capacity items at the given false positive rate.
+        """
+        capacity = max(capacity, 1)
+        bits = int(math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        hashes = int(round(float(bits) / capacity * math.log(2)))
+        return cls(min(bits, cls.MAX_BITS), min(max(hashes, 1), cls.MAX_HASHES), salt)
+
+    @classmethod
+    def fromString(cls, data, salt=""):
+        bits, hashes = cls.HEADER.unpack_from(data)
+        f = cls(bits, hashes, salt)
+        if len(data) != cls.HEADER.size + len(f.array):
+            raise ValueError("bloom filter is the wrong size")
+        f.array = bytearray(data[cls.HEADER.size:])
+        return f
+
+    def toString(self):
+        return self.HEADER.pack(self.bits, self.hashes) + str(self.array)
+
+    def _positions(self, item):
+        h = self.POSITIONS.unpack(hashlib.sha512(self.salt + item).digest())
+        return [h[i] % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        for pos in self._positions(item):
+            if not self.array[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
 
 
 def sharedPrefix(args):
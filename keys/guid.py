@@ -8,9 +8,37 @@ import nacl.signing
 import nacl.hash
 import nacl.encoding
 
+from dht.utils import LRUCache
+
+# pubkey -> (VerifyKey, guid, pow_valid) for the public keys we've seen lately
+_identities = LRUCache(10000)
+
 def _testpow(pow_hash):
     return True if int(pow_hash, 16) < 50 else False
 
+def get_identity(pubkey):
+    """
+    Get (VerifyKey, guid, whether the guid has a valid proof of work) for a raw
+    public key. These are cached so peers we hear from often don't cost a hash
+    and a key construction every time.
+    """
+    identity = _identities.get(pubkey)
+    if identity is None:
+        h = nacl.hash.sha512(pubkey)
+        identity = (nacl.signing.VerifyKey(pubkey), unhexlify(h[:40]), _testpow(h[40:46]))
+        _identities.set(pubkey, identity)
+    return identity
+
+def verify_guid(pubkey, guid):
+    """
+    Check that guid is derived from pubkey with a valid proof of work and return
+    the VerifyKey for pubkey. Raises an exception if it isn't.
+    """
+    identity = get_identity(pubkey)
+    if not identity[2] or guid != identity[1]:
+        raise Exception('Invalid GUID')
+    return identity[0]
+
 class GUID(object):
     """
     Class for generating the guid. It can be generated using C code for a modest
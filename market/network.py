@@ -19,6 +19,7 @@ from config import DATA_FOLDER, TRANSACTION_FEE
 from dht.node import Node
 from dht.utils import digest
 from keys.bip32utils import derive_childkey
+from keys.guid import verify_guid
 from keys.keychain import KeyChain
 from log import Logger
 from market.contracts import Contract
@@ -394,14 +395,10 @@ class Server(object):
             # Verify the signature and guid of each follower.
             for follower in f.followers:
                 try:
-                    v_key = nacl.signing.VerifyKey(follower.pubkey)
+                    v_key = verify_guid(follower.pubkey, follower.guid)
                     signature = follower.signature
                     follower.ClearField("signature")
                     v_key.verify(follower.SerializeToString(), signature)
-                    h = nacl.hash.sha512(follower.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or follower.guid.encode("hex") != h[:40]:
-                        raise Exception('Invalid GUID')
                     if follower.following != node_to_ask.id:
                         raise Exception('Invalid follower')
                 except Exception:
@@ -432,13 +429,9 @@ class Server(object):
                 return None
             for user in f.users:
                 try:
-                    v_key = nacl.signing.VerifyKey(user.pubkey)
+                    v_key = verify_guid(user.pubkey, user.guid)
                     signature = user.signature
                     v_key.verify(user.metadata.SerializeToString(), signature)
-                    h = nacl.hash.sha512(user.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or user.guid.encode("hex") != h[:40]:
-                        raise Exception('Invalid GUID')
                 except Exception:
                     f.users.remove(user)
             return f
@@ -537,12 +530,8 @@ class Server(object):
                             p.ParseFromString(plaintext)
                             signature = p.signature
                             p.ClearField("signature")
-                            verify_key = nacl.signing.VerifyKey(p.pubkey)
+                            verify_key = verify_guid(p.pubkey, p.sender_guid)
                             verify_key.verify(p.SerializeToString(), signature)
-                            h = nacl.hash.sha512(p.pubkey)
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or p.sender_guid.encode("hex") != h[:40]:
-                                raise Exception('Invalid guid')
                             if p.type == objects.PlaintextMessage.Type.Value("ORDER_CONFIRMATION"):
                                 c = Contract(self.db, hash_value=unhexlify(p.subject),
                                              testnet=self.protocol.multiplexer.testnet)
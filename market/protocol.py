@@ -4,16 +4,16 @@ import json
 import nacl.signing
 import nacl.utils
 import nacl.encoding
-import nacl.hash
 from collections import OrderedDict
 from interfaces import MessageProcessor, BroadcastListener, MessageListener, NotificationListener
 from keys.bip32utils import derive_childkey
+from keys.guid import verify_guid
 from log import Logger
 from market.contracts import Contract
 from market.moderation import process_dispute, close_dispute
 from market.profile import Profile
 from nacl.public import PublicKey, Box
-from net.rpcudp import RPCProtocol
+from net.rpcudp import RPCProtocol, TIMED_OUT
 from protos.message import GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,\
     GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING, BROADCAST, MESSAGE, ORDER, \
     ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN, DISPUTE_CLOSE, GET_RATINGS, REFUND
@@ -219,11 +219,9 @@ class MarketProtocol(RPCProtocol):
             p.ParseFromString(plaintext)
             signature = p.signature
             p.ClearField("signature")
-            verify_key = nacl.signing.VerifyKey(p.pubkey)
+            verify_key = verify_guid(p.pubkey, p.sender_guid)
             verify_key.verify(p.SerializeToString(), signature)
-            h = nacl.hash.sha512(p.pubkey)
-            pow_hash = h[40:]
-            if int(pow_hash[:6], 16) >= 50 or p.sender_guid.encode("hex") != h[:40] or p.sender_guid != sender.id:
+            if p.sender_guid != sender.id:
                 raise Exception('Invalid guid')
             self.log.info("received a message from %s" % sender)
             self.router.addContact(sender)
@@ -431,6 +429,8 @@ class MarketProtocol(RPCProtocol):
         """
         if result[0]:
             self.router.addContact(node)
+        elif result[1] is TIMED_OUT:
+            self.log.debug("%s is slow to respond, keeping it in the router" % node)
         else:
             self.log.debug("no response from %s, removing from router" % node)
             self.router.removeContact(node)
@@ -4,19 +4,220 @@ Copyright (c) 2015 OpenBazaar
 """
 
 import abc
+import time
 import random
+from collections import Counter
 from base64 import b64encode
-from config import PROTOCOL_VERSION
+from config import PROTOCOL_VERSION, MIN_PROTOCOL_VERSION
 from dht.node import Node
-from dht.utils import digest
+from dht.utils import digest, LRUCache
 from hashlib import sha1
+from keys.guid import get_identity
 from log import Logger
-from protos.message import Message, Command, NOT_FOUND, HOLE_PUNCH
+from protos.message import Command, NOT_FOUND, HOLE_PUNCH
 from protos.objects import FULL_CONE, RESTRICTED, SYMMETRIC
 from twisted.internet import defer, reactor
 from txrudp.connection import State
 
 
+def _varint(value):
+    out = []
+    while value > 0x7f:
+        out.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    out.append(chr(value))
+    return "".join(out)
+
+
+def _field(tag, data):
+    """
+    Encode a length delimited protobuf field.
+    """
+    return tag + _varint(len(data)) + data
+
+
+# Messages in the detached signature framing are DETACHED_FRAME, FRAME_VERSION,
+# the sender's 32 byte public key, the 64 byte signature and then the signed
+# bytes: the serialized `Message` without its signature. A serialized Message
+# never starts with a zero byte so the two framings can't be confused.
+DETACHED_FRAME = "\x00"
+FRAME_VERSION = 1
+
+# What a request fails with, as (False, TIMED_OUT), when it outlives a timeout
+# shortened by the peer's round trip time estimate. The peer may just be slow so
+# unlike (False, None) it isn't taken to mean the peer is gone.
+TIMED_OUT = "timed out"
+
+
+def openDetached(datagram):
+    """
+    Check the signature on a message in the detached signature framing, without
+    parsing it or serializing anything. The signed part of the datagram is still
+    copied once, since NaCl only verifies a `str`.
+
+    Returns: (the sender's public key, the serialized `Message` without its signature).
+    Raises an exception if the frame or the signature is bad.
+    """
+    if datagram[0] != DETACHED_FRAME or datagram[1] != chr(FRAME_VERSION):
+        raise ValueError("unknown message framing")
+    pubkey = datagram[2:34]
+    # the signature comes right before the signed bytes so the rest of the frame
+    # is already a signed message as NaCl expects it
+    return pubkey, get_identity(pubkey)[0].verify(datagram[34:])
+
+
+class MessageBuilder(object):
+    """
+    Builds signed, serialized `Message`s sent by one node.
+
+    The serialized sender field is kept until the node's proto changes (see
+    `Node.getSerializedProto`) and the rest of the envelope is encoded by hand,
+    once. Since protobuf writes fields in field number order and the signature
+    is the last field, the bytes we sign are exactly the message without its
+    signature and the signature can simply be appended to them. The result is
+    the same as building the `Message` and calling `SerializeToString`.
+    """
+
+    def __init__(self, node, signing_key):
+        self.node = node
+        self.signing_key = signing_key
+        self._frame = DETACHED_FRAME + chr(FRAME_VERSION) + signing_key.verify_key.encode()
+        self._proto = None
+        self._sender = None
+
+    def _senderField(self):
+        proto = self.node.getSerializedProto()
+        if proto is not self._proto:
+            self._proto = proto
+            self._sender = _field("\x12", proto)
+        return self._sender
+
+    def build(self, msgID, command, arguments, testnet, detached=False):
+        """
+        Args:
+            msgID: the message id.
+            command: a `Command` value.
+            arguments: a list of arguments, each converted with `str`.
+            testnet: whether we're on testnet.
+            detached: use the detached signature framing (see `openDetached`).
+        """
+        parts = [_field("\x0a", msgID), self._senderField(),
+                 "\x18" + _varint(command), "\x20" + _varint(PROTOCOL_VERSION)]
+        for arg in arguments:
+            parts.append(_field("\x2a", str(arg)))
+        parts.append("\x30\x01" if testnet else "\x30\x00")
+        signed = "".join(parts)
+        if detached:
+            return self._frame + self.signing_key.sign(signed)
+        return signed + _field("\x3a", self.signing_key.sign(signed)[:64])
+
+
+class RTTEstimate(object):
+    """
+    The smoothed round trip time and its variance for one peer, kept as in
+    RFC 6298.
+    """
+    __slots__ = ("srtt", "rttvar")
+
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+    GRANULARITY = 0.01
+
+    def __init__(self, sample):
+        self.srtt = sample
+        self.rttvar = sample / 2.0
+
+    def update(self, sample):
+        self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - sample)
+        self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * sample
+
+    def rto(self):
+        return self.srtt + max(self.GRANULARITY, self.K * self.rttvar)
+
+
+class OutstandingRequests(dict):
+    """
+    A dict of msgID -> [deferred, address, timeout, command, sent] for RPCs
+    waiting on a response, where sent is the time the request went out or None
+    if it shouldn't be used as a round trip time sample. It's also indexed by
+    address so failing every request to a peer only touches that peer's
+    requests, and it keeps a count of requests in flight for each command.
+    The command and sent time may be left off an entry.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.byAddress = {}
+        self.commands = Counter()
+
+    @staticmethod
+    def _command(entry):
+        return entry[3] if len(entry) > 3 else None
+
+    def _index(self, msgID, entry):
+        self.byAddress.setdefault(entry[1], set()).add(msgID)
+        self.commands[self._command(entry)] += 1
+
+    def _unindex(self, msgID):
+        entry = dict.__getitem__(self, msgID)
+        ids = self.byAddress[entry[1]]
+        ids.discard(msgID)
+        if len(ids) == 0:
+            del self.byAddress[entry[1]]
+        command = self._command(entry)
+        self.commands[command] -= 1
+        if self.commands[command] <= 0:
+            del self.commands[command]
+
+    def __setitem__(self, msgID, entry):
+        if msgID in self:
+            self._unindex(msgID)
+        dict.__setitem__(self, msgID, entry)
+        self._index(msgID, entry)
+
+    def __delitem__(self, msgID):
+        self._unindex(msgID)
+        dict.__delitem__(self, msgID)
+
+    def pop(self, msgID, *default):
+        if msgID in self:
+            self._unindex(msgID)
+        return dict.pop(self, msgID, *default)
+
+    def popitem(self):
+        msgID, entry = dict.popitem(self)
+        dict.__setitem__(self, msgID, entry)
+        del self[msgID]
+        return msgID, entry
+
+    def setdefault(self, msgID, entry=None):
+        if msgID not in self:
+            self[msgID] = entry
+        return dict.__getitem__(self, msgID)
+
+    def update(self, *args, **kwargs):
+        for msgID, entry in dict(*args, **kwargs).items():
+            self[msgID] = entry
+
+    def clear(self):
+        dict.clear(self)
+        self.byAddress.clear()
+        self.commands.clear()
+
+    def forAddress(self, address):
+        """
+        Get the msgIDs of the requests waiting on address.
+        """
+        return list(self.byAddress.get(address, ()))
+
+    def countFor(self, address):
+        """
+        Get the number of requests waiting on address.
+        """
+        return len(self.byAddress.get(address, ()))
+
+
 class RPCProtocol:
     """
     This is an abstract class for processing and sending rpc messages.
@@ -25,22 +226,52 @@ class RPCProtocol:
     """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, sourceNode, router, waitTimeout=15):
+    # the first protocol version to accept the detached signature framing
+    DETACHED_SIGNATURE_VERSION = 16
+
+    # Commands whose responses can be large. They're given at least bulkTimeout
+    # seconds and aren't used as round trip time samples.
+    BULK_COMMANDS = frozenset(["get_contract", "get_image", "get_profile", "get_listings", "get_user_metadata",
+                               "get_contract_metadata", "get_following", "get_followers", "get_ratings"])
+    # Commands the peer has to do real work to answer (signature checks, database
+    # writes, notifications) or whose responses can run to several packets. How
+    # fast the peer answers a PING says little about these, so they always get
+    # the full waitTimeout and aren't used as round trip time samples.
+    REMOTE_COMMANDS = frozenset(["find_value", "order", "order_confirmation", "complete_order", "message",
+                                 "dispute_open", "dispute_close"])
+    # never time out a request to a peer we have an estimate for sooner than this,
+    # so txrudp has time to retransmit a lost packet or two
+    MIN_TIMEOUT = 2
+    # the slowest rate, in bytes per second, we allow for when sending a large request
+    MIN_THROUGHPUT = 16384
+    # requests bigger than a packet make poor round trip time samples
+    RTT_SAMPLE_MAX_BYTES = 1000
+
+    def __init__(self, sourceNode, router, waitTimeout=15, bulkTimeout=60):
         """
         Args:
             sourceNode: A protobuf `Node` object containing info about this node.
             router: A `RoutingTable` object from dht.routing. Implies a `network.Server` object
                     must be started first.
             waitTimeout: Timeout for whole messages. Note the txrudp layer has a per-packet
-                    timeout but invalid responses wont trigger it. The waitTimeout on this
-                     layer needs to be long enough to allow whole messages (ex. images) to
-                     transmit.
+                    timeout but invalid responses wont trigger it. This is used for peers
+                    we don't have a round trip time estimate for yet and caps the timeout
+                    for those we do.
+            bulkTimeout: The shortest timeout for commands in `BULK_COMMANDS`, which
+                    needs to be long enough to allow whole messages (ex. images) to
+                    transmit.
 
         """
         self.sourceNode = sourceNode
         self.router = router
         self._waitTimeout = waitTimeout
-        self._outstanding = {}
+        self._bulkTimeout = bulkTimeout
+        # (ip, port) -> RTTEstimate
+        self.rtt = LRUCache(10000)
+        self._builder = None
+        self._outstanding = OutstandingRequests()
+        # guid -> the protocol version that node last sent us
+        self.peerVersions = LRUCache(10000)
         self.log = Logger(system=self)
 
     def receive_message(self, message, sender, connection, ban_score):
@@ -50,13 +281,14 @@ class RPCProtocol:
             connection.shutdown()
             return False
 
-        if message.protoVer < PROTOCOL_VERSION:
+        if message.protoVer < MIN_PROTOCOL_VERSION:
             self.log.warning("received message from %s with incompatible protocol version." %
                              str(connection.dest_addr))
             connection.shutdown()
             return False
 
         self.multiplexer.vendors[sender.id] = sender
+        self.peerVersions.set(sender.id, message.protoVer)
 
         msgID = message.messageID
         if message.command == NOT_FOUND:
@@ -75,11 +307,19 @@ class RPCProtocol:
             self.log.debug("received response for message id %s from %s" % msgargs)
         else:
             self.log.warning("received 404 error response from %s" % sender)
-        d = self._outstanding[msgID][0]
-        if self._outstanding[msgID][2].active():
-            self._outstanding[msgID][2].cancel()
-        d.callback((True, data))
-        del self._outstanding[msgID]
+        entry = self._outstanding.pop(msgID)
+        if entry[2].active():
+            entry[2].cancel()
+        if len(entry) > 4 and entry[4] is not None:
+            self._sampleRTT(entry[1], time.time() - entry[4])
+        entry[0].callback((True, data))
+
+    def _sampleRTT(self, address, sample):
+        estimate = self.rtt.get(address)
+        if estimate is None:
+            self.rtt.set(address, RTTEstimate(sample))
+        else:
+            estimate.update(sample)
 
     def _acceptRequest(self, msgID, funcname, args, sender, connection):
         self.log.debug("received request from %s, command %s" % (sender, funcname.upper()))
@@ -97,34 +337,111 @@ class RPCProtocol:
 
     def _sendResponse(self, response, funcname, msgID, sender, connection):
         self.log.debug("sending response for msg id %s to %s" % (b64encode(msgID), sender))
-        m = Message()
-        m.messageID = msgID
-        m.sender.MergeFrom(self.sourceNode.getProto())
-        m.protoVer = PROTOCOL_VERSION
-        m.testnet = self.multiplexer.testnet
         if response is None:
-            m.command = NOT_FOUND
+            data = self._buildMessage(sender, msgID, NOT_FOUND, [])
         else:
-            m.command = Command.Value(funcname.upper())
             if not isinstance(response, list):
                 response = [response]
-            for arg in response:
-                m.arguments.append(str(arg))
-        m.signature = self.signing_key.sign(m.SerializeToString())[:64]
-        connection.send_message(m.SerializeToString())
+            data = self._buildMessage(sender, msgID, Command.Value(funcname.upper()), response)
+        connection.send_message(data)
+
+    def _buildMessage(self, node, msgID, command, arguments):
+        """
+        Build a message for node, in the detached signature framing if it's known
+        to support it.
+        """
+        builder = self._builder
+        if builder is None or builder.node is not self.sourceNode or builder.signing_key is not self.signing_key:
+            builder = self._builder = MessageBuilder(self.sourceNode, self.signing_key)
+        detached = self.peerVersion(node) >= self.DETACHED_SIGNATURE_VERSION
+        return builder.build(msgID, command, arguments, self.multiplexer.testnet, detached)
+
+    def inflight(self):
+        """
+        Get the number of RPCs waiting on a response, as a dict with the count
+        for each peer address under 'peers' and for each command under 'commands'.
+        """
+        return {'peers': dict((address, len(ids)) for address, ids in self._outstanding.byAddress.items()),
+                'commands': dict((command, n) for command, n in self._outstanding.commands.items()
+                                 if command is not None)}
+
+    def rttEstimate(self, node):
+        """
+        Get (smoothed round trip time, round trip time variance) in seconds for
+        node, or None if we haven't measured it yet.
+        """
+        estimate = self.rtt.get((node.ip, node.port))
+        if estimate is None:
+            return None
+        return estimate.srtt, estimate.rttvar
+
+    def rpcTimeout(self, node, command, size=0):
+        """
+        Get how long to wait for a response to a command sent to node.
+
+        Requests to peers with a round trip time estimate wait for the
+        retransmission timeout from RFC 6298, clamped between MIN_TIMEOUT and
+        our waitTimeout. Other peers, and commands in REMOTE_COMMANDS, get the
+        full waitTimeout. Commands in BULK_COMMANDS, whose responses can be
+        large, wait at least bulkTimeout, and large requests get extra time to
+        transmit at MIN_THROUGHPUT.
+
+        Args:
+            command: the lower case command name.
+            size: the size of the serialized request in bytes.
+        """
+        estimate = self.rtt.get((node.ip, node.port))
+        timeout = self._waitTimeout
+        if estimate is not None and command not in self.REMOTE_COMMANDS:
+            timeout = min(max(estimate.rto(), self.MIN_TIMEOUT), self._waitTimeout)
+        if command in self.BULK_COMMANDS:
+            timeout = max(timeout, self._bulkTimeout)
+        return timeout + float(size) / self.MIN_THROUGHPUT
+
+    def peerVersion(self, node):
+        """
+        Get the protocol version node is running, or 0 if we haven't heard from it.
+        """
+        return self.peerVersions.get(node.id, 0)
+
+    def _timeoutRequest(self, msgID, node, shortened=False):
+        """
+        Called when a single request has waited out its `rpcTimeout`. Only that
+        request fails; the connection and any other requests to the peer are
+        left to the txrudp connection handler, which calls `timeout` if the
+        peer is really gone. If the timeout was shortened below waitTimeout
+        the request fails with (False, TIMED_OUT) so callers can tell a slow
+        peer from a missing one.
+        """
+        val = self._outstanding.pop(msgID, None)
+        if val is None:
+            return
+        self.log.debug("%s request to %s timed out (msgid %s)" % (val[3], val[1], b64encode(msgID)))
+        # the estimate was too optimistic, start the next request from a conservative timeout
+        self.rtt.invalidate(val[1])
+        val[0].callback((False, TIMED_OUT if shortened else None))
+        self.requestTimedOut(node)
+
+    def requestTimedOut(self, node):
+        """
+        Called after a single request to node has timed out. Does nothing here,
+        subclasses can override it.
+        """
 
     def timeout(self, node):
         """
-        This timeout is called by the txrudp connection handler. We will run through the
-        outstanding messages and callback false on any waiting on this IP address.
+        This timeout is called by the txrudp connection handler. We callback false on
+        every outstanding message waiting on this IP address.
         """
         address = (node.ip, node.port)
-        for msgID, val in self._outstanding.items():
-            if address == val[1]:
+        # the next request will have to start from a conservative timeout again
+        self.rtt.invalidate(address)
+        for msgID in self._outstanding.forAddress(address):
+            val = self._outstanding.pop(msgID, None)
+            if val is not None:
+                if val[2].active():
+                    val[2].cancel()
                 val[0].callback((False, None))
-                if self._outstanding[msgID][2].active():
-                    self._outstanding[msgID][2].cancel()
-                del self._outstanding[msgID]
 
         self.router.removeContact(node)
         try:
@@ -160,16 +477,8 @@ class RPCProtocol:
         def func(node, *args):
             msgID = sha1(str(random.getrandbits(255))).digest()
 
-            m = Message()
-            m.messageID = msgID
-            m.sender.MergeFrom(self.sourceNode.getProto())
-            m.command = Command.Value(name.upper())
-            m.protoVer = PROTOCOL_VERSION
-            for arg in args:
-                m.arguments.append(str(arg))
-            m.testnet = self.multiplexer.testnet
-            m.signature = self.signing_key.sign(m.SerializeToString())[:64]
-            data = m.SerializeToString()
+            command = Command.Value(name.upper())
+            data = self._buildMessage(node, msgID, command, args)
 
             address = (node.ip, node.port)
             relay_addr = None
@@ -178,9 +487,13 @@ class RPCProtocol:
                 relay_addr = node.relay_node
 
             d = defer.Deferred()
-            if m.command != HOLE_PUNCH:
-                timeout = reactor.callLater(self._waitTimeout, self.timeout, node)
-                self._outstanding[msgID] = [d, address, timeout]
+            if command != HOLE_PUNCH:
+                wait = self.rpcTimeout(node, name, len(data))
+                timeout = reactor.callLater(wait, self._timeoutRequest, msgID, node,
+                                            wait < self._waitTimeout)
+                sample = len(data) <= self.RTT_SAMPLE_MAX_BYTES and \
+                    name not in self.BULK_COMMANDS and name not in self.REMOTE_COMMANDS
+                self._outstanding[msgID] = [d, address, timeout, name, time.time() if sample else None]
                 self.log.debug("calling remote function %s on %s (msgid %s)" % (name, address, b64encode(msgID)))
 
             self.multiplexer.send_message(data, address, relay_addr)
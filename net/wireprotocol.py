@@ -1,13 +1,13 @@
 __author__ = 'chris'
 import socket
-import nacl.signing
-import nacl.hash
 from config import SEEDS
 from dht.node import Node
 from dht.utils import digest
 from interfaces import MessageProcessor
+from keys.guid import verify_guid
 from log import Logger
 from net.dos import BanScore
+from net.rpcudp import DETACHED_FRAME, openDetached
 from protos.message import Message, PING, NOT_FOUND
 from protos.objects import FULL_CONE
 from random import shuffle
@@ -76,24 +76,21 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
                 return False
             m = Message()
             try:
-                m.ParseFromString(datagram)
-                self.node = Node(m.sender.guid,
-                                 m.sender.nodeAddress.ip,
-                                 m.sender.nodeAddress.port,
-                                 m.sender.publicKey,
-                                 None if not m.sender.HasField("relayAddress") else
-                                 (m.sender.relayAddress.ip, m.sender.relayAddress.port),
-                                 m.sender.natType,
-                                 m.sender.vendor)
-                pubkey = m.sender.publicKey
-                verify_key = nacl.signing.VerifyKey(pubkey)
-                signature = m.signature
-                m.ClearField("signature")
-                verify_key.verify(m.SerializeToString(), signature)
-                h = nacl.hash.sha512(m.sender.publicKey)
-                pow_hash = h[40:]
-                if int(pow_hash[:6], 16) >= 50 or m.sender.guid.encode("hex") != h[:40]:
-                    raise Exception('Invalid GUID')
+                if datagram[0] == DETACHED_FRAME:
+                    # newer peers send the signature next to the bytes it covers,
+                    # so it's checked before parsing and nothing is re-serialized
+                    pubkey, signed = openDetached(datagram)
+                    m.ParseFromString(signed)
+                    if m.sender.publicKey != pubkey:
+                        raise Exception('Wrong public key')
+                    verify_guid(m.sender.publicKey, m.sender.guid)
+                else:
+                    m.ParseFromString(datagram)
+                    verify_key = verify_guid(m.sender.publicKey, m.sender.guid)
+                    signature = m.signature
+                    m.ClearField("signature")
+                    verify_key.verify(m.SerializeToString(), signature)
+                self.node = Node.fromProto(m.sender)
             except Exception:
                 # If message isn't formatted property then ignore
                 self.log.warning("received an invalid message from %s, ignoring" % self.addr)
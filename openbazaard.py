@@ -11,12 +11,14 @@ import urllib2
 from api.ws import WSFactory, AuthenticatedWebSocketProtocol, AuthenticatedWebSocketFactory
 from api.restapi import RestAPI
 from config import DATA_FOLDER, KSIZE, ALPHA, LIBBITCOIN_SERVER,\
-    LIBBITCOIN_SERVER_TESTNET, SSL_KEY, SSL_CERT, SEEDS, SSL
+    LIBBITCOIN_SERVER_TESTNET, SSL_KEY, SSL_CERT, SEEDS, SSL, DHT_MAX_BYTES,\
+    DHT_MAX_ENTRIES, DHT_MAX_VALUES_PER_KEYWORD, DHT_EVICTION_POLICY
 from daemon import Daemon
 from db.datastore import Database
 from dht.network import Server
 from dht.node import Node
-from dht.storage import PersistentStorage, ForgetfulStorage
+from dht.storage import PersistentStorage, ForgetfulStorage, LogStorage, StorageQuota, FarthestFirst,\
+    LeastRecentlyUsed, SoonestExpiring
 from keys.credentials import get_credentials
 from keys.keychain import KeyChain
 from log import Logger, FileLogObserver
@@ -44,6 +46,7 @@ def run(*args):
     RESTPORT = args[4]
     WSPORT = args[5]
     HEARTBEATPORT = args[6]
+    STORAGE = args[7]
 
     def start_server(keys, first_startup=False):
         # logging
@@ -79,7 +82,21 @@ def run(*args):
                                       relaying=True if nat_type == FULL_CONE else False)
 
         # kademlia
-        storage = ForgetfulStorage() if TESTNET else PersistentStorage(db.get_database_path())
+        if DHT_EVICTION_POLICY == "lru":
+            policy = LeastRecentlyUsed()
+        elif DHT_EVICTION_POLICY == "expiring":
+            policy = SoonestExpiring()
+        else:
+            policy = FarthestFirst(keys.guid)
+        quota = StorageQuota(DHT_MAX_BYTES, DHT_MAX_ENTRIES, DHT_MAX_VALUES_PER_KEYWORD, policy)
+        if STORAGE == "log":
+            storage = LogStorage(DATA_FOLDER + ("dht-testnet.store" if TESTNET else "dht.store"), quota=quota)
+            reactor.addSystemEventTrigger('before', 'shutdown', storage.close)
+        elif STORAGE == "memory" or (STORAGE is None and TESTNET):
+            storage = ForgetfulStorage(quota=quota)
+        else:
+            storage = PersistentStorage(db.get_database_path(), flush_interval=2, quota=quota)
+            reactor.addSystemEventTrigger('before', 'shutdown', storage.flush)
         relay_node = None
         if nat_type != FULL_CONE:
             for seed in SEEDS:
@@ -158,7 +175,7 @@ def run(*args):
 
         heartbeat_server.set_status("online")
 
-        logger.info("Startup took %s seconds" % str(round(time.time() - args[7], 2)))
+        logger.info("Startup took %s seconds" % str(round(time.time() - args[8], 2)))
 
     # database
     db = Database(TESTNET)
@@ -224,6 +241,8 @@ commands:
             parser.add_argument('-r', '--restapiport', help="set the rest api port", default=18469)
             parser.add_argument('-w', '--websocketport', help="set the websocket api port", default=18466)
             parser.add_argument('-b', '--heartbeatport', help="set the heartbeat port", default=18470)
+            parser.add_argument('-s', '--storage', choices=["memory", "sqlite", "log"],
+                                help="set the dht storage backend (default: memory on testnet, sqlite otherwise)")
             parser.add_argument('--pidfile', help="name of the pid file", default="openbazaard.pid")
             args = parser.parse_args(sys.argv[2:])
 
@@ -251,11 +270,11 @@ commands:
                 self.daemon.pidfile = "/tmp/" + args.pidfile
                 self.daemon.start(args.testnet, args.loglevel, port, args.allowip,
                                   int(args.restapiport), int(args.websocketport),
-                                  int(args.heartbeatport), time.time())
+                                  int(args.heartbeatport), args.storage, time.time())
             else:
                 run(args.testnet, args.loglevel, port, args.allowip,
                     int(args.restapiport), int(args.websocketport),
-                    int(args.heartbeatport), time.time())
+                    int(args.heartbeatport), args.storage, time.time())
 
         def stop(self):
             # pylint: disable=W0612
@@ -0,0 +1,57 @@
+"""
+Micro-benchmark for building outgoing messages.
+
+Times building and signing a FIND_NODE request the way RPCProtocol used to
+(fill in a `Message`, serialize it to sign, then serialize it again to send)
+against `MessageBuilder`, which reuses the serialized sender and serializes
+once.
+
+Usage: python scripts/bench_messages.py [messages]
+"""
+import os
+import sys
+import time
+import hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import nacl.signing  # pylint: disable=import-error
+from config import PROTOCOL_VERSION  # pylint: disable=import-error
+from dht.node import Node  # pylint: disable=import-error
+from net.rpcudp import MessageBuilder  # pylint: disable=import-error
+from protos.message import Message, FIND_NODE  # pylint: disable=import-error
+from protos.objects import FULL_CONE  # pylint: disable=import-error
+
+
+def protobufBuild(node, signing_key, msgID, args):
+    m = Message()
+    m.messageID = msgID
+    m.sender.MergeFrom(node.getProto())
+    m.command = FIND_NODE
+    m.protoVer = PROTOCOL_VERSION
+    for arg in args:
+        m.arguments.append(str(arg))
+    m.testnet = False
+    m.signature = signing_key.sign(m.SerializeToString())[:64]
+    return m.SerializeToString()
+
+
+def bench(name, build, count):
+    msgIDs = [hashlib.sha1(str(i)).digest() for i in range(count)]
+    args = [hashlib.sha1("target").digest()]
+    start = time.time()
+    for msgID in msgIDs:
+        build(msgID, args)
+    elapsed = time.time() - start
+    print "%-10s %8.0f messages/sec" % (name, count / elapsed)
+
+
+if __name__ == "__main__":
+    COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    SIGNING_KEY = nacl.signing.SigningKey.generate()
+    NODE = Node(hashlib.sha1("me").digest(), "127.0.0.1", 18467, SIGNING_KEY.verify_key.encode(),
+                None, FULL_CONE, True)
+    BUILDER = MessageBuilder(NODE, SIGNING_KEY)
+    assert protobufBuild(NODE, SIGNING_KEY, "id", ["a"]) == BUILDER.build("id", FIND_NODE, ["a"], False)
+    bench("protobuf", lambda msgID, args: protobufBuild(NODE, SIGNING_KEY, msgID, args), COUNT)
+    bench("builder", lambda msgID, args: BUILDER.build(msgID, FIND_NODE, args, False), COUNT)
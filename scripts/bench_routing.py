@@ -0,0 +1,113 @@
+"""
+Micro-benchmark for RoutingTable.addContact and neighbor lookups.
+
+Fills a routing table with roughly 1k and 10k contacts and then times re-adding
+contacts that are already in it (the common case, since addContact runs for
+every message we receive). The old full-table duplicate scan is timed
+alongside the address index for comparison.
+
+It then times finding the k closest contacts to random ids by walking the
+buckets (findNeighbors) and by scanning every contact (the flat scan
+findNeighborsMany switches to when k is large).
+
+Usage: python scripts/bench_routing.py [rounds]
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dht.node import Node  # pylint: disable=import-error
+from dht.routing import RoutingTable  # pylint: disable=import-error
+
+
+class _Protocol(object):
+    def callPing(self, node):
+        pass
+
+
+def scanForDuplicate(router, node):
+    """
+    The duplicate check addContact used to do: walk every node in every bucket.
+    """
+    for bucket in router.buckets:
+        for n in bucket.getNodes():
+            if (n.ip, n.port) == (node.ip, node.port) and n.id != node.id:
+                router.removeContact(n)
+
+
+def makeTable(size):
+    me = Node(hashlib.sha1("me").digest(), "127.0.0.1", 18467)
+    # buckets far from us only split when their depth allows it, so a table
+    # with k=20 tops out well short of 10k contacts. Scale k with the size
+    # instead; the duplicate check doesn't care how the contacts are bucketed.
+    router = RoutingTable(_Protocol(), max(20, size / 4), me)
+    contacts = []
+    for _ in range(size):
+        node = Node(hashlib.sha1(str(random.getrandbits(255))).digest(),
+                    "10.%d.%d.%d" % (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)),
+                    random.randint(1024, 65535))
+        router.addContact(node)
+        if not router.isNewNode(node):
+            contacts.append(node)
+    return router, [n for n in contacts if not router.isNewNode(n)]
+
+
+def bench(size, rounds):
+    router, contacts = makeTable(size)
+    sample = [random.choice(contacts) for _ in range(rounds)]
+
+    start = time.time()
+    for node in sample:
+        router.addContact(node)
+    indexed = (time.time() - start) / rounds
+
+    start = time.time()
+    for node in sample:
+        scanForDuplicate(router, node)
+    scanned = (time.time() - start) / rounds
+
+    print "%6d contacts (%4d buckets): addContact %8.2f us, full scan duplicate check %9.2f us" % \
+        (len(router.addresses), len(router.buckets), indexed * 1e6, scanned * 1e6)
+
+
+def benchNeighbors(size, rounds):
+    """
+    Time lookups on a table with the real k, which splits into many small buckets.
+    """
+    router = RoutingTable(_Protocol(), 20, Node(hashlib.sha1("me").digest(), "127.0.0.1", 18467))
+    for i in range(size):
+        router.addContact(Node(hashlib.sha1(str(random.getrandbits(255))).digest(), "10.0.0.1", i))
+    targets = [Node(hashlib.sha1(str(random.getrandbits(255))).digest()) for _ in range(rounds)]
+    for k in (20, 40, 80):
+        start = time.time()
+        for target in targets:
+            router.findNeighbors(target, k)
+        walked = (time.time() - start) / rounds
+
+        start = time.time()
+        for i in range(0, rounds, 16):
+            router.findNeighborsMany(targets[i:i + 16], k)
+        many = (time.time() - start) / rounds
+
+        router.FLAT_SCAN_MIN_K = 0
+        start = time.time()
+        for i in range(0, rounds, 16):
+            router.findNeighborsMany(targets[i:i + 16], k)
+        flat = (time.time() - start) / rounds
+        del router.FLAT_SCAN_MIN_K
+
+        print "%6d contacts (%3d buckets), k=%2d: bucket walk %7.2f us, findNeighborsMany %7.2f us, " \
+              "flat scan %7.2f us per target" % \
+            (len(router.addresses), len(router.buckets), k, walked * 1e6, many * 1e6, flat * 1e6)
+
+
+if __name__ == "__main__":
+    ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for SIZE in (1000, 10000):
+        bench(SIZE, ROUNDS)
+    for SIZE in (1000, 10000):
+        benchNeighbors(SIZE, ROUNDS)